@@ -1,19 +1,279 @@
+import gzip
+import hashlib
 import pathlib
 import secrets
 import os
 import sys
-from datetime import datetime
+import json
+import atexit
+import threading
+import time
+import cProfile
+import itertools
+import sqlite3
+from datetime import datetime, timezone
 from base64 import b64decode
-from flask import Flask, request, current_app, Response, render_template
-from db import Database
-from collections import defaultdict
+import numpy as np
+from flask import Flask, request, current_app, Response, render_template, stream_with_context, g
+from db import (Database, data_revision, is_locked, uplink_key, DATA_COLUMNS, DUPLICATE_WINDOW, ROLLUP_METRICS,
+                ROLLUP_RESOLUTIONS, ROUTE_COLUMNS)
+from archive import RawArchive
+from backfill import prepare_uplink
+from downsample import lttb
+from ingest import IngestQueue, RecentUplinks, gateway_ids
+from queue import Full, Empty
+from live import Broadcaster
+from export import EXPORT_FIELDS, COLUMN_FIELDS, POSITION_COLUMNS, export_csv, export_geojson, export_kml, encode_columns
+from spatial import cover, precision_for_zoom
+from metrics import registry, stage
 
 app = Flask(__name__)
 app.config['DATABASE_PATH'] = str(pathlib.Path().resolve())
+app.config['API_PAGE_LIMIT'] = 1000
+app.config['GRAPH_POINTS'] = 500
+app.config['ROLLUP_MAX_BUCKETS'] = 500     # the finest resolution of /api/rollup giving at most this many buckets
+app.config['ARCHIVE_SEGMENT_BYTES'] = 16 * 1024 * 1024
+app.config['ARCHIVE_SEGMENT_SECONDS'] = 24 * 3600
+app.config['ARCHIVE_COMPRESS'] = True
+app.config['INGEST_ASYNC'] = True
+app.config['LIVE_INTERVAL'] = 1.0
+app.config['STREAM_MAX_CLIENTS'] = 8       # connected /api/stream clients per process, each holds a thread
+app.config['INGEST_MAX_BATCH'] = 100
+app.config['INGEST_MAX_DELAY'] = 0.5
+app.config['INGEST_QUEUE_SIZE'] = 10000
+app.config['INGEST_RETRIES'] = 5       # batches stored in background are stored again when database is locked
+app.config['INGEST_RETRY_DELAY'] = 1.0     # seconds before the first retry, doubled for every next one
+app.config['DEDUP_CACHE_SIZE'] = 10000     # recently accepted uplinks remembered by every process, see RecentUplinks
+app.config['PROFILE_REQUESTS'] = False      # dump cProfile of every request to profiles/, see profile_request()
+
+# derived data shared by table, markers and graphs, see provide_derived_data()
+_derived_cache = {'revision': None, 'data': None}
+_derived_lock = threading.Lock()
+
+# rendered (and compressed) responses of any endpoint, see cached_response()
+_response_cache = {'revision': None, 'rendered': {}}
+_response_lock = threading.Lock()
+
+# resources owned by this process, see provide_archive() and provide_ingest_queue()
+_process_lock = threading.Lock()
+
+# archives of raw uplinks, one per database path and process
+_archives = {}
+
+# queues of received uplinks, one per database path and process
+_ingest_queues = {}
+
+# live feeds of new rows, one per database path and process
+_broadcasters = {}
+
+# recently accepted uplinks, one per database path and process
+_recent_uplinks = {}
+
+# user and password for endpoint, see load_credentials()
+_credentials = {}
+
+# only one request can be profiled at a time (profiler is global since Python 3.12)
+_profile_lock = threading.Lock()
+# streamed responses would hold the profiler for the whole life of the stream, they are never profiled
+UNPROFILED_ENDPOINTS = {'stream', 'export'}
+
+
+def provide_archive():
+    '''Provide archive of raw uplinks (in cloud_data/) written by this process'''
+    key = (app.config['DATABASE_PATH'], os.getpid())
+    with _process_lock:
+        if key not in _archives:
+            _archives[key] = RawArchive(f'''{app.config['DATABASE_PATH']}/cloud_data''',
+                                        max_bytes=app.config['ARCHIVE_SEGMENT_BYTES'],
+                                        max_age=app.config['ARCHIVE_SEGMENT_SECONDS'],
+                                        compress=app.config['ARCHIVE_COMPRESS'])
+        return _archives[key]
+
+
+@atexit.register
+def close_archives():
+    '''Close (and compress) segments written by this process, called at exit'''
+    with _process_lock:
+        for archive in _archives.values():
+            archive.close()
+        _archives.clear()
+
+
+def provide_ingest_queue():
+    '''Provide queue which stores received uplinks in background (see ingest.IngestQueue), one per process'''
+    path = app.config['DATABASE_PATH']
+    key = (path, os.getpid())
+    with _process_lock:
+        if key not in _ingest_queues:
+            _ingest_queues[key] = IngestQueue(lambda uplinks: store_uplinks(path, uplinks, app.config['INGEST_RETRIES']),
+                                              max_batch=app.config['INGEST_MAX_BATCH'],
+                                              max_delay=app.config['INGEST_MAX_DELAY'],
+                                              max_size=app.config['INGEST_QUEUE_SIZE'])
+        return _ingest_queues[key]
+
+
+@atexit.register
+def close_ingest_queues():
+    '''Store all queued uplinks, called at exit (before archives are closed)'''
+    with _process_lock:
+        queues = list(_ingest_queues.values())
+        _ingest_queues.clear()
+    for ingest_queue in queues:
+        ingest_queue.close()
+
+
+def provide_recent_uplinks():
+    '''Provide LRU of recently stored uplinks (see ingest.RecentUplinks), one per process'''
+    key = (app.config['DATABASE_PATH'], os.getpid())
+    with _process_lock:
+        if key not in _recent_uplinks:
+            _recent_uplinks[key] = RecentUplinks(app.config['DEDUP_CACHE_SIZE'], DUPLICATE_WINDOW)
+        return _recent_uplinks[key]
+
+
+def provide_broadcaster():
+    '''Provide live feed of new rows (see live.Broadcaster), one per process'''
+    path = app.config['DATABASE_PATH']
+    key = (path, os.getpid())
+    with _process_lock:
+        if key not in _broadcasters:
+            _broadcasters[key] = Broadcaster(revision=lambda: data_revision(path),
+                                             fetch=lambda since: provide_live_events(path, since),
+                                             latest=lambda: Database(path).fetch_latest_data_id(),
+                                             interval=app.config['LIVE_INTERVAL'],
+                                             max_subscribers=app.config['STREAM_MAX_CLIENTS'])
+        return _broadcasters[key]
+
+
+def provide_live_events(path, since):
+    '''
+    Provide rows stored after row data_id since as events of the live feed, list of data_id and event with:
+        - table = row of summary table
+        - marker = marker and its card, None if row is not localizable
+        - route = longitude and latitude on the route of the flight (see provide_data_route()), None if unknown
+        - temp, alt = time and value for graphs, None if value is missing
+    '''
+    rows = Database(path).fetch_derived_after(since)
+    events = []
+    for (data_id, position, _), row in zip(rows, format_derived_rows([row for _, _, row in rows])):
+        derived = build_derived_data([row])
+        temp = derived['series']['temp']
+        alt = derived['series']['alt']
+        marker = derived['markers'][0] if derived['markers'] else None
+        if marker:
+            marker[0] = f'live-{data_id}'     # unique marker id
+        events.append((data_id, {
+            'table': derived['table'][0],
+            'marker': marker,
+            'route': position,
+            'temp': [temp[0][0], temp[1][0]] if temp[0] else None,
+            'alt': [alt[0][0], alt[1][0]] if alt[0] else None,
+        }))
+    return events
+
+
+def store_uplinks(path, uplinks, retries=0):
+    '''
+    Append received uplinks (pairs of timestamp and raw data) to the archive and store them into database
+    in a single transaction, only dictionaries are stored into database
+    Every uplink is parsed on its own, an uplink which cannot be parsed or stored is skipped and counted
+    (uplinks_rejected_total, reason malformed), so it cannot take valid uplinks of the batch down with it
+    Duplicate deliveries are not stored again, their gateways are merged into the stored uplink (see Database.store_many())
+    A failed batch is rolled back, batches which waited for a lock of the database too long are counted
+    (sqlite_locked_total) and stored again up to retries times (INGEST_RETRY_DELAY doubled every time),
+    then the error is raised; only committed uplinks are remembered as recent ones (see provide_recent_uplinks())
+    '''
+    archive = provide_archive()
+    with stage('archive_write'):
+        for timestamp, raw_data in uplinks:
+            archive.append(timestamp, raw_data)
+    rows = []
+    with stage('prepare_data'):
+        for timestamp, raw_data in uplinks:
+            if type(raw_data) == dict:
+                try:
+                    rows.append(prepare_uplink(timestamp, raw_data))
+                except Exception:
+                    reject_malformed(raw_data)
+    if not rows:
+        return
+    with stage('store_data'):
+        database = Database(path)
+        for attempt in itertools.count():
+            try:
+                stored, committed = store_rows(database, rows)
+                break
+            except Exception as error:
+                if not is_locked(error):
+                    raise
+                registry.increment('sqlite_locked_total', (('stage', 'store_data'),))
+                if attempt >= retries:
+                    raise
+                time.sleep(app.config['INGEST_RETRY_DELAY'] * 2 ** attempt)
+    recent_uplinks = provide_recent_uplinks()
+    for data, raw_data in committed:
+        key = uplink_key(raw_data)
+        if key is not None:
+            recent_uplinks.add(key, gateway_ids(raw_data), data['timestamp'])
+    registry.increment('uplinks_stored_total', value=stored)
+    registry.increment('uplinks_duplicate_total', (('stage', 'database'),), len(committed) - stored)
+
+
+def store_rows(database, rows):
+    '''
+    Store parsed uplinks (pairs of parsed data and raw data) and commit them in a single transaction,
+    when the batch fails for another reason than a lock, every uplink is stored in its own transaction
+    and those which fail are skipped (see reject_malformed())
+    Return number of inserted rows and committed uplinks (inserted or merged duplicates)
+    '''
+    try:
+        stored = database.store_many(rows)
+        database.commit()
+        return stored, rows
+    except Exception as error:
+        database.rollback()
+        if is_locked(error):
+            raise
+    stored = 0
+    committed = []
+    for row in rows:
+        try:
+            stored += database.store_many([row])
+            database.commit()
+            committed.append(row)
+        except Exception as error:
+            database.rollback()
+            if is_locked(error):
+                raise
+            reject_malformed(row[1])
+    return stored, committed
+
+
+def reject_malformed(raw_data):
+    '''Count and log an uplink which cannot be parsed or stored'''
+    registry.increment('uplinks_rejected_total', (('reason', 'malformed'),))
+    app.logger.warning(f'Malformed uplink skipped: {raw_data!r:.200}', exc_info=True)
+
+
+def is_authorized():
+    '''True if the request carries user and password of credentials.txt (basic auth)'''
+    user, password = load_credentials()
+    auth = request.authorization
+    return bool(auth) and auth.username == user and auth.password == password
+
+
+def load_credentials(path='credentials.txt'):
+    '''Read user and password for endpoint, file is read again only when it is modified'''
+    modified = os.stat(path).st_mtime_ns
+    if path not in _credentials or _credentials[path][0] != modified:
+        with open(path) as f:
+            user, password = f.read().strip().split(':')
+        _credentials[path] = (modified, user, password)
+    return _credentials[path][1:]
 
 
 def pretty_format(value, digits=None, suffix=None, divisor=None):
-    if value == 'None':
+    if value is None:
         return 'missing'
     else:
         if divisor:
@@ -33,15 +293,7 @@ def provide_data_markers():
         - card_body = information about temperature, battery, altitude, longitude and latitude
         - longitude, latitude
     '''
-    data_all = provide_data_table()
-    data_markers = []
-    for i, entry in enumerate(data_all):
-        time, pressure, temp, alt, lat, lon, battery = entry
-        if lat != 'missing' and lon != 'missing':   # marker must be localizable
-            marker_id = i
-            card_body = f'temperature: {temp}, probe battery: {battery}, altitude: {alt}, longitude: {lon}, latitude: {lat}'
-            data_markers.append([marker_id, time, card_body, lon, lat])
-    return data_markers
+    return provide_derived_data()['markers']
 
 
 def provide_data_table():
@@ -56,38 +308,132 @@ def provide_data_table():
         - Battery
     If there are missing data from GPS use data from gateways
     '''
-    data_all = provide_data()
-    data_table = []
-    for row in data_all:
-        time, pressure, temp, alt, lat, lon, battery, lat_gw, lon_gw, alt_gw = row
-        if alt == 'missing':
-            alt = alt_gw
-        if lat == 'missing':
-            lat = lat_gw
-        if lon == 'missing':
-            lon = lon_gw
-        data_table.append([time, pressure, temp, alt, lat, lon, battery])
-    return data_table
+    return provide_derived_data()['table']
+
+
+def provide_data_route():
+    '''
+    Provide longitude and latitude of every localizable row, for the route of the flight,
+    estimated track (see track.py) fills rows without GPS fix (see ROUTE_COLUMNS)
+    '''
+    rows = Database(app.config['DATABASE_PATH']).iter_derived(ROUTE_COLUMNS)
+    return [list(row) for row in rows if row[0] is not None]
+
+
+def provide_flight_database(flight_id):
+    '''
+    Provide database holding rows of a flight, archived flights are kept in flights/<flight_id>/ (see archive_flights())
+    Return None for unknown flight
+    '''
+    database = Database(app.config['DATABASE_PATH'])
+    for flight in database.fetch_flights():
+        if flight[0] == flight_id:
+            return Database(flight_archive_path(flight_id)) if flight[-1] else database
+    return None
+
+
+def flight_archive_path(flight_id):
+    return f'''{app.config['DATABASE_PATH']}/flights/{flight_id}'''
+
+
+def archive_flights():
+    '''
+    Move finished flights (all but the latest flight of every device) out of the hot tables, to flights/<flight_id>/
+    Return list of archived flights
+    '''
+    database = Database(app.config['DATABASE_PATH'])
+    devices = set()
+    archived = []
+    for flight_id, dev_id, hardware_serial, _, _, _, is_archived in database.fetch_flights():   # latest first
+        if (dev_id, hardware_serial) not in devices:
+            devices.add((dev_id, hardware_serial))
+        elif not is_archived:
+            database.archive_flight(flight_id, flight_archive_path(flight_id))
+            archived.append(flight_id)
+    return archived
+
+
+def provide_marker_clusters(west, south, east, north, zoom):
+    '''
+    Provide markers within a bounding box, rows close to each other (for map zoom level) are clustered:
+        - lat, lon = average position of rows of a cluster
+        - count = number of rows
+        - id = data_id of the latest row of a cluster, its card is loaded by /api/markers/<id>
+    Rows are grouped by prefix of geohash stored with derived values (see spatial.py)
+    '''
+    cells = cover(west, south, east, north)
+    precision = max(precision_for_zoom(zoom), len(cells[0]))
+    clusters = Database(app.config['DATABASE_PATH']).fetch_clusters(cells, precision, west, south, east, north)
+    return [{'lat': lat, 'lon': lon, 'count': count, 'id': data_id} for _, count, lat, lon, data_id in clusters]
+
 
+def provide_marker_card(data_id):
+    '''Provide time and card body of a marker (see provide_data_markers()), None if row is not localizable'''
+    row = Database(app.config['DATABASE_PATH']).fetch_derived_row(data_id)
+    markers = build_derived_data(format_derived_rows([row]))['markers'] if row else None
+    if not markers:
+        return None
+    return {'time': markers[0][1], 'card': markers[0][2], 'lon': markers[0][3], 'lat': markers[0][4]}
 
-def provide_data_graph():
-    data_all = provide_data()
+
+def provide_derived_data():
+    '''
+    Provide data for table, markers and graphs, computed by build_derived_data() from provide_data_columns()
+    Result is cached and built again only when new data are stored into database
+    '''
+    revision = data_revision(app.config['DATABASE_PATH'])
+    with _derived_lock:
+        if _derived_cache['revision'] != revision:
+            data_all = provide_data_columns()
+            with stage('build_derived_data'):
+                _derived_cache['data'] = build_derived_data(data_all)
+            _derived_cache['revision'] = revision
+        return _derived_cache['data']
+
+
+def build_derived_data(data_all):
+    '''
+    Prepare data for table, markers and graphs in a single pass over provide_data() (or provide_data_columns()) output
+    Return dictionary with:
+        - table = rows of summary table
+        - markers = markers and their cards
+        - series = times and values of temperature (temp) and altitude (alt) for graphs of the live feed
+    '''
+    data_table = []
+    data_markers = []
     data_temp_time = []
     data_temp = []
     data_alt_time = []
     data_alt = []
-    for row in data_all:
-        time, pressure, temp, alt, lat, lon, battery, lat_gw, lon_gw, alt_gw = row
-        # remove suffixes! and to float
+    for i, row in enumerate(data_all):
+        time, pressure, temp, alt, lat, lon, battery, lat_gw, lon_gw, alt_gw, timestamp = row
+        # graphs, remove suffixes! and to float
         if temp != 'missing':
-            temp = float(temp.split()[0])
             data_temp_time.append(time)
-            data_temp.append(temp)
+            data_temp.append(float(temp.split()[0]))
         if alt != 'missing':
-            alt = float(alt.split()[0])
             data_alt_time.append(time)
-            data_alt.append(alt)
-    return (data_temp_time, data_temp, data_alt_time, data_alt)
+            data_alt.append(float(alt.split()[0]))
+        # table, if there are missing data from GPS use data from gateways
+        if alt == 'missing':
+            alt = alt_gw
+        if lat == 'missing':
+            lat = lat_gw
+        if lon == 'missing':
+            lon = lon_gw
+        data_table.append([time, pressure, temp, alt, lat, lon, battery])
+        # markers, marker must be localizable
+        if lat != 'missing' and lon != 'missing':
+            card_body = f'temperature: {temp}, probe battery: {battery}, altitude: {alt}, longitude: {lon}, latitude: {lat}'
+            data_markers.append([i, time, card_body, lon, lat])
+    return {
+        'table': data_table,
+        'markers': data_markers,
+        'series': {
+            'temp': (data_temp_time, data_temp),
+            'alt': (data_alt_time, data_alt),
+        },
+    }
 
 
 def provide_data():
@@ -103,23 +449,31 @@ def provide_data():
         - Latitude from gateway
         - Longitude from gateway
         - Altitude (m) from gateway
+        - Timestamp
     If outside temperature seems to be invalid, use temperature of core.
     If altitude is None, calculate it from pressure.
     '''
-    data_raw = Database(app.config['DATABASE_PATH']).fetch_all_data()
+    with stage('fetch_all_data'):
+        data_raw = Database(app.config['DATABASE_PATH']).fetch_all_data()
+    with stage('provide_data'):
+        return format_data(data_raw)
+
+
+def format_data(data_raw):
+    '''Handle invalid values of rows of fetch_all_data() and format them, see provide_data()'''
     data = []
     for row in data_raw:
-        timestamp, pressure, temp, core_temp, alt, lat, lon, bat_mv, loop_time, lat_gw, lon_gw, alt_gw = row[:-3]
+        timestamp, pressure, temp, core_temp, alt, lat, lon, bat_mv, loop_time, lat_gw, lon_gw, alt_gw = row[:-2]
         # invalid / missing input handling
-        if alt == 'None' and pressure != 'None':    # missing altitude value, calculation from pressure
+        if alt is None and pressure is not None:    # missing altitude value, calculation from pressure
             alt = round((145366.45 * (1 - pow(pressure / 101325, 0.190284))) / 3.2808)
-        if temp != 'None' and core_temp != 'None':
+        if temp is not None and core_temp is not None:
             # use temperature of core for nonsense temperatures values
             if temp < -100 or temp > 50:
                 if core_temp > -100 and core_temp < 50:
                     temp = core_temp
                 else:    # cannot use temperature of core, discard value
-                    temp = 'None'
+                    temp = None
         # pretty formatting
         time = datetime.fromtimestamp(timestamp).strftime("%d.%m. %H:%M")
         pressure = pretty_format(pressure, digits=2, suffix='HPa', divisor=100)
@@ -131,93 +485,535 @@ def provide_data():
         lat_gw = pretty_format(lat_gw, digits=3)
         lon_gw = pretty_format(lon_gw, digits=3)
         alt_gw = pretty_format(alt_gw, digits=0, suffix='m')
-        data.append([time, pressure, temp, alt, lat, lon, battery, lat_gw, lon_gw, alt_gw])
+        data.append([time, pressure, temp, alt, lat, lon, battery, lat_gw, lon_gw, alt_gw, timestamp])
     return data
 
 
+def format_column(values, digits, suffix=None, divisor=None):
+    '''
+    Counterpart of pretty_format() for a whole column (NumPy array, NaN for missing values)
+    Division is done on the whole column, for digits=0 whole numbers are formatted as integers
+    '''
+    if divisor:
+        values = values / divisor
+    formatted = []
+    for value in values.tolist():
+        if value != value:      # NaN
+            formatted.append('missing')
+            continue
+        if digits == 0 and value.is_integer():
+            value = int(value)
+        value = round(value, digits)
+        formatted.append(f'{value} {suffix}' if suffix else value)
+    return formatted
+
+
+def provide_data_columns():
+    '''
+    Provide the same data as provide_data(), from values derived at insert (table telemetry_derived):
+        - altitude from pressure and temperature handling are already done (see telemetry.derive_row())
+        - whole table is loaded into a NumPy array (NaN for missing values), units are converted on whole columns
+        - only formatting is done for every value (see format_column())
+    provide_data() is kept as a reference implementation
+    '''
+    with stage('fetch_derived_data'):
+        data_derived = Database(app.config['DATABASE_PATH']).fetch_derived_data()
+    with stage('format_derived_rows'):
+        return format_derived_rows(data_derived)
+
+
+def format_derived_rows(data_derived):
+    '''Format rows of table telemetry_derived (see Database.fetch_derived_data()) as provide_data() does'''
+    if not data_derived:
+        return []
+    columns = np.array([row[1:] for row in data_derived], dtype=float)
+    pressure, temp, alt, lat, lon, bat_mv, lat_gw, lon_gw, alt_gw = columns.T
+    timestamps = [row[0] for row in data_derived]
+    time = [datetime.fromtimestamp(timestamp).strftime("%d.%m. %H:%M") for timestamp in timestamps]
+    return [list(row) for row in zip(
+        time,
+        format_column(pressure, digits=2, suffix='HPa', divisor=100),
+        format_column(temp, digits=1, suffix='°C'),
+        format_column(alt, digits=0, suffix='m'),
+        format_column(lat, digits=3),
+        format_column(lon, digits=3),
+        format_column(bat_mv, digits=3, suffix='V', divisor=1000),
+        format_column(lat_gw, digits=3),
+        format_column(lon_gw, digits=3),
+        format_column(alt_gw, digits=0, suffix='m'),
+        timestamps)]
+
+
+def code_version():
+    '''Return a short hash of the application code and templates, so responses cached by clients expire with a deploy'''
+    digest = hashlib.sha1()
+    directory = pathlib.Path(__file__).resolve().parent
+    for path in sorted([*directory.glob('*.py'), *directory.glob('templates/*')]):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:8]
+
+
+CODE_VERSION = code_version()
+
+
+def data_etag(revision):
+    '''
+    Weak ETag of responses which depend only on stored data, given by data_revision() the response was rendered for
+    Size and modification time of database files change with every write (also rebuilds, merges and redecoding)
+    and are the same for all workers, the version of the code changes with a deploy
+    '''
+    files = hashlib.sha1(repr(revision[2:]).encode()).hexdigest()[:16]
+    return f'{CODE_VERSION}-{files}'
+
+
+def revision_modified(revision):
+    '''Return time of the last modification of database files in data_revision(), for Last-Modified header'''
+    times = [mtime for mtime in revision[2::2] if mtime is not None]
+    return datetime.fromtimestamp(max(times) // 10**9, timezone.utc) if times else None
+
+
+def not_modified(etag):
+    '''
+    Return True if the client already has the current version of a response (If-None-Match)
+    If-Modified-Since is not used, its resolution of one second cannot tell apart writes within the same second
+    '''
+    return bool(request.if_none_match) and request.if_none_match.contains_weak(etag)
+
+
+def cached_response(name, render, mimetype, etag_suffix=''):
+    '''
+    Respond with a body which depends only on stored data:
+        - 304 (Not Modified) when the client already has it (ETag)
+        - body is rendered by render() (text or bytes) only once and kept (also gzip compressed) until new data are stored
+        - compressed body is sent to clients accepting gzip
+    Cache is keyed on data_revision() only, so small responses (e.g. rollups) do not need provide_derived_data()
+    '''
+    revision = data_revision(app.config['DATABASE_PATH'])
+    etag = data_etag(revision) + etag_suffix
+    if not_modified(etag):
+        response = Response(status=304)
+    else:
+        with _response_lock:
+            if _response_cache['revision'] != revision:
+                _response_cache['rendered'] = {}
+                _response_cache['revision'] = revision
+            rendered = _response_cache['rendered'].get(name)
+        if rendered is None:
+            body = render()
+            if isinstance(body, str):
+                body = body.encode()
+            rendered = (body, gzip.compress(body))
+            with _response_lock:
+                if _response_cache['revision'] == revision:
+                    if len(_response_cache['rendered']) >= 64:     # keep only a few responses
+                        _response_cache['rendered'].clear()
+                    _response_cache['rendered'][name] = rendered
+        body, compressed = rendered
+        response = Response(body, mimetype=mimetype)
+        if 'gzip' in request.accept_encodings:
+            response.set_data(compressed)
+            response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak=True)
+    response.last_modified = revision_modified(revision)
+    response.cache_control.no_cache = True      # always revalidate
+    return response
+
+
+@app.before_request
+def start_request():
+    '''Remember start of a request, start profiler if PROFILE_REQUESTS is enabled (streams excepted)'''
+    g.start = time.perf_counter()
+    g.profile = None
+    if (app.config['PROFILE_REQUESTS'] and request.endpoint not in UNPROFILED_ENDPOINTS
+            and _profile_lock.acquire(blocking=False)):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+
+@app.after_request
+def finish_request(response):
+    '''Measure duration of a request (until response is created, streamed body is not included)'''
+    if 'start' in g:
+        registry.observe('request_seconds', (('endpoint', request.endpoint or 'unknown'),
+                                             ('status', response.status_code)), time.perf_counter() - g.start)
+    return response
+
+
+@app.teardown_request
+def profile_request(exception=None):
+    '''Dump profile of the request to profiles/<endpoint>-<time>-<pid>.prof (open by pstats or snakeviz)'''
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    try:
+        profile.disable()
+        directory = f'''{app.config['DATABASE_PATH']}/profiles'''
+        os.makedirs(directory, exist_ok=True)
+        profile.dump_stats(f'{directory}/{request.endpoint or "unknown"}-{time.time_ns() // 1000000}-{os.getpid()}.prof')
+    finally:
+        _profile_lock.release()
+
+
+@app.errorhandler(sqlite3.OperationalError)
+def database_error(error):
+    '''
+    Database locked by other writers for too long is temporarily unavailable, the network server retries later
+    Lock errors are counted (sqlite_locked_total), those of stored uplinks are counted by store_uplinks() already
+    '''
+    if not is_locked(error):
+        raise error
+    if request.endpoint != 'endpoint':
+        registry.increment('sqlite_locked_total', (('stage', request.endpoint or 'unknown'),))
+    app.logger.warning(f'{request.path}: {error}')
+    return Response(status=503, headers={'Retry-After': '10'})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    '''
+    Counters and latency histograms of stages (auth, archive_write, prepare_data, store_data, fetch_all_data,
+    provide_data, render_template, ...) and requests of this process, in Prometheus text format
+    Credentials of endpoint are required (basic auth), else return 401 (Unauthorized)
+    '''
+    if not is_authorized():
+        return Response(status=401, headers={'WWW-Authenticate': 'Basic realm="metrics"'})
+    return Response(registry.render((('worker', os.getpid()),)), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/', methods=['GET'])
 def index():
     '''
     For index page provide data for:
         - a summary table
-        - markers and their cards
-        - graphs of development of temperature and altitude
-    '''
-    data_table = provide_data_table()[::-1]
-    data_markers = provide_data_markers()
-    data_temp_time, data_temp, data_alt_time, data_alt = provide_data_graph()
-    return render_template('index.html',
-                           data_markers=data_markers,
-                           data_table=data_table,
-                           data_temp_time=data_temp_time,
-                           data_temp=data_temp,
-                           data_alt_time=data_alt_time,
-                           data_alt=data_alt
-                           )
+        - route of the flight (markers are loaded by /api/markers for the visible part of map)
+        - graphs of development of temperature and altitude are loaded by the browser from /api/columns
+          (downsampled to GRAPH_POINTS), values are formatted there
+    Rendered page is kept until new data are stored, see cached_response()
+    '''
+    def render():
+        data_table = provide_data_table()[::-1]
+        data_route = provide_data_route()
+        with stage('render_template'):
+            return render_template('index.html',
+                                   data_route=data_route,
+                                   data_table=data_table,
+                                   graph_points=app.config['GRAPH_POINTS']
+                                   )
+    return cached_response('index', render, 'text/html')
+
+
+@app.route('/api/columns', methods=['GET'])
+def api_columns():
+    '''
+    Provide values as typed binary columns (see export.encode_columns()), formatted by the browser:
+        - fields = comma separated names of fields (see export.COLUMN_FIELDS), timestamp is always the first
+        - start, end = timestamps of a time range
+        - flight = id of a flight (see /api/flights), also an archived one
+        - points = downsample to at most points rows by LTTB of the first field after timestamp,
+          rows where it is missing are left out
+    Body is cached and gzip compressed like other data responses, see cached_response()
+    Return 400 (Bad Request) for unknown fields and 404 (Not Found) for unknown flight
+    '''
+    fields = request.args.get('fields', 'timestamp').split(',')
+    if any(field not in COLUMN_FIELDS for field in fields):
+        return Response(status=400)
+    fields = ['timestamp'] + [field for field in fields if field != 'timestamp']
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    points = request.args.get('points', type=int)
+    flight_id = request.args.get('flight', type=int)
+    database = provide_flight_database(flight_id) if flight_id is not None else Database(app.config['DATABASE_PATH'])
+    if database is None:
+        return Response(status=404)
+
+    def render():
+        with stage('fetch_columns'):
+            rows = list(database.iter_derived([COLUMN_FIELDS[field] for field in fields], start, end,
+                                              flight_id=flight_id))
+        values = np.array(rows, dtype=float).reshape(len(rows), len(fields))
+        if points and len(fields) > 1:
+            values = values[~np.isnan(values[:, 1])]
+            values = values[lttb(values[:, 0].tolist(), values[:, 1].tolist(), points)]
+        return encode_columns(fields, values)
+    key = f'{",".join(fields)}-{start}-{end}-{points}-{flight_id}'
+    return cached_response(f'columns-{key}', render, 'application/octet-stream', etag_suffix=f'-columns-{key}')
+
+
+@app.route('/api/markers', methods=['GET'])
+def api_markers():
+    '''
+    Provide clustered markers of the visible part of map, see provide_marker_clusters():
+        - bbox = west,south,east,north (degrees, whole world by default)
+        - zoom = map zoom level, clusters are smaller for higher zoom
+    Return 400 (Bad Request) for invalid bounding box
+    '''
+    try:
+        west, south, east, north = [float(value) for value in request.args.get('bbox', '-180,-90,180,90').split(',')]
+    except ValueError:
+        return Response(status=400)
+    west, east = max(west, -180.0), min(east, 180.0)
+    south, north = max(south, -90.0), min(north, 90.0)
+    if west > east or south > north:
+        return Response(status=400)
+    zoom = min(max(request.args.get('zoom', 0, type=int), 0), 20)
+    key = f'{west},{south},{east},{north}-{zoom}'
+
+    def render():
+        return json.dumps(provide_marker_clusters(west, south, east, north, zoom))
+    return cached_response(f'markers-{key}', render, 'application/json', etag_suffix=f'-{key}')
+
+
+@app.route('/api/markers/<int:data_id>', methods=['GET'])
+def api_marker_card(data_id):
+    '''Provide card of a marker (time and card body), 404 (Not Found) for unknown or not localizable row'''
+    card = provide_marker_card(data_id)
+    if card is None:
+        return Response(status=404)
+    return Response(json.dumps(card), mimetype='application/json')
+
+
+@app.route('/api/flights', methods=['GET'])
+def api_flights():
+    '''Provide all flights (the latest first) with identity of their device, time range and number of rows'''
+    def render():
+        keys = ['id', 'dev_id', 'hardware_serial', 'first_timestamp', 'last_timestamp', 'rows', 'archived']
+        flights = Database(app.config['DATABASE_PATH']).fetch_flights()
+        return json.dumps([dict(zip(keys, flight[:-1] + [bool(flight[-1])])) for flight in flights])
+    return cached_response('flights', render, 'application/json', etag_suffix='-flights')
+
+
+@app.route('/api/flights/<int:flight_id>/route', methods=['GET'])
+def api_flight_route(flight_id):
+    '''
+    Provide route of a flight (longitude, latitude of localizable rows, estimated track fills rows without GPS fix,
+    see ROUTE_COLUMNS), 404 (Not Found) for unknown flight
+    estimated=1 provides the estimated track only (see track.py), with standard deviation (m) of every point
+    '''
+    database = provide_flight_database(flight_id)
+    if database is None:
+        return Response(status=404)
+    if request.args.get('estimated', type=int):
+        rows = database.iter_derived(['est_lon', 'est_lat', 'est_error_m'], flight_id=flight_id)
+        route = [list(row) for row in rows if row[0] is not None]
+    else:
+        route = [list(row) for row in database.iter_derived(ROUTE_COLUMNS, flight_id=flight_id) if row[0] is not None]
+    return Response(json.dumps(route), mimetype='application/json')
+
+
+@app.route('/api/gateways', methods=['GET'])
+def api_gateways():
+    '''
+    Provide coverage of gateways (the most used first), aggregates are kept up to date at insert (see Database.store_gateways()):
+        - receptions, best and mean RSSI and SNR, first and last seen (timestamps)
+        - max_distance_m = maximal distance to the balloon (from GPS position)
+        - position of the gateway
+    '''
+    def render():
+        keys = ['gtw_id', 'receptions', 'best_rssi', 'mean_rssi', 'best_snr', 'mean_snr',
+                'first_seen', 'last_seen', 'max_distance_m', 'lat', 'lon', 'alt']
+        return json.dumps([dict(zip(keys, gateway)) for gateway in Database(app.config['DATABASE_PATH']).fetch_gateways()])
+    return cached_response('gateways', render, 'application/json', etag_suffix='-gateways')
+
+
+@app.route('/api/rollup', methods=['GET'])
+def api_rollup():
+    '''
+    Provide hourly or daily aggregates (min, max, mean of temperature, altitude, pressure, battery and RSSI)
+    for overview charts of long flights, see Database.update_rollups():
+        - start, end = timestamps of a time range, whole flight by default
+        - flight = id of a flight (see /api/flights), all hot data by default
+    Resolution is the finest one giving at most ROLLUP_MAX_BUCKETS buckets, so response does not grow with the flight
+    Return 404 (Not Found) for unknown flight
+    '''
+    flight_id = request.args.get('flight', type=int)
+    database = provide_flight_database(flight_id) if flight_id is not None else Database(app.config['DATABASE_PATH'])
+    if database is None:
+        return Response(status=404)
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    key = f'{start}-{end}-{flight_id}'
+
+    def render():
+        nonlocal start, end
+        if start is None or end is None:
+            span = database.fetch_rollup_range(flight_id) or (0, 0)
+            start = span[0] if start is None else start
+            end = span[1] if end is None else end
+        for resolution in ROLLUP_RESOLUTIONS:
+            if (end - start) / resolution <= app.config['ROLLUP_MAX_BUCKETS']:
+                break
+        buckets = []
+        for line in database.fetch_rollups(resolution, start // resolution * resolution, end, flight_id):
+            bucket = {'time': line[0], 'rows': line[1]}
+            for i, metric in enumerate(ROLLUP_METRICS):
+                bucket[metric] = dict(zip(['min', 'max', 'mean'], line[2 + 3 * i:5 + 3 * i]))
+            buckets.append(bucket)
+        return json.dumps({'resolution': resolution, 'buckets': buckets})
+    return cached_response(f'rollup-{key}', render, 'application/json', etag_suffix=f'-rollup-{key}')
+
+
+@app.route('/api/telemetry', methods=['GET'])
+def api_telemetry():
+    '''
+    Provide stored data newer than a cursor, paged by timestamp:
+        - since = timestamp of the last already known row (default 0, all data)
+        - limit = maximal number of returned rows (up to API_PAGE_LIMIT)
+        - flight = id of a flight (see /api/flights), only its rows are read
+    Return rows ordered by time (as dictionaries), cursor for next request and whether more data are waiting,
+    response is kept until new data are stored (see cached_response())
+    If parameters are invalid, return 400 (Bad Request)
+    '''
+    since = request.args.get('since', 0, type=float)
+    limit = request.args.get('limit', app.config['API_PAGE_LIMIT'], type=int)
+    if limit < 1:
+        return Response(status=400)
+    limit = min(limit, app.config['API_PAGE_LIMIT'])
+    flight_id = request.args.get('flight', type=int)
+    database = provide_flight_database(flight_id) if flight_id is not None else Database(app.config['DATABASE_PATH'])
+    if database is None:
+        return Response(status=404)
+
+    def render():
+        rows = database.fetch_data_since(since, limit, flight_id)
+        return json.dumps({
+            'data': [dict(zip(DATA_COLUMNS, row)) for row in rows],
+            'next': rows[-1][0] if rows else since,
+            'more': len(rows) == limit,
+        })
+    key = f'{since}-{limit}-{flight_id}'
+    return cached_response(f'telemetry-{key}', render, 'application/json', etag_suffix=f'-{key}')
+
+
+@app.route('/api/stream', methods=['GET'])
+def stream():
+    '''
+    Server-Sent Events feed of new rows (see provide_live_events()), id of an event is data_id of the row
+    Events missed since Last-Event-ID are sent first, a comment is sent every 15 s to keep connection open
+    Return 503 (Service Unavailable) when STREAM_MAX_CLIENTS are already connected to this process
+    '''
+    since = request.headers.get('Last-Event-ID', type=int)
+    broadcaster = provide_broadcaster()
+    subscriber = broadcaster.subscribe(since)
+    if subscriber is None:
+        return Response(status=503, headers={'Retry-After': '30'})
+
+    def events():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    data_id, event = subscriber.get(timeout=15)
+                except Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'id: {data_id}\ndata: {json.dumps(event)}\n\n'
+        finally:
+            broadcaster.unsubscribe(subscriber)
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/export/<fmt>', methods=['GET'])
+def export(fmt):
+    '''
+    Stream the flight as csv, geojson (track and points) or kml, rows are read from a cursor one by one:
+        - start, end = timestamps of a time range
+        - fields = comma separated names of exported fields (see export.EXPORT_FIELDS), all by default
+        - flight = id of a flight (see /api/flights), also an archived one
+    Position is taken from GPS, or from gateway if GPS data are missing
+    Return 404 (Not Found) for unknown format or flight and 400 (Bad Request) for unknown fields
+    '''
+    if fmt not in ('csv', 'geojson', 'kml'):
+        return Response(status=404)
+    fields = request.args.get('fields', ','.join(EXPORT_FIELDS)).split(',')
+    if any(field not in EXPORT_FIELDS for field in fields):
+        return Response(status=400)
+    fields = ['timestamp'] + [field for field in fields if field != 'timestamp']
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    flight_id = request.args.get('flight', type=int)
+    database = provide_flight_database(flight_id) if flight_id is not None else Database(app.config['DATABASE_PATH'])
+    if database is None:
+        return Response(status=404)
+    columns = [EXPORT_FIELDS[field] for field in fields]
+    if fmt == 'csv':
+        body = export_csv(database.iter_derived(columns, start, end, flight_id=flight_id), fields)
+        mimetype = 'text/csv'
+    else:
+        track = database.iter_derived(POSITION_COLUMNS, start, end, located=True, flight_id=flight_id)
+        points = database.iter_derived(POSITION_COLUMNS + columns, start, end, located=True, flight_id=flight_id)
+        if fmt == 'geojson':
+            body = export_geojson(track, points, fields)
+            mimetype = 'application/geo+json'
+        else:
+            body = export_kml(track, points, fields)
+            mimetype = 'application/vnd.google-earth.kml+xml'
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=flight.{fmt}'})
 
 
 @app.route('/endpoint', methods=['POST'])
 def endpoint():
     '''
-    Save incoming data to a text file (with timestamp as a name)
-    If data are dictionary, insert them into database, pass them as a default dictionary (+ add current timestamp)
-    If everything goes smooth, return response status 200 (OK), else return 403 (Forbidden)
+    Pass incoming data (with current timestamp) to the ingest queue, which appends them to the archive of raw uplinks
+    and inserts dictionaries into database in background (see store_uplinks())
+    Repeated deliveries of a recently accepted uplink (device and frame counter) which bring no new gateway
+    are acknowledged without any write
+    With INGEST_ASYNC disabled data are stored before response is sent
+    If everything goes smooth, return response status 200 (OK), 400 (Bad Request) for data which are not dictionary,
+    403 (Forbidden) for invalid authorization and 503 (Service Unavailable) when the ingest queue is full
+    or the database stays locked by other writers (see database_error())
     '''
-    with open('credentials.txt') as f:
-        user, password = f.read().strip().split(':')
-
-    auth = request.authorization
-    if not auth or auth.username != user or auth.password != password:
+    with stage('auth'):
+        authorized = is_authorized()
+    if not authorized:
+        registry.increment('uplinks_rejected_total', (('reason', 'unauthorized'),))
         return Response(status=403)
 
     # obtain data
     raw_data = request.get_json(force=True)
-    # save data externally
     timestamp = datetime.timestamp(datetime.now())
-    time = datetime.fromtimestamp(timestamp).strftime("%d.%m. %H:%M")
-    if os.path.exists(f"""{app.config["DATABASE_PATH"]}/cloud_data/""") is False:
-        os.mkdir(f"""{app.config["DATABASE_PATH"]}/cloud_data/""")
-    with open(f'''{app.config['DATABASE_PATH']}/cloud_data/{time}.txt''', 'w') as new_file:
-        print(raw_data, file=new_file)
-    # pass data to database (as default dictionary)
+    key = uplink_key(raw_data) if type(raw_data) == dict else None
+    if key is not None:
+        gateways = gateway_ids(raw_data)
+        if provide_recent_uplinks().seen(key, gateways, timestamp):
+            # repeated delivery, nothing new to store
+            registry.increment('uplinks_duplicate_total', (('stage', 'ingest'),))
+            return Response(status=200)
+    if app.config['INGEST_ASYNC']:
+        try:
+            provide_ingest_queue().submit((timestamp, raw_data))
+        except Full:
+            registry.increment('uplinks_rejected_total', (('reason', 'queue_full'),))
+            return Response(status=503, headers={'Retry-After': '10'})
+    else:
+        store_uplinks(app.config['DATABASE_PATH'], [(timestamp, raw_data)])
     if type(raw_data) == dict:
-        received_data = defaultdict(lambda: None)
-        received_data.update(raw_data)
-        received_data['timestamp'] = timestamp      # add current timestamp
-        Database(app.config['DATABASE_PATH']).prepare_data(received_data)
         # everything goes fine = return 200
-        status_code = Response(status=200)
-    else:
-        # wrong data format
-        status_code = Response(status=400)
-    return status_code
+        return Response(status=200)
+    # wrong data format
+    return Response(status=400)
 
 
 def upload_data():
-    import dateutil.parser
-    from collections import OrderedDict
-    global_dict = OrderedDict()
-    files = os.listdir(f"""{app.config["DATABASE_PATH"]}/cloud_data/""")
-    for one_file in files:
-        if one_file.startswith('.'):
-            continue
-        with open(f"""{app.config["DATABASE_PATH"]}/cloud_data/{one_file}""") as f:
-            string = f.read()
-            json = eval(string)
-            iso_8601 = json['metadata']['time']
-            datetime_object = dateutil.parser.isoparse(iso_8601)
-            timestamp = datetime_object.timestamp()
-            global_dict[timestamp] = json
-    sorted_dict = OrderedDict(sorted(global_dict.items()))
-    for timestamp, raw_data in sorted_dict.items():
-        received_data = defaultdict(lambda: None)
-        received_data.update(raw_data)
-        received_data['timestamp'] = timestamp      # add timestamp
-        Database(app.config['DATABASE_PATH']).prepare_data(received_data)
+    '''Import all uplinks archived in cloud_data/ to database, see backfill.import_archive()'''
+    from backfill import import_archive
+    return import_archive(app.config['DATABASE_PATH'])
 
 
 if __name__ == '__main__':
-    if count(sys.argv) == 2 and sys.argv[1] == '-u':
+    if len(sys.argv) == 2 and sys.argv[1] == '-u':
         upload_data()
+    if len(sys.argv) == 2 and sys.argv[1] == '-d':     # formulas of derived values were changed
+        Database(app.config['DATABASE_PATH']).rebuild_derived()
+    if len(sys.argv) == 2 and sys.argv[1] == '-p':     # layout of the packet was changed
+        from backfill import redecode_database
+        redecode_database(app.config['DATABASE_PATH'])
+    if len(sys.argv) == 2 and sys.argv[1] == '-r':     # hourly and daily aggregates are inconsistent
+        Database(app.config['DATABASE_PATH']).rebuild_rollups()
+    if len(sys.argv) == 2 and sys.argv[1] == '-a':     # move finished flights out of the hot tables
+        print('archived flights:', archive_flights())
 
     app.run(debug=False)
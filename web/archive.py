@@ -0,0 +1,162 @@
+import bisect
+import gzip
+import heapq
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+
+SEGMENT_PREFIX = 'uplink-'
+# preset dictionary of zlib compression of single uplinks (see encode_uplink()), keys and typical values of uplinks
+# of the network server, the most frequent ones at the end; stored uplinks depend on it, so it must never be changed
+UPLINK_DICTIONARY = json.dumps({
+    'app_id': 'picoballoon', 'dev_id': 'probe', 'hardware_serial': '00EF30A4C3C5F12F', 'port': 1, 'counter': 0,
+    'is_retry': True, 'confirmed': False,
+    'payload_fields': {'alt_m': 0, 'bat_mv': 0, 'core_temp_c': 0, 'lat': 0.0, 'lon': 0.0, 'loop_time_s': 0,
+                       'pressure_pa': 0, 'temp_c': 0.0},
+    'metadata': {'time': '2021-06-28T00:00:00.000000000Z', 'frequency': 868.1, 'modulation': 'LORA',
+                 'data_rate': 'SF12BW125', 'airtime': 1482752000, 'coding_rate': '4/5', 'gateways': [
+                     {'gtw_id': 'eui-b827ebfffe000000', 'timestamp': 0, 'time': '2021-06-28T00:00:00.000000Z',
+                      'channel': 0, 'rssi': -120, 'snr': -10.0, 'rf_chain': 0, 'latitude': 49.0, 'longitude': 16.0,
+                      'altitude': 0, 'location_source': 'registry'},
+                     {'gtw_id': 'eui-', 'gtw_trusted': True, 'timestamp': 0, 'time': '', 'channel': 0, 'rssi': -110,
+                      'snr': -5.0, 'rf_chain': 0, 'latitude': 49.0, 'longitude': 16.0, 'altitude': 0}],
+                 'latitude': 49.0, 'longitude': 16.0, 'altitude': 0},
+    'payload_raw': '', 'downlink_url': 'https://integrations.thethingsnetwork.org/ttn-eu/api/v2/down/'},
+    separators=(',', ':')).encode()
+
+
+class RawArchive:
+    '''
+    Append-only archive of received uplinks, stored as JSON lines in segments:
+        - uplink-<start time in ms>-<pid>.jsonl, every process appends to its own segment,
+          one line {"timestamp": ..., "data": ...} per uplink
+        - segment is closed when it is bigger than max_bytes or older than max_age (seconds),
+          closed segment is compressed by gzip (if compress)
+        - every segment has an index uplink-<start time in ms>-<pid>.idx with timestamp and offset
+          (in uncompressed segment) of every index_every-th uplink, so time ranges are read without
+          scanning whole segments
+    '''
+
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024, max_age=24 * 3600, compress=True, index_every=64):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.index_every = index_every
+        self.__lock = threading.Lock()
+        self.__segment = None
+        self.__index = None
+        self.__started = None
+        self.__count = 0
+        self.__size = 0
+
+    def __open_segment(self, timestamp):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f'{SEGMENT_PREFIX}{int(timestamp * 1000)}-{os.getpid()}'
+        self.__segment = open(os.path.join(self.directory, f'{name}.jsonl'), 'ab', buffering=0)
+        self.__index = open(os.path.join(self.directory, f'{name}.idx'), 'a', buffering=1)
+        self.__started = time.time()
+        self.__count = 0
+        self.__size = self.__segment.tell()
+
+    def __close_segment(self):
+        path = self.__segment.name
+        self.__segment.close()
+        self.__index.close()
+        self.__segment = None
+        if self.compress:
+            with open(path, 'rb') as source, gzip.open(f'{path}.gz', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(path)
+
+    def append(self, timestamp, raw_data):
+        '''Append one uplink (any JSON serializable data) received at timestamp, by a single write'''
+        line = json.dumps({'timestamp': timestamp, 'data': raw_data}, separators=(',', ':')).encode() + b'\n'
+        with self.__lock:
+            if self.__segment is not None:
+                if self.__size >= self.max_bytes or time.time() - self.__started >= self.max_age:
+                    self.__close_segment()
+            if self.__segment is None:
+                self.__open_segment(timestamp)
+            if self.__count % self.index_every == 0:
+                self.__index.write(f'{timestamp} {self.__size}\n')
+            self.__segment.write(line)
+            self.__count += 1
+            self.__size += len(line)
+
+    def close(self):
+        '''Close (and compress) the segment of this process'''
+        with self.__lock:
+            if self.__segment is not None:
+                self.__close_segment()
+
+    def segments(self):
+        '''List paths of all segments (of all processes) ordered by their start time'''
+        if not os.path.exists(self.directory):
+            return []
+        names = [name for name in os.listdir(self.directory)
+                 if name.startswith(SEGMENT_PREFIX) and name.endswith(('.jsonl', '.jsonl.gz'))]
+        names.sort(key=lambda name: int(name[len(SEGMENT_PREFIX):].split('-')[0]))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def read(self, since=None, until=None):
+        '''
+        Yield (timestamp, data) of archived uplinks received from since (included) until (excluded),
+        ordered by timestamp, segments of all processes are merged
+        '''
+        readers = []
+        for path in self.segments():
+            started = int(os.path.basename(path)[len(SEGMENT_PREFIX):].split('-')[0]) / 1000
+            if until is not None and started >= until:
+                continue
+            readers.append(record for record in read_segment(path, since, until) if record[0] is not None)
+        return heapq.merge(*readers, key=lambda record: record[0])
+
+
+def read_segment(path, since=None, until=None):
+    '''
+    Yield (timestamp, data) of one segment, from since (included) until (excluded)
+    Index of the segment is used to skip uplinks older than since
+    Lines which cannot be parsed are yielded as (None, line)
+    '''
+    offset = 0
+    if since is not None:
+        index_path = f'{path[:path.index(".jsonl")]}.idx'
+        try:
+            with open(index_path) as f:
+                index = [line.split() for line in f if line.strip()]
+            position = bisect.bisect_right([float(timestamp) for timestamp, _ in index], since) - 1
+            if position >= 0:
+                offset = int(index[position][1])
+        except (OSError, ValueError, IndexError):
+            offset = 0
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            try:
+                record = json.loads(line)
+                timestamp = record['timestamp']
+            except (ValueError, KeyError, TypeError):
+                yield None, line
+                continue
+            if since is not None and timestamp < since:
+                continue
+            if until is not None and timestamp >= until:
+                break
+            yield timestamp, record['data']
+
+
+def encode_uplink(raw_data):
+    '''Compress a single uplink as JSON by zlib with UPLINK_DICTIONARY (small uplinks compress well only with it)'''
+    compressor = zlib.compressobj(9, zdict=UPLINK_DICTIONARY)
+    return compressor.compress(json.dumps(raw_data, separators=(',', ':'), default=str).encode()) + compressor.flush()
+
+
+def decode_uplink(blob):
+    '''Decompress an uplink encoded by encode_uplink()'''
+    decompressor = zlib.decompressobj(zdict=UPLINK_DICTIONARY)
+    return json.loads(decompressor.decompress(blob) + decompressor.flush())
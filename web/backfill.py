@@ -0,0 +1,171 @@
+import ast
+import json
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from db import Database
+from archive import RawArchive, read_segment
+from payload import decode_payloads
+
+ISO_8601 = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$')
+# repr of defaultdict stored into database by older versions
+DEFAULTDICT_REPR = re.compile(r'defaultdict\(<function .*? at 0x[0-9a-fA-F]+>, (.*)\)$', re.S)
+
+
+def parse_iso_time(value):
+    '''
+    Convert time from network server metadata (ISO 8601, up to nanoseconds, Z suffix) to a timestamp
+    Time without a timezone is treated as UTC
+    '''
+    match = ISO_8601.match(value)
+    if not match:
+        raise ValueError(f'Invalid time {value}')
+    base, fraction, zone = match.groups()
+    parsed = datetime.strptime(base, '%Y-%m-%dT%H:%M:%S')
+    if fraction:
+        parsed = parsed.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+    offset = timedelta(0)
+    if zone and zone != 'Z':
+        sign = -1 if zone[0] == '-' else 1
+        offset = sign * timedelta(hours=int(zone[1:3]), minutes=int(zone[4:6]))
+    return parsed.replace(tzinfo=timezone(offset)).timestamp()
+
+
+def parse_raw(string):
+    '''
+    Parse archived uplink, either JSON or a python literal (written by older versions), nothing is evaluated
+    Raise ValueError or SyntaxError when string cannot be parsed
+    '''
+    try:
+        return json.loads(string)
+    except ValueError:
+        string = string.strip()
+        match = DEFAULTDICT_REPR.match(string)
+        return ast.literal_eval(match.group(1) if match else string)
+
+
+def prepare_uplink(timestamp, raw_data):
+    '''Parse one uplink for storing, return parsed data and raw data'''
+    received_data = defaultdict(lambda: None)
+    received_data.update(raw_data)
+    received_data['timestamp'] = timestamp
+    return Database.parse_data(received_data), raw_data
+
+
+def parse_file(path):
+    '''
+    Read and parse one archive file, runs in a worker process:
+        - segment of RawArchive (.jsonl or .jsonl.gz), timestamp of reception is used
+        - text file with one uplink (older versions), timestamp from metadata is used
+    Return list of parsed uplinks (parsed data and raw data) and number of uplinks which cannot be used,
+    an uplink which cannot be parsed is only counted, other uplinks of the file are kept
+    '''
+    uplinks = []
+    failed = 0
+
+    def prepare(timestamp, raw_data):
+        nonlocal failed
+        try:
+            uplinks.append(prepare_uplink(timestamp, raw_data))
+        except Exception:       # any malformed value of a single uplink
+            failed += 1
+    if os.path.basename(path).endswith(('.jsonl', '.jsonl.gz')):
+        for timestamp, raw_data in read_segment(path):
+            if timestamp is None or type(raw_data) != dict:
+                failed += 1
+            else:
+                prepare(timestamp, raw_data)
+        return uplinks, failed
+    try:
+        with open(path) as f:
+            raw_data = parse_raw(f.read())
+        timestamp = parse_iso_time(raw_data['metadata']['time'])
+    except (OSError, ValueError, SyntaxError, KeyError, TypeError):
+        return uplinks, 1
+    if type(raw_data) != dict:
+        return uplinks, 1
+    prepare(timestamp, raw_data)
+    return uplinks, failed
+
+
+def archive_files(directory):
+    '''List files of an archive directory (cloud_data/): segments of RawArchive and text files of older versions'''
+    files = RawArchive(directory).segments()
+    if os.path.exists(directory):
+        files += [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.txt')]
+    return files
+
+
+def import_archive(path, workers=None, batch_size=500, log=sys.stderr):
+    '''
+    Import all uplinks archived in cloud_data/ (segments of RawArchive and text files of older versions)
+    to the database:
+        - files are parsed in a pool of worker processes, uplinks which cannot be parsed are counted as failed
+        - rows are stored in order of time (flights and the estimated track follow it) in batches
+          within a single transaction
+        - uplinks already present in database (same timestamp) and duplicate deliveries are skipped,
+          so import can be repeated
+        - progress and throughput are written to log (None to keep quiet)
+    Return dictionary with number of files, imported, skipped and failed uplinks and duration (s)
+    '''
+    files = archive_files(f'{path}/cloud_data')
+    database = Database(path)
+    known = database.fetch_timestamps()
+    stats = {'files': len(files), 'imported': 0, 'skipped': 0, 'failed': 0}
+    start = time.perf_counter()
+
+    def report(done):
+        if log:
+            duration = time.perf_counter() - start
+            uplinks = stats['imported'] + stats['skipped'] + stats['failed']
+            print(f'{done}/{stats["files"]} files, {stats["imported"]} uplinks imported, {uplinks / duration:.0f} uplinks/s', file=log)
+
+    pending = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for done, (uplinks, failed) in enumerate(pool.map(parse_file, files, chunksize=16), start=1):
+            stats['failed'] += failed
+            for data, raw_data in uplinks:
+                if data['timestamp'] in known:
+                    stats['skipped'] += 1
+                    continue
+                known.add(data['timestamp'])
+                pending.append((data, raw_data))
+            if done % 100 == 0:
+                report(done)
+    pending.sort(key=lambda uplink: uplink[0]['timestamp'])
+    for i in range(0, len(pending), batch_size):
+        batch = pending[i:i + batch_size]
+        imported = database.store_many(batch)
+        stats['imported'] += imported
+        stats['skipped'] += len(batch) - imported
+    database.commit()
+    report(len(files))
+    stats['duration'] = time.perf_counter() - start
+    return stats
+
+
+def redecode_database(path):
+    '''
+    Decode payload_raw of all stored uplinks again (e.g. when layout or scaling of the packet is changed),
+    all payloads are decoded in one vectorized pass (see payload.decode_payloads()) and derived values are rebuilt
+    Values of 0 are treated as missing, rows without a valid payload_raw are kept
+    Return number of updated rows
+    '''
+    database = Database(path)
+    ids = []
+    payloads = []
+    for data_id, raw_data in database.fetch_raw_data():
+        if type(raw_data) == dict and raw_data.get('payload_raw'):
+            ids.append(data_id)
+            payloads.append(raw_data['payload_raw'])
+    rows = []
+    for data_id, (valid, *values) in zip(ids, decode_payloads(payloads).tolist()):
+        if valid:
+            rows.append([value if value != 0 else None for value in values] + [data_id])
+    database.update_payload_values(rows)
+    database.rebuild_derived()
+    return len(rows)
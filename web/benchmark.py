@@ -0,0 +1,185 @@
+'''
+Benchmarks of ingest, backfill and page render on synthetic flights (see synthetic.py)
+
+    python benchmark.py [--sizes 1000,10000,100000] [--output results.json] [--compare old.json]
+
+Every benchmark runs in its own temporary directory (database, archive, credentials), results are written
+as JSON (one item per benchmark and size), --compare prints ratios against results of another version
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from datetime import datetime, timezone
+
+import app as application
+from archive import RawArchive
+from backfill import import_archive, prepare_uplink
+from db import Database, close_connections
+from synthetic import generate_flight
+
+CREDENTIALS = ('bench', 'bench')
+
+
+def timed(function, repeat=1):
+    '''Call function repeat times, return the shortest duration (s) and result of the last call'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+
+class Workspace:
+    '''Temporary directory used as working directory and DATABASE_PATH of the application'''
+
+    def __enter__(self):
+        self.directory = tempfile.TemporaryDirectory(prefix='benchmark-')
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        with open('credentials.txt', 'w') as f:
+            f.write(':'.join(CREDENTIALS))
+        self.config = dict(application.app.config)
+        application.app.config['DATABASE_PATH'] = self.directory.name
+        return self.directory.name
+
+    def __exit__(self, *exc):
+        application.close_ingest_queues()
+        application.close_archives()
+        close_connections()
+        application.app.config.update(self.config)
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+
+def fill_database(path, uplinks):
+    '''Store uplinks directly (in one transaction), without archive and HTTP'''
+    database = Database(path)
+    database.store_many([prepare_uplink(timestamp, raw_data) for timestamp, raw_data in uplinks])
+    database.commit()
+
+
+def bench_ingest(size, asynchronous):
+    '''Uplinks per second accepted by /endpoint, asynchronous ingest is measured until all uplinks are stored'''
+    uplinks = generate_flight(size)
+    with Workspace() as path:
+        application.app.config['INGEST_ASYNC'] = asynchronous
+        client = application.app.test_client()
+        headers = {'Authorization': 'Basic ' + b64encode(':'.join(CREDENTIALS).encode()).decode()}
+
+        def ingest():
+            for _, raw_data in uplinks:
+                client.post('/endpoint', headers=headers, json=raw_data)
+            if asynchronous:
+                application.provide_ingest_queue().flush()
+        duration, _ = timed(ingest)
+        assert len(Database(path).fetch_timestamps()) == size
+    return {'seconds': duration, 'rate': size / duration}
+
+
+def bench_backfill(size):
+    '''Uplinks per second imported from archive segments by backfill.import_archive() (upload_data())'''
+    uplinks = generate_flight(size)
+    with Workspace() as path:
+        archive = RawArchive(f'{path}/cloud_data', max_bytes=4 * 1024 * 1024)
+        for timestamp, raw_data in uplinks:
+            archive.append(timestamp, raw_data)
+        archive.close()
+        duration, stats = timed(lambda: import_archive(path, log=None))
+        assert stats['imported'] == size
+    return {'seconds': duration, 'rate': size / duration}
+
+
+def bench_render(size, repeat):
+    '''
+    Latency (s) of provide_data() (reference implementation), provide_derived_data() after new data were stored,
+    index() rendered from scratch and index() served from cache
+    '''
+    uplinks = generate_flight(size)
+    with Workspace() as path:
+        fill_database(path, uplinks)
+        client = application.app.test_client()
+
+        def rebuild():
+            application._derived_cache['revision'] = None
+            return application.provide_derived_data()
+
+        def render_index():
+            rebuild()
+            application._response_cache['revision'] = None
+            return client.get('/')
+        results = {
+            'provide_data': timed(application.provide_data, repeat)[0],
+            'provide_derived_data': timed(rebuild, repeat)[0],
+            'index_cold': timed(render_index, repeat)[0],
+            'index_warm': timed(lambda: client.get('/'), repeat)[0],
+        }
+    return {name: {'seconds': seconds} for name, seconds in results.items()}
+
+
+def run(sizes, ingest_size, repeat):
+    '''Run all benchmarks, return list of results (name, rows and measured values)'''
+    results = []
+    for asynchronous in (False, True):
+        name = 'ingest_async' if asynchronous else 'ingest_sync'
+        results.append({'name': name, 'rows': ingest_size, **bench_ingest(ingest_size, asynchronous)})
+    for size in sizes:
+        results.append({'name': 'backfill', 'rows': size, **bench_backfill(size)})
+        for name, values in bench_render(size, repeat).items():
+            results.append({'name': name, 'rows': size, **values})
+    return results
+
+
+def environment():
+    '''Version of the code and machine the results were measured on'''
+    try:
+        version = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        version = None
+    return {
+        'version': version,
+        'time': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results, previous):
+    '''Print duration of every benchmark relative to previous results (above 1 = slower now)'''
+    old = {(item['name'], item['rows']): item['seconds'] for item in previous['results']}
+    for item in results:
+        key = (item['name'], item['rows'])
+        if key in old:
+            print(f'{item["name"]:>22} {item["rows"]:>7} rows: {item["seconds"] / old[key]:.2f}x')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of ingest, backfill and page render')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated numbers of rows')
+    parser.add_argument('--ingest', type=int, default=2000, help='number of uplinks posted to /endpoint')
+    parser.add_argument('--repeat', type=int, default=3, help='latency is the best of repeated runs')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='results of another version (JSON written by --output)')
+    args = parser.parse_args(argv)
+    results = run([int(size) for size in args.sizes.split(',')], args.ingest, args.repeat)
+    for item in results:
+        rate = f', {item["rate"]:.0f} rows/s' if 'rate' in item else ''
+        print(f'{item["name"]:>22} {item["rows"]:>7} rows: {item["seconds"] * 1000:.1f} ms{rate}')
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,257 @@
 import sqlite3
 import os
+import json
+import itertools
+import threading
+import weakref
+import numpy as np
 from collections import defaultdict
+from telemetry import DERIVED_COLUMNS, derive_row, derive_columns
+from payload import FIELDS, decode_payload
+from spatial import distance_m
+from archive import encode_uplink, decode_uplink
+import track
+
+# number of rows stored by this process, used to invalidate cached views of the data
+_store_counter = itertools.count(1)
+_store_revision = 0
+
+# columns of table data, in the order of the table (databases of older versions have unused column json after them)
+DATA_COLUMNS = [
+    'timestamp', 'pressure_pa', 'temp_c', 'core_temp_c', 'alt_m', 'lat', 'lon', 'bat_mv',
+    'loop_time_s', 'lat_gw', 'lon_gw', 'alt_gw', 'freq', 'rssi'
+    ]
+# identity of the probe (kept as received) and columns of table data which partition rows by device and flight
+IDENTITY_KEYS = ['dev_id', 'hardware_serial', 'app_id', 'counter']
+FLIGHT_COLUMNS = ['device_id', 'flight_id', 'counter']
+# a new flight starts when frame counter of the device is reset, or after a gap (seconds) without any row
+FLIGHT_GAP = 7 * 24 * 3600
+# frame counter was reset (probe was relaunched) when it drops to at most this value and by more than this value,
+# smaller drops are frames delivered out of order
+RELAUNCH_COUNTER = 16
+# deliveries of the same frame counter within this time (seconds) are duplicates (retries of the network server)
+DUPLICATE_WINDOW = 3600
+# values decoded from the payload, the same for all deliveries of an uplink (unlike values from gateways)
+PAYLOAD_COLUMNS = ['pressure_pa', 'temp_c', 'core_temp_c', 'alt_m', 'lat', 'lon', 'bat_mv', 'loop_time_s']
+# stored row with the same device, flight and frame counter (uses unique index data_device_counter)
+SELECT_DUPLICATE = f'''
+    SELECT rowid, timestamp, {", ".join(PAYLOAD_COLUMNS)} FROM data WHERE device_id = ? AND flight_id = ? AND counter = ?'''
+SELECT_DATA_SINCE = f'SELECT {", ".join(DATA_COLUMNS)} FROM data WHERE timestamp > ?'
+# condition of rows of a flight, uses index on device, flight and timestamp
+WHERE_DATA_FLIGHT = ' AND device_id = (SELECT device_id FROM flights WHERE flight_id = ?) AND flight_id = ?'
+INSERT_DATA = f'''
+    INSERT INTO data ({", ".join(DATA_COLUMNS + FLIGHT_COLUMNS)})
+    VALUES ({", ".join("?" * (len(DATA_COLUMNS) + len(FLIGHT_COLUMNS)))})'''
+# raw uplink of a row, compressed by archive.encode_uplink()
+INSERT_RAW_UPLINK = 'INSERT OR REPLACE INTO raw_uplinks (data_id, uplink) VALUES (?, ?)'
+# estimated position of the balloon and its standard deviation (see track.py), stored with derived values
+TRACK_COLUMNS = ['est_lat', 'est_lon', 'est_error_m']
+# longitude and latitude of a row on the route of the flight: GPS fix, estimated track when the fix is missing,
+# position from gateway only when there is no estimate
+ROUTE_COLUMNS = [f'''
+    CASE WHEN lat IS NOT NULL AND lon IS NOT NULL THEN {column}
+    WHEN est_lat IS NOT NULL AND est_lon IS NOT NULL THEN est_{column} ELSE pos_{column} END''' for column in ('lon', 'lat')]
+INSERT_DERIVED = f'''
+    INSERT OR REPLACE INTO telemetry_derived (data_id, {", ".join(DERIVED_COLUMNS + ['flight_id'] + TRACK_COLUMNS)})
+    VALUES ({", ".join("?" * (len(DERIVED_COLUMNS) + len(TRACK_COLUMNS) + 2))})'''
+# state of the track estimate of a flight after its latest row (see track.step())
+TRACK_STATE_COLUMNS = ['timestamp', 'lat', 'lon', 'vel_n', 'vel_e', 'p_pos', 'p_cross', 'p_vel']
+SELECT_TRACK_STATE = f'SELECT {", ".join(TRACK_STATE_COLUMNS)} FROM track_state WHERE flight_id = ?'
+UPSERT_TRACK_STATE = f'''
+    INSERT OR REPLACE INTO track_state (flight_id, {", ".join(TRACK_STATE_COLUMNS)})
+    VALUES ({", ".join("?" * (len(TRACK_STATE_COLUMNS) + 1))})'''
+# every reception of an uplink by a gateway, values in order of Database.parse_gateways()
+GATEWAY_COLUMNS = ['gtw_id', 'rssi', 'snr', 'channel', 'lat', 'lon', 'alt', 'distance_m']
+INSERT_RECEPTION = f'''
+    INSERT INTO gateway_reception (data_id, {", ".join(GATEWAY_COLUMNS)})
+    VALUES ({", ".join("?" * (len(GATEWAY_COLUMNS) + 1))})'''
+# aggregates of a gateway updated by every reception, NULL values do not replace known ones
+UPSERT_GATEWAY_STATS = '''
+    INSERT INTO gateway_stats VALUES (?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (gtw_id) DO UPDATE SET
+        receptions = receptions + 1,
+        best_rssi = MAX(COALESCE(best_rssi, excluded.best_rssi), COALESCE(excluded.best_rssi, best_rssi)),
+        rssi_sum = rssi_sum + excluded.rssi_sum,
+        rssi_count = rssi_count + excluded.rssi_count,
+        best_snr = MAX(COALESCE(best_snr, excluded.best_snr), COALESCE(excluded.best_snr, best_snr)),
+        snr_sum = snr_sum + excluded.snr_sum,
+        snr_count = snr_count + excluded.snr_count,
+        first_seen = MIN(first_seen, excluded.first_seen),
+        last_seen = MAX(last_seen, excluded.last_seen),
+        max_distance_m = MAX(COALESCE(max_distance_m, excluded.max_distance_m),
+                             COALESCE(excluded.max_distance_m, max_distance_m)),
+        lat = COALESCE(excluded.lat, lat),
+        lon = COALESCE(excluded.lon, lon),
+        alt = COALESCE(excluded.alt, alt)'''
+# values of rows are aggregated (min, max, sum and count) per hour and per day, for every flight
+ROLLUP_RESOLUTIONS = [3600, 86400]
+# aggregated values, rssi is read from table data, the others from telemetry_derived
+ROLLUP_METRICS = ['temp_c', 'alt_m', 'pressure_pa', 'bat_mv', 'rssi']
+ROLLUP_COLUMNS = [f'{metric}_{aggregate}' for metric in ROLLUP_METRICS for aggregate in ('min', 'max', 'sum', 'count')]
+UPSERT_ROLLUP = f'''
+    INSERT INTO rollups (resolution, bucket, flight_id, row_count, {", ".join(ROLLUP_COLUMNS)})
+    VALUES ({", ".join("?" * (len(ROLLUP_COLUMNS) + 4))})
+    ON CONFLICT (resolution, bucket, flight_id) DO UPDATE SET
+        row_count = row_count + excluded.row_count, ''' + ', '.join(
+    f'{column} = {function}(COALESCE({column}, excluded.{column}), COALESCE(excluded.{column}, {column}))'
+    if function else f'{column} = {column} + excluded.{column}'
+    for column, function in zip(ROLLUP_COLUMNS, ['MIN', 'MAX', None, None] * len(ROLLUP_METRICS)))
+SELECT_DERIVED = '''
+    SELECT timestamp, pressure_pa, temp_c, alt_m, lat, lon, bat_mv, lat_gw, lon_gw, alt_gw
+    FROM telemetry_derived WHERE timestamp > ?'''
+
+
+def parse_identity(data):
+    '''
+    Extract identity of the probe (IDENTITY_KEYS) from received data, values are sanitized like other fields:
+    frame counter is an integer (also from a numeric string), ids are strings, anything else is None
+    '''
+    identity = {}
+    for key in IDENTITY_KEYS:
+        value = data.get(key)
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            value = None
+        elif key == 'counter':
+            try:
+                value = int(value)
+            except (ValueError, OverflowError):
+                value = None
+        else:
+            value = str(value)
+        identity[key] = value
+    return identity
+
+
+def uplink_key(data):
+    '''
+    Key of an uplink (received data) which is the same for all its deliveries: device, frame counter and payload
+    (a relaunched probe reuses frame counters, but not with the same payload),
+    None if frame counter is missing (such uplinks are never treated as duplicates)
+    '''
+    identity = parse_identity(data)
+    if identity['counter'] is None:
+        return None
+    payload = data.get('payload_raw') or json.dumps(data.get('payload_fields'), sort_keys=True, default=str)
+    if not isinstance(payload, str):
+        payload = repr(payload)
+    return identity['dev_id'] or '', identity['hardware_serial'] or '', identity['counter'], payload
+
+
+def is_locked(error):
+    '''True for an error of a statement which waited for a lock of another connection longer than its timeout'''
+    return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+
+
+def data_revision(path):
+    '''
+    Return a cheap token which changes whenever new data are stored into the database
+    Combines rows stored by this process with size and modification time of database files,
+    so rows stored by other processes (e.g. other gunicorn workers) are noticed as well
+    Database itself is not touched
+    '''
+    revision = [path, _store_revision]
+    for suffix in ('', '-wal'):
+        try:
+            stat = os.stat(f'{path}/database.sqlite{suffix}')
+            revision += [stat.st_mtime_ns, stat.st_size]
+        except FileNotFoundError:
+            revision += [None, None]
+    return tuple(revision)
+
+
+def close_all(connections):
+    '''Close connections (dictionary of path and connection) of a thread which has ended'''
+    for connection in connections.values():
+        connection.close()
+
+
+class ThreadConnections:
+    '''
+    Connections of a single thread (by path of database), held only by thread-local data of the thread,
+    so they are closed when the thread ends (e.g. a thread of a development server started for every request)
+    '''
+
+    def __init__(self):
+        self.connections = {}
+        weakref.finalize(self, close_all, self.connections)
+
+
+class ConnectionPool:
+    '''
+    Keeps sqlite3 connections open for the whole life of a thread (gunicorn worker threads live as long as the process)
+        - every thread gets its own connection per database, reused by all later requests of the thread,
+          so sqlite3 statement cache survives between requests
+        - connections of a thread are closed when the thread ends, nothing is kept for threads which are gone
+        - database structure is created only once per process and database
+        - forked process (new worker) drops connections inherited from its parent
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__threads = weakref.WeakSet()
+        self.__prepared = set()
+        self.__generation = 0
+        self.__pid = os.getpid()
+
+    def __check_process(self):
+        if self.__pid != os.getpid():
+            with self.__lock:
+                self.__threads = weakref.WeakSet()
+                self.__prepared = set()
+                self.__generation += 1
+                self.__pid = os.getpid()
+
+    def connect(self, path):
+        '''Return connection to a database owned by the current thread, open it if needed'''
+        self.__check_process()
+        local = self.__local
+        if getattr(local, 'generation', None) != self.__generation:
+            local.generation = self.__generation
+            local.thread = ThreadConnections()
+            with self.__lock:
+                self.__threads.add(local.thread)
+        connection = local.thread.connections.get(path)
+        if connection is None:
+            connection = sqlite3.connect(f'{path}/database.sqlite', check_same_thread=False, cached_statements=256)
+            connection.execute('pragma journal_mode=wal')
+            local.thread.connections[path] = connection
+        return connection
+
+    def setup(self, path, create_structure):
+        '''Call create_structure only for the first connection to a database in this process'''
+        if path in self.__prepared:
+            return
+        with self.__lock:
+            if path not in self.__prepared:
+                create_structure()
+                self.__prepared.add(path)
+
+    def close(self):
+        '''Close all connections of all threads, e.g. before a database file is removed'''
+        with self.__lock:
+            for thread in list(self.__threads):
+                close_all(thread.connections)
+                thread.connections.clear()
+            self.__threads = weakref.WeakSet()
+            self.__prepared = set()
+            self.__generation += 1
+
+
+_pool = ConnectionPool()
+
+
+def close_connections():
+    '''Close all pooled connections of this process'''
+    _pool.close()
+
 
 class Database:
 
     def __init__(self, path):
-        self.__connection = sqlite3.connect(f'{path}/database.sqlite')
-        self.__connection.execute('pragma journal_mode=wal')
+        self.__connection = _pool.connect(path)
         self.__cursor = self.__connection.cursor()
-        self.create_database_structure()
+        _pool.setup(path, self.create_database_structure)
 
     def create_database_structure(self):
         self.__cursor.execute('''
@@ -27,9 +270,186 @@ class Database:
                 alt_gw INTEGER,
                 freq REAL,
                 rssi INTEGER,
-                json TEXT)''')
+                device_id INTEGER,
+                flight_id INTEGER,
+                counter INTEGER)''')
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS data_timestamp ON data (timestamp)')
+        # raw uplinks as received (see archive.encode_uplink()), linked by rowid of data, decoded only when asked for
+        self.__cursor.execute('CREATE TABLE IF NOT EXISTS raw_uplinks (data_id INTEGER PRIMARY KEY, uplink BLOB)')
+        # probes (identified by dev_id and hardware_serial, empty when unknown) and their flights
+        self.__cursor.execute('''
+            CREATE TABLE IF NOT EXISTS devices (
+                device_id INTEGER PRIMARY KEY,
+                dev_id TEXT,
+                hardware_serial TEXT,
+                app_id TEXT,
+                UNIQUE (dev_id, hardware_serial))''')
+        self.__cursor.execute('''
+            CREATE TABLE IF NOT EXISTS flights (
+                flight_id INTEGER PRIMARY KEY,
+                device_id INTEGER,
+                first_timestamp REAL,
+                last_timestamp REAL,
+                last_counter INTEGER,
+                row_count INTEGER,
+                archived INTEGER DEFAULT 0)''')
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS flights_device ON flights (device_id, last_timestamp)')
+        # every reception of an uplink by a gateway (linked by rowid of data) and aggregates of every gateway
+        self.__cursor.execute('''
+            CREATE TABLE IF NOT EXISTS gateway_reception (
+                data_id INTEGER,
+                gtw_id TEXT,
+                rssi INTEGER,
+                snr REAL,
+                channel INTEGER,
+                lat REAL,
+                lon REAL,
+                alt INTEGER,
+                distance_m REAL)''')
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS gateway_reception_data ON gateway_reception (data_id)')
+        self.__cursor.execute('''
+            CREATE TABLE IF NOT EXISTS gateway_stats (
+                gtw_id TEXT PRIMARY KEY,
+                receptions INTEGER,
+                best_rssi INTEGER,
+                rssi_sum REAL,
+                rssi_count INTEGER,
+                best_snr REAL,
+                snr_sum REAL,
+                snr_count INTEGER,
+                first_seen REAL,
+                last_seen REAL,
+                max_distance_m REAL,
+                lat REAL,
+                lon REAL,
+                alt INTEGER)''')
+        # aggregates of rows per flight and hour / day (see update_rollups()), bucket is timestamp of its start
+        self.__cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS rollups (
+                resolution INTEGER,
+                bucket INTEGER,
+                flight_id INTEGER,
+                row_count INTEGER,
+                {", ".join(f"{column} REAL" for column in ROLLUP_COLUMNS)},
+                PRIMARY KEY (resolution, bucket, flight_id))''')
+        # state of the track estimate of every flight (see update_track())
+        self.__cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS track_state (
+                flight_id INTEGER PRIMARY KEY,
+                {", ".join(f"{column} REAL" for column in TRACK_STATE_COLUMNS)})''')
+        # values derived from table data at insert (see telemetry.derive_row()), linked by rowid of data
+        self.__cursor.execute('''
+            CREATE TABLE IF NOT EXISTS telemetry_derived (
+                data_id INTEGER PRIMARY KEY,
+                timestamp REAL,
+                pressure_pa INTEGER,
+                temp_c REAL,
+                alt_m INTEGER,
+                lat REAL,
+                lon REAL,
+                bat_mv INTEGER,
+                lat_gw REAL,
+                lon_gw REAL,
+                alt_gw INTEGER,
+                pos_lat REAL,
+                pos_lon REAL,
+                pos_alt_m INTEGER,
+                geohash TEXT,
+                flight_id INTEGER,
+                est_lat REAL,
+                est_lon REAL,
+                est_error_m REAL)''')
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS telemetry_derived_timestamp ON telemetry_derived (timestamp)')
+        self.migrate_database_structure()
+        # indexes of columns added by migrations
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS telemetry_derived_geohash ON telemetry_derived (geohash)')
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS telemetry_derived_flight ON telemetry_derived (flight_id, timestamp)')
+        self.__cursor.execute('CREATE INDEX IF NOT EXISTS data_flight ON data (device_id, flight_id, timestamp)')
+        self.__cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS data_device_counter ON data (device_id, flight_id, counter)
+            WHERE counter IS NOT NULL''')
 
-    def identify_strongest_gw(self, metadata):
+    def migrate_database_structure(self):
+        '''
+        Bring an existing database up to the current format, each step is done only once
+        (database version is kept in pragma user_version):
+            1 - values were stored as strings, missing values as text 'None', replace them with NULL
+            2 - derived values were not stored, compute them for all rows
+            3 - geohash of position was not stored, add it to derived values
+            4 - rows were not assigned to devices and flights, assign them by identity stored in raw uplinks
+            5 - receptions of gateways were not stored, read them from raw uplinks (see rebuild_gateways())
+            6 - duplicate deliveries of uplinks were stored, merge them (see merge_stored_duplicates())
+            7 - hourly and daily aggregates were not stored, compute them (see rebuild_rollups())
+            8 - estimated track was not stored, compute it (see rebuild_track())
+            9 - raw uplinks were stored as text in column json of table data, move them into table raw_uplinks
+                (see move_raw_uplinks())
+        Columns added since the first version are added and raw uplinks are moved before any step, so every step
+        works with the current tables; steps 3 and 4 both need derived values computed again, so they are done together
+        '''
+        version = self.__cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version < 9:
+            for table, column, column_type in [
+                    ('telemetry_derived', 'geohash', 'TEXT'), ('telemetry_derived', 'flight_id', 'INTEGER'),
+                    ('telemetry_derived', 'est_lat', 'REAL'), ('telemetry_derived', 'est_lon', 'REAL'),
+                    ('telemetry_derived', 'est_error_m', 'REAL'),
+                    ('data', 'device_id', 'INTEGER'), ('data', 'flight_id', 'INTEGER'), ('data', 'counter', 'INTEGER')]:
+                columns = [line[1] for line in self.__cursor.execute(f'PRAGMA table_info({table})')]
+                if column not in columns:
+                    self.__cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+            if 'json' in [line[1] for line in self.__cursor.execute('PRAGMA table_info(data)')]:
+                self.move_raw_uplinks()
+        if version < 1:
+            with self.__connection:
+                for column in DATA_COLUMNS:
+                    self.__cursor.execute(f"UPDATE data SET {column} = NULL WHERE {column} = 'None'")
+                self.__cursor.execute('PRAGMA user_version = 1')
+        if version < 4:
+            self.assign_stored_flights()
+            self.rebuild_derived()
+            self.__cursor.execute('PRAGMA user_version = 4')
+            self.__connection.commit()
+        if version < 5:
+            self.rebuild_gateways()
+            self.__cursor.execute('PRAGMA user_version = 5')
+            self.__connection.commit()
+        if version < 6:
+            self.merge_stored_duplicates()
+            self.__cursor.execute('PRAGMA user_version = 6')
+            self.__connection.commit()
+        if version < 7:
+            self.rebuild_rollups()
+            self.__cursor.execute('PRAGMA user_version = 7')
+            self.__connection.commit()
+        if version < 8:
+            self.rebuild_track()
+            self.__cursor.execute('PRAGMA user_version = 8')
+            self.__connection.commit()
+        if version < 9:
+            self.__cursor.execute('PRAGMA user_version = 9')
+            self.__connection.commit()
+
+    def move_raw_uplinks(self):
+        '''
+        Move raw uplinks stored by older versions as text (JSON or python literal) in column json of table data
+        into table raw_uplinks, column json is emptied and the database is vacuumed to give the space back
+        Text which cannot be parsed is kept as a JSON string
+        '''
+        from backfill import parse_raw
+        rows = self.__cursor.execute('SELECT rowid, json FROM data WHERE json IS NOT NULL').fetchall()
+        if not rows:
+            return
+        with self.__connection:
+            for data_id, text in rows:
+                try:
+                    raw_data = parse_raw(text)
+                except (ValueError, SyntaxError, TypeError):
+                    raw_data = text
+                self.__cursor.execute(INSERT_RAW_UPLINK, (data_id, encode_uplink(raw_data)))
+            self.__cursor.execute('UPDATE data SET json = NULL')
+        self.__cursor.execute('VACUUM')
+
+    @staticmethod
+    def identify_strongest_gw(metadata):
         '''
         Determine strongest RSSI from an array of gateways,
         return strongest gateway latitude, longitude, altitude and rssi
@@ -48,7 +468,9 @@ class Database:
                 lon_gw = gw_defdic['longitude']
                 alt_gw = gw_defdic['altitude']
             elif gw_defdic['latitude'] and gw_defdic['longitude']:
-                if gw_defdic['rssi'] > rssi:
+                # rssi which is not a number (missing, string) is never the strongest
+                numbers = (int, float)
+                if isinstance(gw_defdic['rssi'], numbers) and (not isinstance(rssi, numbers) or gw_defdic['rssi'] > rssi):
                     rssi = gw_defdic['rssi']
                     lat_gw = gw_defdic['latitude']
                     lon_gw = gw_defdic['longitude']
@@ -56,6 +478,14 @@ class Database:
         return lat_gw, lon_gw, alt_gw, rssi
 
     def prepare_data(self, data):
+        self.store_data(self.parse_data(data), data)
+
+    @staticmethod
+    def parse_data(data):
+        '''
+        Extract all useful values from received data (default dictionary) to a dictionary of table columns
+        Does not touch the database, so it can run in another process (see backfill.py)
+        '''
         data_for_storing = {}
         keys = [
             'timestamp', 'pressure_pa', 'temp_c', 'core_temp_c', 'alt_m', 'bat_mv', 'lat',
@@ -67,9 +497,12 @@ class Database:
         # timestamp
         data_for_storing['timestamp'] = data['timestamp']
 
-        # data from GPS
-        if data['payload_fields']:
-            gps_data = data['payload_fields'].items()
+        # data from the probe, decoded from payload_raw (see payload.py) or by decoder of the network server
+        payload_fields = decode_payload(data['payload_raw']) if data['payload_raw'] else None
+        if payload_fields is None:
+            payload_fields = data['payload_fields']
+        if payload_fields:
+            gps_data = payload_fields.items()
             for key, value in gps_data:
                 data_for_storing[key] = value
         # lat, lon & alt from gateways
@@ -78,8 +511,7 @@ class Database:
             metadata = defaultdict(lambda: None)
             metadata.update(data['metadata'])
             if metadata['gateways']:
-                if self.identify_strongest_gw(metadata):
-                    lat_gw, lon_gw, alt_gw, rssi = self.identify_strongest_gw(metadata)
+                lat_gw, lon_gw, alt_gw, rssi = Database.identify_strongest_gw(metadata)
             if metadata['latitude'] and metadata['longitude']:
                 lat_gw = metadata['latitude']
                 lon_gw = metadata['longitude']
@@ -104,33 +536,590 @@ class Database:
         for key, value in data_for_storing.items():
             if value == 0 or type(value) == str:
                 data_for_storing[key] = None
-        self.store_data(data_for_storing, data)
+        # identity of the probe, used to assign the row to a device and flight (see assign_flight())
+        data_for_storing.update(parse_identity(data))
+        # all receptions by gateways, stored into table gateway_reception
+        data_for_storing['gateways'] = Database.parse_gateways(data['metadata'], data_for_storing)
+        return data_for_storing
 
-    def store_data(self, data, json):
-        self.__cursor.execute(f'''
-            INSERT INTO data VALUES (
-            "{data['timestamp']}",
-            "{data['pressure_pa']}",
-            "{data['temp_c']}",
-            "{data['core_temp_c']}",
-            "{data['alt_m']}",
-            "{data['lat']}",
-            "{data['lon']}",
-            "{data['bat_mv']}",
-            "{data['loop_time_s']}",
-            "{data['lat_gw']}",
-            "{data['lon_gw']}",
-            "{data['alt_gw']}",
-            "{data['freq']}",
-            "{data['rssi']}",
-            "{json}")''')
+    @staticmethod
+    def parse_gateways(metadata, data):
+        '''
+        Extract receptions of an uplink by all gateways from metadata, list of values of GATEWAY_COLUMNS
+        Distance is measured to the position of the balloon from GPS (None if it is missing),
+        zero position of a gateway and strings instead of numbers are treated as missing
+        '''
+        def number(value):
+            return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+        gateways = []
+        for gateway in (metadata or {}).get('gateways') or []:
+            if not isinstance(gateway, dict):
+                continue
+            lat, lon = number(gateway.get('latitude')) or None, number(gateway.get('longitude')) or None
+            gateways.append([
+                gateway.get('gtw_id'), number(gateway.get('rssi')), number(gateway.get('snr')), gateway.get('channel'),
+                lat, lon, number(gateway.get('altitude')) or None, distance_m(data['lat'], data['lon'], lat, lon)])
+        return gateways
+
+    def assign_flight(self, data):
+        '''
+        Find (or create) device and flight of a parsed row, set device_id and flight_id of data
+        A row belongs to the latest flight of the device which it is not more than FLIGHT_GAP away from,
+        a new flight is started when there is no such flight or when frame counter was reset (dropped far back
+        to a small value, see RELAUNCH_COUNTER) or reused (later than DUPLICATE_WINDOW or with another payload)
+        Must be called in a transaction which stores the row (the first statement is a write, so flights of
+        the device cannot be changed by another process meanwhile)
+        Return rowid of an already stored delivery of the uplink (the same device, flight, frame counter and payload),
+        the flight is not changed then, else None
+        '''
+        identity = (data.get('dev_id') or '', data.get('hardware_serial') or '')
+        self.__cursor.execute('INSERT OR IGNORE INTO devices (dev_id, hardware_serial, app_id) VALUES (?, ?, ?)',
+                              identity + (data.get('app_id'),))
+        device_id = self.__cursor.execute('SELECT device_id FROM devices WHERE dev_id = ? AND hardware_serial = ?',
+                                          identity).fetchone()[0]
+        timestamp = data['timestamp']
+        counter = data.get('counter')
+        flight = self.__cursor.execute('''
+            SELECT flight_id, last_timestamp, last_counter FROM flights
+            WHERE device_id = ? AND first_timestamp <= ? AND last_timestamp >= ? AND archived = 0
+            ORDER BY last_timestamp DESC LIMIT 1''', (device_id, timestamp + FLIGHT_GAP, timestamp - FLIGHT_GAP)).fetchone()
+        if flight is not None:
+            flight_id, last_timestamp, last_counter = flight
+            duplicate = self.__cursor.execute(SELECT_DUPLICATE, (device_id, flight_id, counter)).fetchone()
+            if (duplicate is not None and abs(timestamp - duplicate[1]) <= DUPLICATE_WINDOW
+                    and list(duplicate[2:]) == [data[key] for key in PAYLOAD_COLUMNS]):
+                data['device_id'] = device_id
+                data['flight_id'] = flight_id
+                return duplicate[0]
+            if duplicate is not None:
+                flight = None       # counter was reused (later or with another payload), probe was launched again
+            elif (timestamp >= last_timestamp and counter is not None and last_counter is not None
+                    and counter <= RELAUNCH_COUNTER < last_counter - counter):
+                flight = None       # counter was reset, probe was launched again
+        if flight is None:
+            self.__cursor.execute('''
+                INSERT INTO flights (device_id, first_timestamp, last_timestamp, last_counter, row_count)
+                VALUES (?, ?, ?, ?, 1)''', (device_id, timestamp, timestamp, counter))
+            flight_id = self.__cursor.lastrowid
+        else:
+            self.__cursor.execute('''
+                UPDATE flights SET first_timestamp = MIN(first_timestamp, ?), last_timestamp = MAX(last_timestamp, ?),
+                    last_counter = CASE WHEN ? >= last_timestamp THEN ? ELSE last_counter END, row_count = row_count + 1
+                WHERE flight_id = ?''', (timestamp, timestamp, timestamp, counter, flight_id))
+        data['device_id'] = device_id
+        data['flight_id'] = flight_id
+        return None
+
+    def assign_stored_flights(self):
+        '''Assign all stored rows to devices and flights, identity of the probe is read from raw uplinks'''
+        rows = self.__cursor.execute(f'''
+            SELECT data.rowid, timestamp, uplink, {", ".join(PAYLOAD_COLUMNS)}
+            FROM data LEFT JOIN raw_uplinks ON data_id = data.rowid
+            ORDER BY timestamp''').fetchall()
+        with self.__connection:
+            self.__cursor.execute('DELETE FROM flights')
+            for rowid, timestamp, uplink, *payload in rows:
+                raw_data = decode_uplink(uplink) if uplink else None
+                data = parse_identity(raw_data) if isinstance(raw_data, dict) else {}
+                data['timestamp'] = timestamp
+                data.update(zip(PAYLOAD_COLUMNS, payload))
+                self.assign_flight(data)
+                self.__cursor.execute('UPDATE data SET device_id = ?, flight_id = ?, counter = ? WHERE rowid = ?',
+                                      (data['device_id'], data['flight_id'], data.get('counter'), rowid))
+
+    def store_data(self, data, raw_data):
+        duplicate = self.assign_flight(data)
+        if duplicate is not None:
+            self.merge_gateways([(duplicate, data)])
+            self.commit()
+            return
+        self.__cursor.execute(INSERT_DATA, self.__data_values(data))
+        data_id = self.__cursor.lastrowid
+        self.__cursor.execute(INSERT_RAW_UPLINK, (data_id, encode_uplink(raw_data)))
+        derived = derive_row(data)
+        estimates, late = self.update_track([data])
+        self.__cursor.execute(INSERT_DERIVED, [data_id] + derived + [data['flight_id']] + estimates[0])
+        self.store_gateways([(data_id, data)])
+        if late:
+            self.rebuild_track(late)
+        self.update_rollups([(data, derived)])
+        self.commit()
+
+    @staticmethod
+    def __data_values(data):
+        return [data[key] for key in DATA_COLUMNS] + [data['device_id'], data['flight_id'], data.get('counter')]
+
+    def store_many(self, rows):
+        '''
+        Insert many rows (pairs of parsed data and raw data) with their derived values, raw uplinks and receptions
+        Duplicate deliveries of an uplink (see uplink_key()) are not inserted, their receptions of gateways
+        are merged into the stored uplink (see merge_gateways())
+        Rows are not committed, so a series of calls can share one transaction, call commit() afterwards
+        Return number of inserted rows
+        '''
+        unique = {}
+        new_rows = []
+        duplicates = []
+        for data, raw_data in rows:
+            key = uplink_key(raw_data)
+            if key in unique:       # delivered twice within the batch
+                known = {gateway[0] for gateway in unique[key]['gateways']}
+                unique[key]['gateways'] += [gateway for gateway in data['gateways'] if gateway[0] not in known]
+                continue
+            if key is not None:
+                unique[key] = data
+            duplicate = self.assign_flight(data)
+            if duplicate is None:
+                new_rows.append((data, raw_data))
+            else:
+                duplicates.append((duplicate, data))
+        self.merge_gateways(duplicates)
+        rows = new_rows
+        if not rows:
+            return 0
+        # rowid of every row is taken from its own insert, rowids of a batch need not be consecutive
+        data_ids = []
+        for data, _ in rows:
+            self.__cursor.execute(INSERT_DATA, self.__data_values(data))
+            data_ids.append(self.__cursor.lastrowid)
+        self.__cursor.executemany(INSERT_RAW_UPLINK, (
+            (data_id, encode_uplink(raw_data)) for data_id, (_, raw_data) in zip(data_ids, rows)))
+        derived = [derive_row(data) for data, _ in rows]
+        estimates, late = self.update_track([data for data, _ in rows])
+        self.__cursor.executemany(INSERT_DERIVED, (
+            [data_id] + values + [data['flight_id']] + estimate
+            for data_id, (data, _), values, estimate in zip(data_ids, rows, derived, estimates)))
+        self.store_gateways(list(zip(data_ids, (data for data, _ in rows))))
+        if late:
+            self.rebuild_track(late)
+        self.update_rollups([(data, values) for (data, _), values in zip(rows, derived)])
+        return len(rows)
+
+    def update_track(self, rows):
+        '''
+        Advance track estimates of flights by inserted rows (parsed data, in order of insert), see track.step()
+        State of every touched flight is read and written only once
+        Return estimated position of every row [lat, lon, standard deviation in m], None values when unknown,
+        and set of flights with a row older than their state, their track must be rebuilt once rows are stored
+        (see rebuild_track()), estimate would not be the same as with rows in order of time
+        '''
+        states = {}
+        for flight_id in {data['flight_id'] for data in rows}:
+            line = self.__cursor.execute(SELECT_TRACK_STATE, (flight_id,)).fetchone()
+            states[flight_id] = list(line) if line else None
+        estimates = []
+        late = set()
+        for data in rows:
+            state = states[data['flight_id']]
+            if state is not None and data['flight_id'] is not None and data['timestamp'] < state[0]:
+                late.add(data['flight_id'])
+            gps = (data['lat'], data['lon']) if data['lat'] is not None and data['lon'] is not None else None
+            states[data['flight_id']], estimate = track.step(states[data['flight_id']], data['timestamp'], gps,
+                                                             data['gateways'])
+            estimates.append(list(estimate) if estimate else [None] * len(TRACK_COLUMNS))
+        self.__cursor.executemany(UPSERT_TRACK_STATE, (
+            [flight_id] + state for flight_id, state in states.items() if state is not None))
+        return estimates, late
+
+    def rebuild_track(self, flight_ids=None):
+        '''
+        Compute track estimates of all stored rows again (or rows of given flights), rows of every flight in order
+        of time, GPS position is read from table data and receptions of gateways from table gateway_reception
+        All flights are rebuilt in their own transaction, given flights within the current one (see store_many())
+        '''
+        where, parameters = '', []
+        if flight_ids is not None:
+            where, parameters = f'WHERE flight_id IN ({", ".join("?" * len(flight_ids))})', list(flight_ids)
+        receptions = defaultdict(list)
+        for line in self.__cursor.execute(f'''
+                SELECT data_id, {", ".join(GATEWAY_COLUMNS)} FROM gateway_reception
+                WHERE data_id IN (SELECT rowid FROM data {where})''', parameters):
+            receptions[line[0]].append(line[1:])
+        rows = self.__cursor.execute(
+            f'SELECT rowid, flight_id, timestamp, lat, lon FROM data {where} ORDER BY flight_id, timestamp, rowid',
+            parameters).fetchall()
+        states = {}
+        estimates = []
+        for rowid, flight_id, timestamp, lat, lon in rows:
+            gps = (lat, lon) if lat is not None and lon is not None else None
+            states[flight_id], estimate = track.step(states.get(flight_id), timestamp, gps, receptions[rowid])
+            estimates.append((list(estimate) if estimate else [None] * len(TRACK_COLUMNS)) + [rowid])
+        if flight_ids is None:
+            with self.__connection:
+                self.__store_track(where, parameters, estimates, states)
+        else:
+            self.__store_track(where, parameters, estimates, states)
+
+    def __store_track(self, where, parameters, estimates, states):
+        self.__cursor.execute(f'DELETE FROM track_state {where}', parameters)
+        self.__cursor.executemany(
+            f'UPDATE telemetry_derived SET {", ".join(f"{column} = ?" for column in TRACK_COLUMNS)} WHERE data_id = ?',
+            estimates)
+        self.__cursor.executemany(UPSERT_TRACK_STATE, (
+            [flight_id] + state for flight_id, state in states.items() if flight_id is not None and state is not None))
+
+    def update_rollups(self, rows):
+        '''
+        Add inserted rows (pairs of parsed data and derived values) to hourly and daily aggregates,
+        rows are aggregated in memory first, so every touched bucket is upserted only once
+        '''
+        positions = [DERIVED_COLUMNS.index(metric) if metric in DERIVED_COLUMNS else None for metric in ROLLUP_METRICS]
+        buckets = {}
+        for data, derived in rows:
+            values = [derived[i] if i is not None else data[metric] for metric, i in zip(ROLLUP_METRICS, positions)]
+            for resolution in ROLLUP_RESOLUTIONS:
+                key = (resolution, int(data['timestamp'] // resolution) * resolution, data['flight_id'])
+                if key not in buckets:
+                    buckets[key] = [0] + [None, None, 0, 0] * len(ROLLUP_METRICS)
+                bucket = buckets[key]
+                bucket[0] += 1
+                for i, value in enumerate(values):
+                    if value is None:
+                        continue
+                    j = 1 + 4 * i
+                    bucket[j] = value if bucket[j] is None else min(bucket[j], value)
+                    bucket[j + 1] = value if bucket[j + 1] is None else max(bucket[j + 1], value)
+                    bucket[j + 2] += value
+                    bucket[j + 3] += 1
+        self.__cursor.executemany(UPSERT_ROLLUP, (list(key) + bucket for key, bucket in buckets.items()))
+
+    def rebuild_rollups(self):
+        '''Compute hourly and daily aggregates of all stored rows again (by SQL, nothing is loaded into Python)'''
+        sources = {metric: 'data.rssi' if metric not in DERIVED_COLUMNS else f'derived.{metric}' for metric in ROLLUP_METRICS}
+        aggregates = ', '.join(f'MIN({sources[metric]}), MAX({sources[metric]}), TOTAL({sources[metric]}), COUNT({sources[metric]})'
+                               for metric in ROLLUP_METRICS)
+        with self.__connection:
+            self.__cursor.execute('DELETE FROM rollups')
+            for resolution in ROLLUP_RESOLUTIONS:
+                self.__cursor.execute(f'''
+                    INSERT INTO rollups
+                    SELECT {resolution}, CAST(derived.timestamp / {resolution} AS INTEGER) * {resolution}, derived.flight_id,
+                        COUNT(*), {aggregates}
+                    FROM telemetry_derived AS derived JOIN data ON data.rowid = derived.data_id
+                    GROUP BY 2, 3''')
+        global _store_revision
+        _store_revision = next(_store_counter)
+
+    def fetch_rollups(self, resolution, start, end, flight_id=None):
+        '''
+        Fetch aggregates of buckets of resolution starting within a time range (both included), ordered by time,
+        buckets of all flights are merged unless flight_id is given
+        Return list of bucket, number of rows and min, max, mean of every metric of ROLLUP_METRICS
+        Only buckets are read (primary key range), so time does not depend on number of rows
+        '''
+        aggregates = ', '.join(f'MIN({metric}_min), MAX({metric}_max), SUM({metric}_sum) / NULLIF(SUM({metric}_count), 0)'
+                               for metric in ROLLUP_METRICS)
+        query = f'SELECT bucket, SUM(row_count), {aggregates} FROM rollups WHERE resolution = ? AND bucket BETWEEN ? AND ?'
+        parameters = [resolution, start, end]
+        if flight_id is not None:
+            query += ' AND flight_id = ?'
+            parameters.append(flight_id)
+        data = self.__cursor.execute(query + ' GROUP BY bucket ORDER BY bucket', parameters).fetchall()
         self.__connection.commit()
+        return [list(line) for line in data]
+
+    def fetch_rollup_range(self, flight_id=None):
+        '''Fetch start of the first and the last daily bucket (of a flight), None if there are no data'''
+        query = 'SELECT MIN(bucket), MAX(bucket) FROM rollups WHERE resolution = ?'
+        parameters = [ROLLUP_RESOLUTIONS[-1]]
+        if flight_id is not None:
+            query += ' AND flight_id = ?'
+            parameters.append(flight_id)
+        first, last = self.__cursor.execute(query, parameters).fetchone()
+        self.__connection.commit()
+        return (first, last + ROLLUP_RESOLUTIONS[-1] - 1) if first is not None else None
+
+    def merge_gateways(self, duplicates):
+        '''
+        Store receptions of duplicate deliveries (pairs of rowid of the stored uplink and parsed data)
+        by gateways which are not known for the stored uplink yet, nothing is written when there are none
+        '''
+        for data_id, data in duplicates:
+            known = {line[0] for line in self.__cursor.execute(
+                'SELECT gtw_id FROM gateway_reception WHERE data_id = ?', (data_id,))}
+            gateways = [gateway for gateway in data.get('gateways') or [] if gateway[0] not in known]
+            if gateways:
+                self.store_gateways([(data_id, dict(data, gateways=gateways))])
+
+    def merge_stored_duplicates(self):
+        '''
+        Remove stored duplicate deliveries of uplinks (the same device, flight and frame counter), the first one is kept
+        and receptions by other gateways are moved to it, aggregates of gateways are computed again
+        '''
+        kept = {}
+        duplicates = []
+        for rowid, key in ((line[0], tuple(line[1:])) for line in self.__cursor.execute(
+                'SELECT rowid, device_id, flight_id, counter FROM data WHERE counter IS NOT NULL ORDER BY rowid')):
+            if key in kept:
+                duplicates.append((kept[key], rowid, key[1]))
+            else:
+                kept[key] = rowid
+        if not duplicates:
+            return
+        with self.__connection:
+            for kept_id, rowid, flight_id in duplicates:
+                self.__cursor.execute('''
+                    UPDATE gateway_reception SET data_id = ? WHERE data_id = ? AND gtw_id NOT IN (
+                        SELECT gtw_id FROM gateway_reception WHERE data_id = ? AND gtw_id IS NOT NULL)''',
+                                      (kept_id, rowid, kept_id))
+                self.__cursor.execute('DELETE FROM gateway_reception WHERE data_id = ?', (rowid,))
+                self.__cursor.execute('DELETE FROM telemetry_derived WHERE data_id = ?', (rowid,))
+                self.__cursor.execute('DELETE FROM raw_uplinks WHERE data_id = ?', (rowid,))
+                self.__cursor.execute('DELETE FROM data WHERE rowid = ?', (rowid,))
+                self.__cursor.execute('UPDATE flights SET row_count = row_count - 1 WHERE flight_id = ?', (flight_id,))
+            self.__cursor.execute('DELETE FROM gateway_stats')
+            self.__cursor.execute('''
+                INSERT INTO gateway_stats
+                SELECT r.gtw_id, COUNT(*), MAX(r.rssi), TOTAL(r.rssi), COUNT(r.rssi), MAX(r.snr), TOTAL(r.snr),
+                    COUNT(r.snr), MIN(data.timestamp), MAX(data.timestamp), MAX(r.distance_m), MAX(r.lat), MAX(r.lon),
+                    MAX(r.alt)
+                FROM gateway_reception AS r JOIN data ON data.rowid = r.data_id
+                WHERE r.gtw_id IS NOT NULL GROUP BY r.gtw_id''')
+
+    def store_gateways(self, rows):
+        '''
+        Insert receptions of gateways (see parse_gateways()) of stored rows (pairs of data_id and parsed data)
+        and update aggregates of the gateways (table gateway_stats) by upsert, nothing is scanned
+        '''
+        receptions = [(data_id, data['timestamp'], gateway) for data_id, data in rows for gateway in data.get('gateways') or []]
+        self.__cursor.executemany(INSERT_RECEPTION, ([data_id] + gateway for data_id, _, gateway in receptions))
+        self.__cursor.executemany(UPSERT_GATEWAY_STATS, (
+            [gtw_id, rssi, rssi or 0, int(rssi is not None), snr, snr or 0, int(snr is not None),
+             timestamp, timestamp, distance, lat, lon, alt]
+            for _, timestamp, (gtw_id, rssi, snr, _, lat, lon, alt, distance) in receptions if gtw_id is not None))
+
+    def rebuild_gateways(self):
+        '''Store receptions of gateways of all stored rows again (read from raw uplinks) and compute aggregates again'''
+        rows = []
+        for data_id, timestamp, lat, lon, uplink in self.__cursor.execute('''
+                SELECT data.rowid, timestamp, lat, lon, uplink FROM data LEFT JOIN raw_uplinks ON data_id = data.rowid
+                ORDER BY timestamp''').fetchall():
+            raw_data = decode_uplink(uplink) if uplink else None
+            if isinstance(raw_data, dict) and isinstance(raw_data.get('metadata'), dict):
+                data = {'timestamp': timestamp, 'lat': lat, 'lon': lon}
+                data['gateways'] = self.parse_gateways(raw_data['metadata'], data)
+                rows.append((data_id, data))
+        with self.__connection:
+            self.__cursor.execute('DELETE FROM gateway_reception')
+            self.__cursor.execute('DELETE FROM gateway_stats')
+            self.store_gateways(rows)
+
+    def commit(self):
+        self.__connection.commit()
+        global _store_revision
+        _store_revision = next(_store_counter)
+
+    def rollback(self):
+        '''Discard rows stored since the last commit (e.g. after a failed batch), connection can be reused'''
+        self.__connection.rollback()
+
+    def fetch_timestamps(self):
+        '''Fetch a set of timestamps of all stored rows'''
+        data = self.__cursor.execute('SELECT timestamp FROM data').fetchall()
+        self.__connection.commit()
+        return {line[0] for line in data}
 
     def fetch_all_data(self):
-        data = self.__cursor.execute('SELECT * FROM data;').fetchall()
+        '''Fetch values of DATA_COLUMNS of all rows ordered by timestamp, raw uplinks are not read (see fetch_raw_data())'''
+        data = self.__cursor.execute(f'SELECT {", ".join(DATA_COLUMNS)} FROM data ORDER BY timestamp;').fetchall()
         self.__connection.commit()
         data_ls = []
         for line in data:
             data_ls.append(list(line))
         return data_ls
 
+    def fetch_derived_data(self, since=None, flight_id=None):
+        '''
+        Fetch derived values of all rows (or rows stored after timestamp since, rows of a flight)
+        ordered by timestamp, position columns excluded
+        '''
+        query, parameters = SELECT_DERIVED, [since if since is not None else float('-inf')]
+        if flight_id is not None:
+            query += ' AND flight_id = ?'
+            parameters.append(flight_id)
+        data = self.__cursor.execute(query + ' ORDER BY timestamp', parameters).fetchall()
+        self.__connection.commit()
+        return [list(line) for line in data]
+
+    def fetch_derived_after(self, data_id):
+        '''
+        Fetch derived values of rows stored after row data_id as triples of data_id, position on the route
+        (see ROUTE_COLUMNS, None if unknown) and a row of fetch_derived_data(),
+        ordered by data_id (rowid grows in order of commits, also of rows received by concurrent workers)
+        '''
+        data = self.__cursor.execute(
+            SELECT_DERIVED.replace('SELECT ', f'SELECT data_id, {", ".join(ROUTE_COLUMNS)}, ', 1)
+            .replace('timestamp > ?', 'data_id > ?') + ' ORDER BY data_id', [data_id]).fetchall()
+        self.__connection.commit()
+        return [(line[0], list(line[1:3]) if line[1] is not None else None, list(line[3:])) for line in data]
+
+    def fetch_latest_data_id(self):
+        '''Fetch data_id of the latest stored row, None if there are no data'''
+        data_id = self.__cursor.execute('SELECT MAX(data_id) FROM telemetry_derived').fetchone()[0]
+        self.__connection.commit()
+        return data_id
+
+    def rebuild_derived(self):
+        '''
+        Compute derived values of all stored rows again (e.g. when formulas are changed),
+        whole columns are computed at once by telemetry.derive_columns(), estimated track and aggregates follow
+        '''
+        data = self.__cursor.execute(f'SELECT rowid, flight_id, {", ".join(DATA_COLUMNS)} FROM data').fetchall()
+        with self.__connection:
+            self.__cursor.execute('DELETE FROM telemetry_derived')
+            if data:
+                table = np.array([line[2:] for line in data], dtype=float)
+                derived = derive_columns({key: table[:, i] for i, key in enumerate(DATA_COLUMNS)})
+                values = np.column_stack([derived[key] for key in DERIVED_COLUMNS]).tolist()
+                self.__cursor.executemany(INSERT_DERIVED, (
+                    [line[0]] + [None if value != value else value for value in row] + [line[1]] + [None] * len(TRACK_COLUMNS)
+                    for line, row in zip(data, values)))
+        self.rebuild_track()
+        self.rebuild_rollups()
+
+    def iter_derived(self, columns, start=None, end=None, located=False, flight_id=None):
+        '''
+        Yield rows (tuples) of given columns of table telemetry_derived ordered by timestamp, directly from a cursor
+            - start, end = timestamps of a time range (both included)
+            - located = only rows with known position
+            - flight_id = only rows of a flight (read by index on flight and timestamp)
+        Columns must not come from user input
+        '''
+        query = f'SELECT {", ".join(columns)} FROM telemetry_derived WHERE timestamp >= ? AND timestamp <= ?'
+        parameters = [start if start is not None else float('-inf'), end if end is not None else float('inf')]
+        if located:
+            query += ' AND pos_lat IS NOT NULL AND pos_lon IS NOT NULL'
+        if flight_id is not None:
+            query += ' AND flight_id = ?'
+            parameters.append(flight_id)
+        cursor = self.__connection.execute(query + ' ORDER BY timestamp', parameters)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def fetch_clusters(self, cells, precision, west, south, east, north):
+        '''
+        Fetch clusters of located rows within a bounding box, rows are grouped by geohash prefix of given precision
+        cells are geohash prefixes covering the bounding box (see spatial.cover()), each is read by index range
+        Return list of [prefix, count, average latitude, average longitude, data_id of the latest row]
+        '''
+        clusters = []
+        for cell in cells:
+            clusters += self.__cursor.execute('''
+                SELECT substr(geohash, 1, ?), COUNT(*), AVG(pos_lat), AVG(pos_lon), MAX(data_id)
+                FROM telemetry_derived
+                WHERE geohash >= ? AND geohash < ? AND pos_lat BETWEEN ? AND ? AND pos_lon BETWEEN ? AND ?
+                GROUP BY 1''', (precision, cell, cell + '~', south, north, west, east)).fetchall()
+        self.__connection.commit()
+        return [list(line) for line in clusters]
+
+    def fetch_derived_row(self, data_id):
+        '''Fetch derived values of a single row (the same columns as fetch_derived_data()), None if there is no such row'''
+        line = self.__cursor.execute(SELECT_DERIVED.replace('timestamp > ?', 'data_id = ?'), (data_id,)).fetchone()
+        self.__connection.commit()
+        return list(line) if line else None
+
+    def fetch_raw_data(self):
+        '''Yield rowid and raw uplink (decoded one by one, directly from a cursor) of all rows'''
+        cursor = self.__connection.execute('SELECT data_id, uplink FROM raw_uplinks')
+        try:
+            for data_id, uplink in cursor:
+                yield data_id, decode_uplink(uplink)
+        finally:
+            cursor.close()
+
+    def fetch_raw_uplink(self, data_id):
+        '''Fetch raw uplink of a single row as it was received, None if there is no such row'''
+        line = self.__cursor.execute('SELECT uplink FROM raw_uplinks WHERE data_id = ?', (data_id,)).fetchone()
+        self.__connection.commit()
+        return decode_uplink(line[0]) if line else None
+
+    def update_payload_values(self, rows):
+        '''Replace values decoded from payload, rows are lists of values (in order of payload.FIELDS) and rowid'''
+        with self.__connection:
+            self.__cursor.executemany(
+                f'UPDATE data SET {", ".join(f"{field} = ?" for field in FIELDS)} WHERE rowid = ?', rows)
+
+    def fetch_data_since(self, since, limit, flight_id=None):
+        '''
+        Fetch at most limit rows stored after timestamp since (without raw json), ordered by timestamp,
+        only rows of a flight if flight_id is given
+        Uses index on timestamp, so only requested rows are read
+        '''
+        if flight_id is None:
+            query, parameters = SELECT_DATA_SINCE, [since]
+        else:
+            query, parameters = SELECT_DATA_SINCE + WHERE_DATA_FLIGHT, [since, flight_id, flight_id]
+        data = self.__cursor.execute(query + ' ORDER BY timestamp LIMIT ?', parameters + [limit]).fetchall()
+        self.__connection.commit()
+        return [list(line) for line in data]
+
+    def fetch_gateways(self):
+        '''
+        Fetch aggregates of all gateways (the most used first): gtw_id, receptions, best and mean RSSI,
+        best and mean SNR, first and last seen, maximal distance to the balloon, position
+        '''
+        data = self.__cursor.execute('''
+            SELECT gtw_id, receptions, best_rssi, rssi_sum / NULLIF(rssi_count, 0), best_snr, snr_sum / NULLIF(snr_count, 0),
+                first_seen, last_seen, max_distance_m, lat, lon, alt
+            FROM gateway_stats ORDER BY receptions DESC''').fetchall()
+        self.__connection.commit()
+        return [list(line) for line in data]
+
+    def fetch_flights(self):
+        '''Fetch all flights (also archived ones) with identity of their device, the latest flight first'''
+        data = self.__cursor.execute('''
+            SELECT flight_id, dev_id, hardware_serial, first_timestamp, last_timestamp, row_count, archived
+            FROM flights JOIN devices USING (device_id) ORDER BY last_timestamp DESC''').fetchall()
+        self.__connection.commit()
+        return [list(line) for line in data]
+
+    def archive_flight(self, flight_id, archive_path):
+        '''
+        Move rows of a flight out of the hot tables into database in archive_path (the same structure,
+        can be opened by Database(archive_path)), flight is kept and marked as archived
+        '''
+        os.makedirs(archive_path, exist_ok=True)
+        Database(archive_path)      # create structure
+        data_columns = ', '.join(DATA_COLUMNS + FLIGHT_COLUMNS)
+        derived_columns = ', '.join(['data_id'] + DERIVED_COLUMNS + ['flight_id'] + TRACK_COLUMNS)
+        self.__connection.commit()
+        self.__cursor.execute('ATTACH DATABASE ? AS archive', (f'{archive_path}/database.sqlite',))
+        try:
+            with self.__connection:
+                self.__cursor.execute('''
+                    INSERT OR IGNORE INTO archive.devices SELECT * FROM devices
+                    WHERE device_id = (SELECT device_id FROM flights WHERE flight_id = ?)''', (flight_id,))
+                self.__cursor.execute('INSERT OR REPLACE INTO archive.flights SELECT * FROM flights WHERE flight_id = ?',
+                                      (flight_id,))
+                self.__cursor.execute(f'''
+                    INSERT INTO archive.data (rowid, {data_columns})
+                    SELECT rowid, {data_columns} FROM main.data WHERE flight_id = ?''', (flight_id,))
+                self.__cursor.execute(f'''
+                    INSERT OR REPLACE INTO archive.telemetry_derived ({derived_columns})
+                    SELECT {derived_columns} FROM main.telemetry_derived WHERE flight_id = ?''', (flight_id,))
+                self.__cursor.execute('''
+                    INSERT INTO archive.gateway_reception SELECT * FROM main.gateway_reception
+                    WHERE data_id IN (SELECT rowid FROM main.data WHERE flight_id = ?)''', (flight_id,))
+                self.__cursor.execute('''
+                    DELETE FROM main.gateway_reception
+                    WHERE data_id IN (SELECT rowid FROM main.data WHERE flight_id = ?)''', (flight_id,))
+                self.__cursor.execute('''
+                    INSERT OR REPLACE INTO archive.raw_uplinks SELECT * FROM main.raw_uplinks
+                    WHERE data_id IN (SELECT rowid FROM main.data WHERE flight_id = ?)''', (flight_id,))
+                self.__cursor.execute('''
+                    DELETE FROM main.raw_uplinks
+                    WHERE data_id IN (SELECT rowid FROM main.data WHERE flight_id = ?)''', (flight_id,))
+                self.__cursor.execute('INSERT OR REPLACE INTO archive.rollups SELECT * FROM main.rollups WHERE flight_id = ?',
+                                      (flight_id,))
+                self.__cursor.execute('DELETE FROM main.rollups WHERE flight_id = ?', (flight_id,))
+                self.__cursor.execute('INSERT OR REPLACE INTO archive.track_state SELECT * FROM main.track_state '
+                                      'WHERE flight_id = ?', (flight_id,))
+                self.__cursor.execute('DELETE FROM main.telemetry_derived WHERE flight_id = ?', (flight_id,))
+                self.__cursor.execute('DELETE FROM main.data WHERE flight_id = ?', (flight_id,))
+                self.__cursor.execute('UPDATE main.flights SET archived = 1 WHERE flight_id = ?', (flight_id,))
+        finally:
+            self.__cursor.execute('DETACH DATABASE archive')
+        global _store_revision
+        _store_revision = next(_store_counter)
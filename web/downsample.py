@@ -0,0 +1,37 @@
+def lttb(xs, ys, threshold):
+    '''
+    Downsample a series by Largest-Triangle-Three-Buckets algorithm
+    Return indices of at most threshold points which keep the visual shape of the series,
+    first and last points are always kept
+    xs must be increasing (e.g. timestamps), all points are kept if there are not more than threshold
+    '''
+    length = len(xs)
+    if threshold >= length:
+        return list(range(length))
+    if threshold < 3:
+        return [0, length - 1][:max(threshold, 0)]
+    indices = [0]
+    bucket_size = (length - 2) / (threshold - 2)
+    selected = 0
+    for bucket in range(threshold - 2):
+        # average point of the next bucket
+        next_start = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, length)
+        count = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / count
+        avg_y = sum(ys[next_start:next_end]) / count
+        # point of the current bucket forming the largest triangle with selected point and average
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        x_a = xs[selected]
+        y_a = ys[selected]
+        largest = -1
+        for i in range(start, end):
+            area = abs((x_a - avg_x) * (ys[i] - y_a) - (x_a - xs[i]) * (avg_y - y_a))
+            if area > largest:
+                largest = area
+                chosen = i
+        indices.append(chosen)
+        selected = chosen
+    indices.append(length - 1)
+    return indices
@@ -0,0 +1,108 @@
+import csv
+import io
+import json
+import struct
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+# fields which can be exported and columns of table telemetry_derived they are read from,
+# position is taken from GPS or from gateway if GPS data are missing (the same as in the summary table),
+# est_* is the estimated track which fills gaps of GPS (see track.py)
+EXPORT_FIELDS = {
+    'timestamp': 'timestamp',
+    'pressure_pa': 'pressure_pa',
+    'temp_c': 'temp_c',
+    'alt_m': 'pos_alt_m',
+    'lat': 'pos_lat',
+    'lon': 'pos_lon',
+    'bat_mv': 'bat_mv',
+    'est_lat': 'est_lat',
+    'est_lon': 'est_lon',
+    'est_error_m': 'est_error_m',
+    }
+
+# fields of binary columns (see encode_columns()), altitude is the one of the balloon only (not of gateway)
+COLUMN_FIELDS = dict(EXPORT_FIELDS, alt_m='alt_m')
+
+# columns needed to place a row on a map
+POSITION_COLUMNS = ['pos_lon', 'pos_lat', 'pos_alt_m']
+
+
+def iso_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def export_csv(rows, fields):
+    '''Yield lines of CSV with a header, rows are tuples of values of fields'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['time'] + fields)
+    for row in rows:
+        writer.writerow([iso_time(row[0])] + list(row))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def coordinates(row):
+    '''Coordinates (lon, lat, alt) of a row of POSITION_COLUMNS, altitude is left out when missing'''
+    return list(row[:2]) if row[2] is None else list(row)
+
+
+def export_geojson(track, points, fields):
+    '''
+    Yield GeoJSON FeatureCollection with:
+        - LineString of the flight track, track is an iterable of rows of POSITION_COLUMNS
+        - Point for every row of points, rows of POSITION_COLUMNS followed by values of fields
+    '''
+    yield '{"type": "FeatureCollection", "features": [\n'
+    yield '{"type": "Feature", "properties": {"name": "track"}, "geometry": {"type": "LineString", "coordinates": ['
+    separator = ''
+    for row in track:
+        yield separator + json.dumps(coordinates(row))
+        separator = ', '
+    yield ']}}'
+    for row in points:
+        properties = dict(zip(fields, row[3:]))
+        properties['time'] = iso_time(row[3])
+        feature = {'type': 'Feature', 'properties': properties,
+                   'geometry': {'type': 'Point', 'coordinates': coordinates(row[:3])}}
+        yield ',\n' + json.dumps(feature)
+    yield '\n]}\n'
+
+
+def export_kml(track, points, fields):
+    '''
+    Yield KML document with the flight track (LineString) and a Placemark for every point,
+    arguments are the same as of export_geojson()
+    '''
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+           '<Placemark><name>track</name><LineString><altitudeMode>absolute</altitudeMode><coordinates>\n')
+    for row in track:
+        yield ','.join(str(value) for value in coordinates(row)) + '\n'
+    yield '</coordinates></LineString></Placemark>\n'
+    for row in points:
+        data = ''.join(f'<Data name="{field}"><value>{escape(str(value))}</value></Data>'
+                       for field, value in zip(fields, row[3:]) if value is not None)
+        yield (f'<Placemark><name>{iso_time(row[3])}</name><ExtendedData>{data}</ExtendedData>'
+               f'<Point><coordinates>{",".join(str(value) for value in coordinates(row[:3]))}</coordinates></Point></Placemark>\n')
+    yield '</Document>\n</kml>\n'
+
+
+def encode_columns(fields, values):
+    '''
+    Encode values (NumPy array of rows x fields, NaN for missing) as typed columns for the browser:
+        - length of header (uint32) and JSON header {"rows": number of rows, "columns": [[field, type], ...]},
+          padded by spaces so columns start at a multiple of 4 bytes
+        - columns one after another, timestamp as int32 (whole seconds), other fields as float32 (NaN for missing)
+    All numbers are little-endian, so columns can be read by Int32Array and Float32Array directly
+    '''
+    header = json.dumps({'rows': len(values), 'columns': [
+        [field, 'int32' if field == 'timestamp' else 'float32'] for field in fields]}).encode()
+    header += b' ' * (-len(header) % 4)
+    parts = [struct.pack('<I', len(header)), header]
+    for i, field in enumerate(fields):
+        column = values[:, i]
+        parts.append(column.astype('<i4').tobytes() if field == 'timestamp' else column.astype('<f4').tobytes())
+    return b''.join(parts)
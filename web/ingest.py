@@ -0,0 +1,119 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+
+class IngestQueue:
+    '''
+    Stores received uplinks in a background thread, so the webhook is acknowledged immediately:
+        - uplinks are collected into batches of at most max_batch uplinks, batch is passed to store
+          (a function called with a list of uplinks) when it is full or max_delay seconds after its first uplink
+        - queue holds at most max_size uplinks, when it is full submit() waits at most timeout seconds
+          and raises queue.Full (backpressure, the network server should retry later)
+        - flush() waits until all submitted uplinks are stored, close() flushes and stops the writer
+    '''
+
+    def __init__(self, store, max_batch=100, max_delay=0.5, max_size=10000, timeout=0.1):
+        self.store = store
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.__queue = queue.Queue(max_size)
+        self.__writer = threading.Thread(target=self.__run, name='ingest-writer', daemon=True)
+        self.__writer.start()
+
+    def submit(self, uplink):
+        '''Queue uplink for storing, raise queue.Full if the queue stays full for timeout seconds'''
+        self.__queue.put(uplink, timeout=self.timeout)
+
+    def flush(self):
+        '''Wait until all submitted uplinks are stored'''
+        self.__queue.join()
+
+    def close(self):
+        '''Store all submitted uplinks and stop the writer'''
+        if self.__writer.is_alive():
+            self.__queue.put(_STOP)
+            self.__writer.join()
+
+    def __run(self):
+        stop = False
+        while not stop:
+            item = self.__queue.get()
+            if item is _STOP:
+                self.__queue.task_done()
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.__queue.get(timeout=remaining) if remaining > 0 else self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self.__queue.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self.store(batch)
+            except Exception:
+                logger.exception(f'Storing of {len(batch)} uplinks failed')
+            for _ in batch:
+                self.__queue.task_done()
+
+
+def gateway_ids(raw_data):
+    '''Set of gtw_id of all gateways which received an uplink (received data)'''
+    metadata = raw_data.get('metadata')
+    gateways = metadata.get('gateways') if isinstance(metadata, dict) else None
+    return {gateway.get('gtw_id') for gateway in gateways or [] if isinstance(gateway, dict)}
+
+
+class RecentUplinks:
+    '''
+    Bounded LRU of keys of recently stored uplinks (see db.uplink_key()), gateways which received them
+    and time of their reception, so repeated deliveries (retries of the network server, redundant integrations)
+    are acknowledged without any write
+    Deliveries more than window seconds apart are not repeated ones (like db.DUPLICATE_WINDOW)
+    Only this process is covered, other deliveries are caught by the unique index of the database
+    '''
+
+    def __init__(self, max_size=10000, window=3600):
+        self.max_size = max_size
+        self.window = window
+        self.__lock = threading.Lock()
+        self.__recent = OrderedDict()
+
+    def seen(self, key, gateways, timestamp):
+        '''Return True if uplink was already stored within window with all given gateways, nothing new would be stored'''
+        with self.__lock:
+            known = self.__recent.get(key)
+            if known is None:
+                return False
+            if abs(timestamp - known[0]) > self.window:
+                del self.__recent[key]
+                return False
+            self.__recent.move_to_end(key)
+            return gateways <= known[1]
+
+    def add(self, key, gateways, timestamp):
+        '''
+        Remember stored uplink (call it only after the uplink was committed),
+        the least recently seen one is forgotten when LRU is full
+        '''
+        with self.__lock:
+            known = self.__recent.get(key)
+            if known is None or abs(timestamp - known[0]) > self.window:
+                known = (timestamp, set())
+            self.__recent[key] = (known[0], known[1] | gateways)
+            self.__recent.move_to_end(key)
+            while len(self.__recent) > self.max_size:
+                self.__recent.popitem(last=False)
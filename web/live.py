@@ -0,0 +1,95 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    '''
+    Pushes newly stored rows to all subscribers (Server-Sent Events clients) of this process:
+        - a single thread checks revision() (cheap, database is not touched) every interval seconds
+          while there are subscribers, fetch(since) is called only when revision has changed
+        - fetch(since) returns a list of (id, event) of rows stored after row id since,
+          latest() returns id of the latest stored row (None if there is none)
+        - ids are rowids of stored rows, they only grow in order of commits (unlike timestamps of rows
+          received by concurrent workers), so no row committed later is skipped
+        - every subscriber gets its own bounded queue, subscribers which do not keep up lose events
+        - at most max_subscribers are served at once, each of them holds a thread of the server
+    Rows stored by other processes are noticed too, as long as revision() notices them
+    '''
+
+    def __init__(self, revision, fetch, latest, interval=1.0, max_pending=100, max_subscribers=None):
+        self.revision = revision
+        self.fetch = fetch
+        self.latest = latest
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_subscribers = max_subscribers
+        self.__lock = threading.Lock()
+        self.__poll_lock = threading.Lock()        # guards the cursor (last revision and id)
+        self.__subscribers = set()
+        self.__wakeup = threading.Event()
+        self.__last_revision = None
+        self.__last_id = None
+        self.__thread = None
+
+    def subscribe(self, since=None):
+        '''
+        Return a queue of new events for a subscriber, events stored after row id since (e.g. Last-Event-ID)
+        are queued immediately
+        Return None if there are already max_subscribers
+        '''
+        subscriber = queue.Queue(self.max_pending)
+        if since is not None:
+            for data_id, event in self.fetch(since)[-self.max_pending:]:
+                subscriber.put((data_id, event))
+        with self.__poll_lock, self.__lock:
+            if self.max_subscribers is not None and len(self.__subscribers) >= self.max_subscribers:
+                return None
+            if not self.__subscribers:
+                self.__last_revision = self.revision()
+                self.__last_id = self.latest()
+            self.__subscribers.add(subscriber)
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name='live-broadcaster', daemon=True)
+                self.__thread.start()
+        self.__wakeup.set()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.__lock:
+            self.__subscribers.discard(subscriber)
+
+    def poll(self):
+        '''Fetch rows stored since the last poll and pass them to subscribers, if revision has changed'''
+        with self.__poll_lock:
+            revision = self.revision()
+            if revision == self.__last_revision:
+                return
+            self.__last_revision = revision
+            events = self.fetch(self.__last_id if self.__last_id is not None else 0)
+            if not events:
+                return
+            self.__last_id = events[-1][0]
+            with self.__lock:
+                subscribers = list(self.__subscribers)
+            for subscriber in subscribers:
+                for data_id, event in events:
+                    try:
+                        subscriber.put_nowait((data_id, event))
+                    except queue.Full:
+                        break
+
+    def __run(self):
+        while True:
+            with self.__lock:
+                if not self.__subscribers:
+                    self.__thread = None
+                    return
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Polling for new rows failed')
+            self.__wakeup.wait(self.interval)
+            self.__wakeup.clear()
@@ -0,0 +1,235 @@
+'''
+Replay uplinks against /endpoint while the page is read, to check how a deployment handles bursts
+(many probes, retries of the network server, backlog flushed after an outage)
+
+    python loadtest.py [--archive cloud_data | --synthetic 2000 --probes 5 --retries 0.1]
+                       [--rate 200] [--concurrency 8] [--readers 2] [--url http://127.0.0.1:8000]
+
+Uplinks are posted with basic auth from credentials.txt:
+    - by default to the Flask application in this process (test clients), in a temporary directory like benchmark.py
+    - with --url to a running server, e.g. a local gunicorn (`gunicorn -w 4 app:app`), nothing leaves the machine
+Throughput, latency percentiles of /endpoint and /, responses of a locked or overloaded server (503 or no response,
+counted by the harness) and SQLite lock errors (counter sqlite_locked_total of /metrics, a gunicorn server reports
+only the worker which answered) are printed and written as JSON (--output)
+'''
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from base64 import b64encode
+
+import app as application
+from backfill import archive_files, parse_file
+from benchmark import Workspace
+from synthetic import generate_flight
+
+
+def load_uplinks(archive=None, synthetic=1000, probes=1, retries=0.0, seed=0):
+    '''
+    Return list of uplinks (raw data) in order of sending:
+        - archive = archive directory (cloud_data/, segments of RawArchive and text files of older versions,
+          see backfill.parse_file()), uplinks in order of time, uplinks which cannot be parsed are left out
+        - otherwise synthetic flights of probes (see synthetic.generate_flight()), synthetic uplinks in total,
+          interleaved by time of their reception
+    retries = share of uplinks delivered once more right after the first delivery (retry of the network server)
+    '''
+    if archive:
+        parsed = [uplink for path in archive_files(archive) for uplink in parse_file(path)[0]]
+        uplinks = [raw_data for _, raw_data in sorted(parsed, key=lambda uplink: uplink[0]['timestamp'])]
+    else:
+        flights = [generate_flight(synthetic // probes + (i < synthetic % probes), dev_id=f'probe-{i}', seed=i)
+                   for i in range(probes)]
+        uplinks = [raw_data for _, raw_data in heapq.merge(*flights, key=lambda uplink: uplink[0])]
+    rng = random.Random(seed)
+    replayed = []
+    for raw_data in uplinks:
+        replayed.append(raw_data)
+        if rng.random() < retries:
+            replayed.append(raw_data)
+    return replayed
+
+
+def percentiles(values):
+    '''Number, p50, p95, p99 and maximum (nearest rank) of latencies (s)'''
+    values = sorted(values)
+    result = {'count': len(values)}
+    for name, share in [('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0)]:
+        result[name] = values[max(int(round(share * len(values))) - 1, 0)] if values else None
+    return result
+
+
+class LocalTarget:
+    '''Flask application of this process, every thread gets its own test client'''
+
+    def __init__(self, credentials):
+        self.headers = {'Authorization': 'Basic ' + b64encode(':'.join(credentials).encode()).decode()}
+        self.__local = threading.local()
+
+    def __client(self):
+        if not hasattr(self.__local, 'client'):
+            self.__local.client = application.app.test_client()
+        return self.__local.client
+
+    def post(self, raw_data):
+        return self.__client().post('/endpoint', headers=self.headers, json=raw_data).status_code
+
+    def get(self, path):
+        response = self.__client().get(path, headers=self.headers)
+        return response.status_code, response.get_data(as_text=True)
+
+    def settle(self):
+        '''Wait until uplinks accepted by the asynchronous ingest are stored'''
+        if application.app.config['INGEST_ASYNC']:
+            application.provide_ingest_queue().flush()
+
+
+class HttpTarget:
+    '''Running server at url, status is None when the server cannot be reached'''
+
+    def __init__(self, url, credentials, timeout=30):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.headers = {'Authorization': 'Basic ' + b64encode(':'.join(credentials).encode()).decode()}
+
+    def __request(self, request):
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read().decode(errors='replace')
+        except urllib.error.HTTPError as error:
+            return error.code, ''
+        except OSError:
+            return None, ''
+
+    def post(self, raw_data):
+        request = urllib.request.Request(f'{self.url}/endpoint', data=json.dumps(raw_data).encode(),
+                                         headers=dict(self.headers, **{'Content-Type': 'application/json'}),
+                                         method='POST')
+        return self.__request(request)[0]
+
+    def get(self, path):
+        return self.__request(urllib.request.Request(f'{self.url}{path}', headers=self.headers))
+
+    def settle(self):
+        time.sleep(application.app.config['INGEST_MAX_DELAY'] * 2)
+
+
+def locked_count(target):
+    '''Sum of counter sqlite_locked_total read from /metrics'''
+    status, text = target.get('/metrics')
+    if status != 200:
+        return 0
+    return sum(float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line.startswith('sqlite_locked_total'))
+
+
+def run(target, uplinks, rate=None, concurrency=4, readers=1):
+    '''
+    Post uplinks by concurrency threads and read / by readers threads until all uplinks are posted
+    With rate (uplinks per second) every uplink has its time of sending, its latency is measured from that time,
+    so a server which cannot keep up is not hidden by workers waiting for responses
+    Return report with throughput, percentiles of latencies, statuses of responses, requests refused by a locked
+    or overloaded server (503 or no response at all) and SQLite lock errors
+    '''
+    locked_before = locked_count(target)
+    lock = threading.Lock()
+    pending = iter(enumerate(uplinks))
+    posted = {'latency': [], 'status': {}}
+    read = {'latency': [], 'status': {}}
+    done = threading.Event()
+
+    def record(results, status, latency):
+        with lock:
+            results['latency'].append(latency)
+            results['status'][str(status)] = results['status'].get(str(status), 0) + 1
+
+    def post():
+        while True:
+            with lock:
+                i, raw_data = next(pending, (None, None))
+            if i is None:
+                return
+            due = start + i / rate if rate else time.perf_counter()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            status = target.post(raw_data)
+            record(posted, status, time.perf_counter() - due)
+
+    def get():
+        while not done.is_set():
+            sent = time.perf_counter()
+            status, _ = target.get('/')
+            record(read, status, time.perf_counter() - sent)
+
+    start = time.perf_counter()
+    posters = [threading.Thread(target=post) for _ in range(concurrency)]
+    getters = [threading.Thread(target=get) for _ in range(readers)]
+    for thread in posters + getters:
+        thread.start()
+    for thread in posters:
+        thread.join()
+    duration = time.perf_counter() - start
+    done.set()
+    for thread in getters:
+        thread.join()
+    target.settle()
+    return {
+        'uplinks': len(uplinks),
+        'seconds': duration,
+        'throughput': len(uplinks) / duration if duration else None,
+        'endpoint': {**percentiles(posted['latency']), 'status': posted['status']},
+        'index': {**percentiles(read['latency']), 'status': read['status']},
+        'unavailable': sum(results['status'].get(status, 0) for results in (posted, read) for status in ('503', 'None')),
+        'sqlite_locked': locked_count(target) - locked_before,
+    }
+
+
+def print_report(report):
+    throughput = f'{report["throughput"]:.0f}' if report['throughput'] is not None else '-'
+    print(f'{report["uplinks"]} uplinks in {report["seconds"]:.2f} s, {throughput} uplinks/s')
+    for name in ('endpoint', 'index'):
+        item = report[name]
+        if item['count']:
+            print(f'{name:>9}: {item["count"]} requests, p50 {item["p50"] * 1000:.1f} ms, '
+                  f'p95 {item["p95"] * 1000:.1f} ms, p99 {item["p99"] * 1000:.1f} ms, max {item["max"] * 1000:.1f} ms, '
+                  f'status {item["status"]}')
+    print(f'locked or overloaded (503 or no response): {report["unavailable"]}, '
+          f'SQLite lock errors: {report["sqlite_locked"]:.0f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay uplinks against /endpoint and measure latency')
+    parser.add_argument('--archive', help='replay uplinks archived in this directory (e.g. cloud_data, also text files of older versions)')
+    parser.add_argument('--synthetic', type=int, default=1000, help='number of synthetic uplinks (without --archive)')
+    parser.add_argument('--probes', type=int, default=1, help='number of probes flying at once (synthetic)')
+    parser.add_argument('--retries', type=float, default=0.0, help='share of uplinks delivered twice')
+    parser.add_argument('--rate', type=float, help='uplinks per second, as fast as possible by default')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of threads posting uplinks')
+    parser.add_argument('--readers', type=int, default=1, help='number of threads reading the page meanwhile')
+    parser.add_argument('--url', help='running server (e.g. http://127.0.0.1:8000), this process by default')
+    parser.add_argument('--credentials', default='credentials.txt', help='user:password of endpoint (with --url)')
+    parser.add_argument('--sync', action='store_true', help='store uplinks before response (without --url)')
+    parser.add_argument('--output', help='write report as JSON')
+    args = parser.parse_args(argv)
+    uplinks = load_uplinks(args.archive, args.synthetic, max(args.probes, 1), args.retries)
+    if args.url:
+        target = HttpTarget(args.url, application.load_credentials(args.credentials))
+        report = run(target, uplinks, args.rate, args.concurrency, args.readers)
+    else:
+        with Workspace():
+            application.app.config['INGEST_ASYNC'] = not args.sync
+            target = LocalTarget(application.load_credentials(os.path.abspath('credentials.txt')))
+            report = run(target, uplinks, args.rate, args.concurrency, args.readers)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (s) of latency histogram buckets
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class Histogram:
+    '''Counts of observed durations in BUCKETS, their sum and count (cumulative buckets are computed on render)'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)     # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    '''
+    Latency histograms and counters of this process, rendered in Prometheus text format
+        - histograms are labelled by stage (e.g. fetch_all_data) or by endpoint and status
+        - counters count events, e.g. rejected uplinks
+    Every gunicorn worker has its own registry, so /metrics shows the worker which served the request
+    (label worker tells which one)
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__histograms = {}
+        self.__counters = {}
+
+    def observe(self, name, labels, value):
+        '''Add a duration (s) to histogram name with labels (tuple of pairs)'''
+        with self.__lock:
+            key = (name, labels)
+            if key not in self.__histograms:
+                self.__histograms[key] = Histogram()
+            self.__histograms[key].observe(value)
+
+    def increment(self, name, labels=(), value=1):
+        with self.__lock:
+            self.__counters[(name, labels)] = self.__counters.get((name, labels), 0) + value
+
+    def clear(self):
+        with self.__lock:
+            self.__histograms.clear()
+            self.__counters.clear()
+
+    @contextmanager
+    def stage(self, name):
+        '''Measure duration of a stage (with block), stored into histogram stage_seconds'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', (('stage', name),), time.perf_counter() - start)
+
+    def render(self, labels=()):
+        '''Return all metrics in Prometheus text format, labels are added to every sample'''
+        lines = []
+        with self.__lock:
+            histograms = sorted(self.__histograms.items())
+            counters = sorted(self.__counters.items())
+            typed = set()
+            for (name, key_labels), histogram in histograms:
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                common = format_labels(labels + key_labels)
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + key_labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{common} {histogram.sum}')
+                lines.append(f'{name}_count{common} {histogram.count}')
+            for (name, key_labels), value in counters:
+                if name not in typed:
+                    lines.append(f'# TYPE {name} counter')
+                    typed.add(name)
+                lines.append(f'{name}{format_labels(labels + key_labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+# registry of this process
+registry = Registry()
+stage = registry.stage
@@ -0,0 +1,78 @@
+import binascii
+import struct
+from base64 import b64decode
+import numpy as np
+
+# names of decoded values, the same as names of payload_fields of the network server decoder
+FIELDS = ['pressure_pa', 'temp_c', 'core_temp_c', 'bat_mv', 'alt_m', 'lat', 'lon', 'loop_time_s']
+
+# known layouts of telemetry_packet_t (fw/src/main.c), by payload length:
+#   - struct of values, in order of FIELDS
+#   - pressure multiplier to Pascals
+#   - temperature divisor to Celsius (temperature is sent in deci Celsius)
+LAYOUTS = {
+    # flown in 2021, pressure in deca Pascals as uint16
+    18: (struct.Struct('<HhbHHffB'), 10, 10),
+    # current firmware, pressure in Pascals as uint32
+    20: (struct.Struct('<IhbHHffB'), 1, 10),
+}
+
+# structured array of decoded values, see decode_payloads()
+DECODED_DTYPE = np.dtype([
+    ('valid', np.bool_),
+    ('pressure_pa', np.uint32),
+    ('temp_c', np.float64),
+    ('core_temp_c', np.int8),
+    ('bat_mv', np.uint16),
+    ('alt_m', np.uint16),
+    ('lat', np.float32),
+    ('lon', np.float32),
+    ('loop_time_s', np.uint8),
+    ])
+
+
+def decode_payload(payload_raw):
+    '''
+    Decode payload_raw (base64) sent by the probe to a dictionary with keys of FIELDS
+    Return None for payloads which cannot be decoded (unknown length, invalid base64)
+    '''
+    try:
+        payload = b64decode(payload_raw, validate=True)
+    except (binascii.Error, TypeError, ValueError):
+        return None
+    if len(payload) not in LAYOUTS:
+        return None
+    layout, pressure_multiplier, temp_divisor = LAYOUTS[len(payload)]
+    values = dict(zip(FIELDS, layout.unpack(payload)))
+    values['pressure_pa'] *= pressure_multiplier
+    values['temp_c'] /= temp_divisor
+    return values
+
+
+def decode_payloads(payloads):
+    '''
+    Decode many payloads (base64) at once to a NumPy structured array (DECODED_DTYPE), one item per payload
+    Payloads of the same layout are decoded by a single np.frombuffer, item is not valid when payload cannot be decoded
+    '''
+    decoded = np.zeros(len(payloads), dtype=DECODED_DTYPE)
+    groups = {length: ([], []) for length in LAYOUTS}
+    for i, payload_raw in enumerate(payloads):
+        try:
+            payload = b64decode(payload_raw, validate=True)
+        except (binascii.Error, TypeError, ValueError):
+            continue
+        if len(payload) in groups:
+            groups[len(payload)][0].append(i)
+            groups[len(payload)][1].append(payload)
+    for length, (indices, group) in groups.items():
+        if not indices:
+            continue
+        layout, pressure_multiplier, temp_divisor = LAYOUTS[length]
+        dtype = np.dtype(list(zip(FIELDS, [f'<{code}' for code in layout.format[1:]])))
+        values = np.frombuffer(b''.join(group), dtype=dtype)
+        decoded['valid'][indices] = True
+        for field in FIELDS:
+            decoded[field][indices] = values[field]
+        decoded['pressure_pa'][indices] = values['pressure_pa'].astype(np.uint32) * pressure_multiplier
+        decoded['temp_c'][indices] = values['temp_c'] / temp_divisor
+    return decoded
@@ -0,0 +1,88 @@
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# precision of geohash stored for every row
+GEOHASH_PRECISION = 10
+
+# mean radius of the Earth
+EARTH_RADIUS_M = 6371008.8
+
+
+def geohash(lat, lon, precision=GEOHASH_PRECISION):
+    '''Geohash of a position, None if position is missing'''
+    if lat is None or lon is None:
+        return None
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        ranges, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (ranges[0] + ranges[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            ranges[0] = middle
+        else:
+            ranges[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    '''Height and width (degrees) of a geohash cell of given precision'''
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+
+def precision_for_zoom(zoom):
+    '''
+    Geohash precision of clusters for a map zoom level, a cluster is roughly a quarter of a map tile (256 px) wide
+    '''
+    tile_width = 360 / 2 ** zoom
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        if cell_size(precision)[1] < tile_width / 4:
+            return precision
+    return GEOHASH_PRECISION
+
+
+def cover(west, south, east, north, max_cells=16):
+    '''
+    Geohash cells covering a bounding box, precision is chosen so there are at most max_cells cells
+    (but at least precision 1), every cell is a range of geohashes starting with it
+    '''
+    cells = set()
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        if ((north - south) / height + 2) * ((east - west) / width + 2) > max_cells and precision > 1:
+            continue
+        lat = south
+        while True:
+            lon = west
+            while True:
+                cells.add(geohash(min(lat, north), min(lon, east), precision))
+                if lon >= east:
+                    break
+                lon += width
+            if lat >= north:
+                break
+            lat += height
+        return sorted(cells)
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    '''Great-circle distance (m) of two positions, None if any of them is missing'''
+    if None in (lat1, lon1, lat2, lon2):
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
@@ -0,0 +1,68 @@
+import math
+import random
+from base64 import b64encode
+from datetime import datetime, timezone
+from payload import LAYOUTS
+
+# launch site, Brno Observatory and Planetarium
+LAUNCH_LAT = 49.20522
+LAUNCH_LON = 16.58396
+
+
+def pressure_at(alt_m):
+    '''Air pressure (Pa) at altitude, inverse of telemetry.altitude_from_pressure()'''
+    return 101325 * pow(1 - alt_m * 3.2808 / 145366.45, 1 / 0.190284)
+
+
+def generate_flight(rows, gateways=3, missing_gps=0.2, invalid_temp=0.05, start=1624867200, interval=600,
+                    dev_id='probe-1', seed=0):
+    '''
+    Generate uplinks of a synthetic flight as the network server sends them (payload_raw of the current firmware
+    and metadata with gateways), list of timestamp of reception and uplink:
+        - rows = number of uplinks, one every interval seconds from start
+        - gateways = number of gateways which received every uplink (at least 1)
+        - missing_gps = share of uplinks without GPS fix (position is then known only from gateways)
+        - invalid_temp = share of uplinks with nonsense outside temperature
+    The balloon ascends to about 12 km and drifts east with the wind, altitude and battery voltage follow the day
+    Output depends only on arguments (seed of random numbers)
+    '''
+    rng = random.Random(seed)
+    layout = LAYOUTS[20][0]
+    lat, lon = LAUNCH_LAT, LAUNCH_LON
+    uplinks = []
+    for counter in range(rows):
+        timestamp = start + counter * interval
+        day = math.sin(2 * math.pi * ((timestamp % 86400) / 86400 - 0.25))
+        alt = max(min(counter * interval * 2, 11500 + 500 * day) + rng.uniform(-50, 50), 0)
+        lat += rng.gauss(0, 0.01)
+        lon += 0.05 * interval / 600 + rng.gauss(0, 0.01)
+        lon = (lon + 180) % 360 - 180
+        temp = 15 - 0.0065 * min(alt, 11000) + 10 * day
+        core_temp = temp + 5
+        if rng.random() < invalid_temp:
+            temp = 3000
+        fix = rng.random() >= missing_gps
+        payload = layout.pack(
+            round(pressure_at(alt)), round(temp * 10), round(core_temp), round(3300 + 600 * max(day, 0)),
+            round(alt) if fix else 0, lat if fix else 0, lon if fix else 0, rng.randrange(1, 60))
+        uplinks.append((timestamp, {
+            'app_id': 'picoballoon',
+            'dev_id': dev_id,
+            'hardware_serial': f'{seed:016X}',
+            'port': 1,
+            'counter': counter,
+            'payload_raw': b64encode(payload).decode(),
+            'metadata': {
+                'time': datetime.fromtimestamp(timestamp, timezone.utc).isoformat().replace('+00:00', 'Z'),
+                'frequency': rng.choice([868.1, 868.3, 868.5]),
+                'gateways': [{
+                    'gtw_id': f'eui-{seed:04x}{i:012x}',
+                    'rssi': rng.randrange(-130, -90),
+                    'snr': round(rng.uniform(-20, 5), 1),
+                    'latitude': round(lat + rng.uniform(-2, 2), 4),
+                    'longitude': round(lon + rng.uniform(-2, 2), 4),
+                    'altitude': rng.randrange(100, 600),
+                } for i in range(max(gateways, 1))],
+            },
+        }))
+    return uplinks
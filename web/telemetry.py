@@ -0,0 +1,75 @@
+import numpy as np
+from spatial import geohash
+
+# columns of table telemetry_derived (except data_id), in the order of the table
+DERIVED_COLUMNS = [
+    'timestamp', 'pressure_pa', 'temp_c', 'alt_m', 'lat', 'lon', 'bat_mv',
+    'lat_gw', 'lon_gw', 'alt_gw', 'pos_lat', 'pos_lon', 'pos_alt_m', 'geohash'
+    ]
+
+
+def altitude_from_pressure(pressure_pa):
+    '''Barometric altitude (m, rounded) from air pressure (Pa)'''
+    return round((145366.45 * (1 - pow(pressure_pa / 101325, 0.190284))) / 3.2808)
+
+
+def valid_temperature(temp_c, core_temp_c):
+    '''
+    Return temperature if it seems to be valid, else temperature of core if it seems to be valid, else None
+    Temperature is not checked if temperature of core is missing
+    '''
+    if temp_c is not None and core_temp_c is not None:
+        if temp_c < -100 or temp_c > 50:
+            if core_temp_c > -100 and core_temp_c < 50:
+                return core_temp_c
+            return None
+    return temp_c
+
+
+def derive_row(data):
+    '''
+    Compute derived values from a dictionary of stored values (see Database.parse_data()):
+        - temperature, temperature of core is used for invalid values
+        - altitude from GPS, calculated from pressure if missing
+        - position (pos_lat, pos_lon, pos_alt_m) from GPS, from gateway if missing
+        - geohash of the position (see spatial.py)
+    Return list of values in the order of DERIVED_COLUMNS
+    '''
+    alt = data['alt_m']
+    if alt is None and data['pressure_pa'] is not None:
+        alt = altitude_from_pressure(data['pressure_pa'])
+    pos_lat = data['lat'] if data['lat'] is not None else data['lat_gw']
+    pos_lon = data['lon'] if data['lon'] is not None else data['lon_gw']
+    return [
+        data['timestamp'], data['pressure_pa'], valid_temperature(data['temp_c'], data['core_temp_c']), alt,
+        data['lat'], data['lon'], data['bat_mv'], data['lat_gw'], data['lon_gw'], data['alt_gw'],
+        pos_lat, pos_lon, alt if alt is not None else data['alt_gw'], geohash(pos_lat, pos_lon),
+        ]
+
+
+def derive_columns(columns):
+    '''
+    Compute the same values as derive_row() for whole columns at once (geohash is computed for every row)
+    columns is a dictionary of NumPy arrays (NaN for missing values) with names of table data columns
+    Return dictionary of NumPy arrays with names of DERIVED_COLUMNS
+    '''
+    pressure = columns['pressure_pa']
+    temp = columns['temp_c']
+    core_temp = columns['core_temp_c']
+    with np.errstate(invalid='ignore'):
+        alt = np.where(np.isnan(columns['alt_m']),
+                       np.round((145366.45 * (1 - np.power(pressure / 101325, 0.190284))) / 3.2808),
+                       columns['alt_m'])
+        invalid = ~np.isnan(core_temp) & ((temp < -100) | (temp > 50))
+        core_valid = (core_temp > -100) & (core_temp < 50)
+        temp = np.where(invalid, np.where(core_valid, core_temp, np.nan), temp)
+    derived = {key: columns[key] for key in ['timestamp', 'pressure_pa', 'lat', 'lon', 'bat_mv', 'lat_gw', 'lon_gw', 'alt_gw']}
+    derived['temp_c'] = temp
+    derived['alt_m'] = alt
+    derived['pos_lat'] = np.where(np.isnan(columns['lat']), columns['lat_gw'], columns['lat'])
+    derived['pos_lon'] = np.where(np.isnan(columns['lon']), columns['lon_gw'], columns['lon'])
+    derived['pos_alt_m'] = np.where(np.isnan(alt), columns['alt_gw'], alt)
+    derived['geohash'] = np.array([
+        geohash(lat, lon) if lat == lat and lon == lon else None
+        for lat, lon in zip(derived['pos_lat'].tolist(), derived['pos_lon'].tolist())], dtype=object)
+    return derived
@@ -11,12 +11,22 @@ def db(app):
 def app():
     import pathlib
     import os
+    import shutil
     from app import app
     with app.app_context():
         app.config['DATABASE_PATH'] = str(pathlib.Path().resolve())
+        app.config['INGEST_ASYNC'] = False
     yield app
+    from app import close_ingest_queues, close_archives, _recent_uplinks
+    from db import close_connections
+    close_ingest_queues()
+    close_archives()
+    _recent_uplinks.clear()
+    close_connections()
     if os.path.exists(f"""{app.config["DATABASE_PATH"]}/database.sqlite"""):
         os.remove(f"""{app.config['DATABASE_PATH']}/database.sqlite""")
+    shutil.rmtree(f"""{app.config['DATABASE_PATH']}/flights""", ignore_errors=True)     # archived flights
+    shutil.rmtree(f"""{app.config['DATABASE_PATH']}/cloud_data""", ignore_errors=True)      # archive of raw uplinks
 
 
 @pytest.fixture
@@ -121,20 +131,19 @@ def test_endpoint_passes_data(client, db):
     for data_row in db.fetch_all_data():
         for value in data_row:
             assert value != 'None'
+            assert value is not None
     assert response.status_code == 200
 
 
 def test_endpoint_save_externally(client, db, app):
-    '''Endpoint saves incoming json to a new file'''
-    from os import path
-    from datetime import datetime
+    '''Endpoint appends incoming json to the archive of raw uplinks'''
+    from app import provide_archive
 
-    response = client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={})
+    response = client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={"counter": 18})
     last_input = db.fetch_all_data()
-    timestamp = last_input[0][0]
-    time = datetime.fromtimestamp(timestamp).strftime("%d.%m. %H:%M")
+    timestamp = last_input[-1][0]
 
-    assert path.exists(f"""{app.config['DATABASE_PATH']}/cloud_data/{time}.txt""") is True
+    assert list(provide_archive().read(since=timestamp)) == [(timestamp, {"counter": 18})]
     assert response.status_code == 200
 
 
@@ -174,7 +183,7 @@ def test_database_no_gps(client, db):
         }
     })
     for data_row in db.fetch_all_data():
-        lat_gw, lon_gw, alt_gw, freq, rssi = data_row[9:-1]
+        lat_gw, lon_gw, alt_gw, freq, rssi = data_row[9:]
         assert [lat_gw, lon_gw, alt_gw] == [52.2345, 6.2345, 200]
     assert response.status_code == 200
 
@@ -205,7 +214,7 @@ def test_database_missing_device_info(client, db):
         }
     })
     for data_row in db.fetch_all_data():
-        lat_gw, lon_gw, alt_gw, freq, rssi = data_row[9:-1]
+        lat_gw, lon_gw, alt_gw, freq, rssi = data_row[9:]
         assert [lat_gw, lon_gw, alt_gw, freq, rssi] == [53.2312345254, 42.1, 100, 700.9, -100]
     assert response.status_code == 200
 
@@ -224,7 +233,7 @@ def test_database_no_gw(client, db):
     })
     for data_row in db.fetch_all_data():
         for value in data_row[1:1]:     # except timestamp and json
-            assert value == 'None'
+            assert value is None
     assert response.status_code == 200
 
 
@@ -233,7 +242,7 @@ def test_database_no_data(client, db):
     response = client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={})
     for data_row in db.fetch_all_data():
         for value in data_row[1:1]:     # except timestamp and json
-            assert value == 'None'
+            assert value is None
     assert response.status_code == 200
 
 
@@ -267,8 +276,8 @@ def test_database_handle_0(client, db):
         }
     })
     for data_row in db.fetch_all_data():
-        for value in data_row[1:-1]:  # except timestamp and json
-            assert value == 'None'
+        for value in data_row[1:]:  # except timestamp
+            assert value is None
     assert response.status_code == 200
 
 
@@ -300,7 +309,7 @@ def test_database_strongest_gw(client, db):
         }
     })
     for data_row in db.fetch_all_data():
-        lat_gw, lon_gw, alt_gw, freq, rssi = data_row[9:-1]
+        lat_gw, lon_gw, alt_gw, freq, rssi = data_row[9:]
         assert [lat_gw, lon_gw, alt_gw, freq, rssi] == [20.00, 20.00, 6000, 867.9, 100]
     assert response.status_code == 200
 
@@ -320,9 +329,24 @@ def test_database_strings_invalid(client, db):
         }
     })
     for data_row in db.fetch_all_data():
-        _, _, _, _, _, _, _, _, loop_time, lat_gw, lon_gw, _, freq, rssi = data_row[:-1]
-        assert [lat_gw, lon_gw, freq, loop_time] == ['None', 'None', 'None', 'None']
+        _, _, _, _, _, _, _, _, loop_time, lat_gw, lon_gw, _, freq, rssi = data_row
+        assert [lat_gw, lon_gw, freq, loop_time] == [None, None, None, None]
+    assert response.status_code == 200
+
+
+def test_gateway_strings(client, db, app):
+    '''Gateway values sent as strings are treated as missing, the uplink and its receptions are stored'''
+    response = client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_fields": {"temp_c": 20, "lat": 49.2, "lon": 16.6},
+        "metadata": {"gateways": [
+            {"gtw_id": "eui-text", "rssi": "-100", "snr": "5", "latitude": "49.1", "longitude": "16.5", "altitude": "300"},
+            {"gtw_id": "eui-number", "rssi": -110, "snr": 2.5, "latitude": 49.0, "longitude": 16.4}]}})
     assert response.status_code == 200
+    assert len(db.fetch_all_data()) == 1
+    receptions = db._Database__cursor.execute(
+        'SELECT gtw_id, rssi, snr, lat, lon, alt, distance_m FROM gateway_reception ORDER BY gtw_id').fetchall()
+    assert receptions[1] == ('eui-text', None, None, None, None, None, None)
+    assert receptions[0][:5] == ('eui-number', -110, 2.5, 49.0, 16.4) and receptions[0][6] > 0
 
 
 def test_app_temp_correct(client, db, app):
@@ -363,4 +387,799 @@ def test_app_temp_missing(client, db, app):
     })
     data = provide_data()
     temp = data[0][2]
-    assert temp == "missing"
\ No newline at end of file
+    assert temp == "missing"
+
+def test_app_derived_data_cached(client, db, app, monkeypatch):
+    '''App builds table, markers and graphs once and reuses them until new data are stored'''
+    import app as app_module
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+    "payload_fields": {
+        "core_temp_c": 30,
+        "temp_c": 20,
+        "lat": 49.2,
+        "lon": 16.6
+        },
+    })
+    calls = []
+    provide_data_columns = app_module.provide_data_columns
+    monkeypatch.setattr(app_module, 'provide_data_columns', lambda: calls.append(1) or provide_data_columns())
+    assert client.get('/').status_code == 200
+    assert client.get('/').status_code == 200
+    assert len(calls) == 1
+    assert app_module.provide_data_markers()[0][3:] == [16.6, 49.2]
+
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+    "payload_fields": {"temp_c": 10},
+    })
+    assert len(app_module.provide_data_table()) == 2
+    assert app_module.provide_derived_data()['series']['temp'][1] == [20.0, 10.0]
+    assert len(calls) == 2
+
+
+def test_db_connection_reused(db, app):
+    '''
+    Database reuses connection of the current thread, other threads get their own connection,
+    which is closed when the thread ends
+    '''
+    import gc
+    import sqlite3
+    import threading
+    from db import Database
+    connection = db._Database__connection
+    assert Database(app.config['DATABASE_PATH'])._Database__connection is connection
+    other = []
+    thread = threading.Thread(target=lambda: other.append(Database(app.config['DATABASE_PATH'])._Database__connection))
+    thread.start()
+    thread.join()
+    assert other[0] is not connection
+    gc.collect()
+    with pytest.raises(sqlite3.ProgrammingError):      # closed when its thread ended
+        other[0].execute('SELECT 1')
+    connection.execute('SELECT 1')
+
+
+def test_db_migrates_none_strings(app):
+    '''Database replaces text 'None' stored by older versions with NULL, numbers keep their type'''
+    import sqlite3
+    from db import Database, close_connections
+    connection = sqlite3.connect(f"""{app.config['DATABASE_PATH']}/database.sqlite""")
+    connection.execute('CREATE TABLE data (timestamp INTEGER, pressure_pa INTEGER, temp_c REAL, core_temp_c REAL, '
+                       'alt_m INTEGER, lat REAL, lon REAL, bat_mv INTEGER, loop_time_s INTEGER, lat_gw REAL, '
+                       'lon_gw REAL, alt_gw INTEGER, freq REAL, rssi INTEGER, json TEXT)')
+    connection.execute('INSERT INTO data VALUES ("1624000000", "99160", "29.6", "None", "None", "None", "None", '
+                       '"441", "None", "None", "None", "None", "867.9", "-120", "{}")')
+    connection.commit()
+    connection.close()
+    close_connections()
+    data_row = Database(app.config['DATABASE_PATH']).fetch_all_data()[0]
+    assert data_row[:4] == [1624000000, 99160, 29.6, None]
+    assert data_row[4:7] == [None, None, None]
+    assert data_row[12:14] == [867.9, -120]
+
+
+def test_api_telemetry_since(client, db):
+    '''API provides only rows newer than cursor, paged by limit'''
+    for temp in [10, 20, 30]:
+        client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_fields": {"temp_c": temp},
+        })
+    response = client.get('/api/telemetry?limit=2')
+    page = response.get_json()
+    assert [row['temp_c'] for row in page['data']] == [10, 20]
+    assert page['more'] is True
+    page = client.get(f"/api/telemetry?since={page['next']}&limit=2").get_json()
+    assert [row['temp_c'] for row in page['data']] == [30]
+    assert page['more'] is False
+    page = client.get(f"/api/telemetry?since={page['next']}").get_json()
+    assert page['data'] == []
+    assert client.get('/api/telemetry?limit=0').status_code == 400
+
+
+def test_backfill_import(app, tmp_path):
+    '''
+    Archived uplinks are imported in bulk in order of time, invalid files and uplinks are skipped,
+    duplicate deliveries are not counted as imported and import can be repeated
+    '''
+    from archive import RawArchive
+    from backfill import import_archive, parse_iso_time
+    from db import Database
+    (tmp_path / 'cloud_data').mkdir()
+    for name, uplink in [
+            ('a.txt', {'payload_fields': {'temp_c': 20}, 'metadata': {'time': '2021-06-17T19:20:32.358785168Z'}}),
+            ('b.txt', {'payload_fields': {'temp_c': 10}, 'metadata': {'time': '2021-06-17T19:10:32Z'}}),
+            ('c.txt', 'nonsense')]:
+        (tmp_path / 'cloud_data' / name).write_text(str(uplink))
+    archive = RawArchive(str(tmp_path / 'cloud_data'))
+    archive.append(1623957000.5, {'payload_fields': {'temp_c': 5}})
+    archive.append(1623957100, {'payload_fields': [1]})     # malformed uplink
+    for timestamp in (1623957001, 1623957002):      # delivered twice
+        archive.append(timestamp, {'dev_id': 'probe', 'counter': 1, 'payload_fields': {'temp_c': 7}})
+    archive.close()
+    stats = import_archive(str(tmp_path), workers=2, log=None)
+    assert (stats['imported'], stats['failed'], stats['skipped']) == (4, 2, 1)
+    stats = import_archive(str(tmp_path), workers=2, log=None)
+    assert (stats['imported'], stats['skipped']) == (0, 5)
+    database = Database(str(tmp_path))
+    data = database.fetch_all_data()
+    assert [row[2] for row in data] == [5, 7, 10, 20]
+    assert [row[2] for row in database.fetch_derived_data()] == [5, 7, 10, 20]
+    inserted = database._Database__cursor.execute('SELECT timestamp FROM data ORDER BY rowid').fetchall()
+    assert inserted == sorted(inserted)
+    assert data[3][0] == parse_iso_time('2021-06-17T21:20:32.358785+02:00') == 1623957632.358785
+
+
+def test_archive_segments(tmp_path):
+    '''Archive rotates and compresses segments and reads time ranges of all segments'''
+    from archive import RawArchive
+    archive = RawArchive(str(tmp_path), max_bytes=100, index_every=2)
+    for timestamp in range(10):
+        archive.append(float(timestamp), {'counter': timestamp})
+    archive.close()
+    segments = archive.segments()
+    assert len(segments) > 1
+    assert all(segment.endswith('.jsonl.gz') for segment in segments)
+    assert [timestamp for timestamp, _ in archive.read()] == list(range(10))
+    assert list(archive.read(since=4, until=6)) == [(4, {'counter': 4}), (5, {'counter': 5})]
+
+
+def test_app_graph_downsampled(client, db, app):
+    '''Graphs of whole flight are downsampled by LTTB (from /api/columns), live feed provides points of graphs'''
+    from app import provide_live_events
+    from downsample import lttb
+    for temp in [10, 20, 15, 30, 25]:
+        client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_fields": {"temp_c": temp},
+        })
+    assert [event['temp'][1] for _, event in provide_live_events(app.config['DATABASE_PATH'], 0)] == [10, 20, 15, 30, 25]
+    assert client.get('/api/graph/temp').status_code == 404
+    assert lttb([0, 1, 2, 3, 4, 5, 6], [0, 0, 9, 0, 0, -9, 0], 4) == [0, 2, 5, 6]
+
+
+def test_app_columns_match_reference(client, db, app):
+    '''Columnar computation provides the same data as the reference provide_data()'''
+    from app import provide_data, provide_data_columns
+    assert provide_data_columns() == []
+    for payload_fields, metadata in [
+            ({"pressure_pa": 99160, "temp_c": 29.6, "core_temp_c": 36, "bat_mv": 441}, {"latitude": 52.2345, "longitude": 6.2345, "altitude": 2}),
+            ({"pressure_pa": 1500, "temp_c": 200, "core_temp_c": 30, "alt_m": 12000, "lat": 49.1, "lon": 16.6}, {}),
+            ({"temp_c": -110, "core_temp_c": -120}, {"gateways": [{"rssi": -100, "latitude": 50.5, "longitude": 15.5, "altitude": 250.5}]}),
+            ({"temp_c": 70}, {}),
+            ({}, {})]:
+        client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+            "payload_fields": payload_fields, "metadata": metadata})
+    assert provide_data_columns() == provide_data()
+
+
+def test_db_derived_rebuild(client, db, app):
+    '''Values derived at insert are the same as values derived by rebuild of the whole table'''
+    from app import provide_data, provide_data_columns
+    for payload_fields, metadata in [
+            ({"pressure_pa": 1500, "temp_c": 200, "core_temp_c": 30, "bat_mv": 441}, {"latitude": 52.2345, "longitude": 6.2345, "altitude": 2}),
+            ({"temp_c": 20, "alt_m": 12000, "lat": 49.1, "lon": 16.6}, {"latitude": 52.2345, "longitude": 6.2345})]:
+        client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+            "payload_fields": payload_fields, "metadata": metadata})
+    derived = db.fetch_derived_data()
+    assert derived[0][2:4] == [30.0, 24432]
+    db.rebuild_derived()
+    assert db.fetch_derived_data() == derived
+    assert provide_data_columns() == provide_data()
+
+
+def test_endpoint_async_ingest(client, db, app):
+    '''Endpoint acknowledges data immediately, they are stored in background in batches'''
+    from app import provide_ingest_queue
+    app.config['INGEST_ASYNC'] = True
+    for temp in [10, 20, 30]:
+        response = client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_fields": {"temp_c": temp},
+        })
+        assert response.status_code == 200
+    assert client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, data='[1, 2, 3]').status_code == 400
+    provide_ingest_queue().flush()
+    assert [row[2] for row in db.fetch_all_data()] == [10, 20, 30]
+
+
+def test_ingest_queue_backpressure():
+    '''Ingest queue stores uplinks in batches and refuses uplinks when it is full'''
+    import threading
+    import time
+    from queue import Full
+    from ingest import IngestQueue
+    batches = []
+    blocked = threading.Event()
+
+    def store(batch):
+        blocked.wait()
+        batches.append(batch)
+
+    ingest_queue = IngestQueue(store, max_batch=2, max_delay=0.01, max_size=2, timeout=0.01)
+    ingest_queue.submit(0)
+    time.sleep(0.1)     # writer is blocked with the first batch
+    ingest_queue.submit(1)
+    ingest_queue.submit(2)
+    with pytest.raises(Full):
+        ingest_queue.submit(3)
+    blocked.set()
+    ingest_queue.close()
+    assert batches == [[0], [1, 2]]
+
+
+def test_payload_decoder(client, db, app):
+    '''Payload sent by the probe is decoded natively, stored payloads can be decoded again in bulk'''
+    import struct
+    from base64 import b64encode
+    from backfill import redecode_database
+    from payload import decode_payload, decode_payloads
+    current = b64encode(struct.pack('<IhbHHffB', 99160, -25, 12, 3300, 9000, 49.25, 16.5, 7)).decode()
+    assert decode_payload('vCYoASS5AQAAAAAAAAAAAAAA') == {
+        'pressure_pa': 99160, 'temp_c': 29.6, 'core_temp_c': 36, 'bat_mv': 441,
+        'alt_m': 0, 'lat': 0.0, 'lon': 0.0, 'loop_time_s': 0}
+    assert decode_payload('AAAA') is None
+    decoded = decode_payloads(['vCYoASS5AQAAAAAAAAAAAAAA', 'nonsense', current])
+    assert decoded['valid'].tolist() == [True, False, True]
+    assert decoded['temp_c'].tolist() == [29.6, 0, -2.5]
+
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_raw": current, "payload_fields": {"temp_c": 100}})
+    assert db.fetch_all_data()[0][1:8] == [99160, -2.5, 12, 9000, 49.25, 16.5, 3300]
+    db.update_payload_values([[None] * 8 + [1]])
+    assert redecode_database(app.config['DATABASE_PATH']) == 1
+    assert db.fetch_all_data()[0][1:8] == [99160, -2.5, 12, 9000, 49.25, 16.5, 3300]
+    assert db.fetch_derived_data()[0][2] == -2.5
+
+
+def test_app_conditional_get(client, db, app):
+    '''Index page is rendered once, repeated requests get 304 or a cached compressed page until new data are stored'''
+    import gzip
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+    "payload_fields": {"temp_c": 20},
+    })
+    response = client.get('/')
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+    assert response.headers['Last-Modified']
+    assert client.get('/', headers={'If-None-Match': etag}).status_code == 304
+    compressed = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == response.data
+
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+    "payload_fields": {"temp_c": 30},
+    })
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert client.get('/api/telemetry', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_app_etag_rebuild(client, db, app):
+    '''ETag changes when stored data change without new rows (rebuild) and carries version of the code'''
+    from app import CODE_VERSION
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+    "payload_fields": {"temp_c": 20},
+    })
+    etag = client.get('/').headers['ETag']
+    db.rebuild_derived()
+    db.commit()
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.headers['ETag'].strip('W/"').startswith(CODE_VERSION)
+
+
+def test_export(client, db, app):
+    '''Flight is exported as csv, geojson and kml, position from gateway is used when GPS data are missing'''
+    import json
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_fields": {"temp_c": 20, "lat": 49.5, "lon": 16.5, "alt_m": 1000}})
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_fields": {"temp_c": 10}, "metadata": {"latitude": 50.5, "longitude": 15.5}})
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_fields": {"temp_c": 5}})
+    lines = client.get('/export/csv?fields=temp_c,lat').data.decode().splitlines()
+    assert lines[0] == 'time,timestamp,temp_c,lat'
+    assert [line.split(',')[2:] for line in lines[1:]] == [['20.0', '49.5'], ['10.0', '50.5'], ['5.0', '']]
+    geojson = json.loads(client.get('/export/geojson').data)
+    assert geojson['features'][0]['geometry']['coordinates'] == [[16.5, 49.5, 1000], [15.5, 50.5]]
+    assert [feature['properties']['temp_c'] for feature in geojson['features'][1:]] == [20.0, 10.0]
+    kml = client.get('/export/kml').data.decode()
+    assert '16.5,49.5,1000\n15.5,50.5\n' in kml
+    assert client.get('/export/csv?fields=json').status_code == 400
+    assert client.get('/export/xls').status_code == 404
+
+
+def test_live_feed(client, db, app):
+    '''
+    New rows are pushed to all subscribers of the live feed by a single broadcaster, in order of storing
+    (not of timestamps), number of connected clients is limited
+    '''
+    import json
+    from app import provide_broadcaster, provide_live_events, store_uplinks
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_fields": {"temp_c": 20}})
+    broadcaster = provide_broadcaster()
+    subscribers = [broadcaster.subscribe(), broadcaster.subscribe()]
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+        "payload_fields": {"temp_c": 10, "lat": 49.5, "lon": 16.5}})
+    broadcaster.poll()
+    for subscriber in subscribers:
+        timestamp, event = subscriber.get(timeout=1)
+        assert event['table'][2] == '10.0 °C'
+        assert event['temp'][1] == 10.0
+        assert event['marker'][3:] == [16.5, 49.5]
+        assert subscriber.empty()
+        broadcaster.unsubscribe(subscriber)
+    assert len(provide_live_events(app.config['DATABASE_PATH'], 0)) == 2
+
+    subscriber = broadcaster.subscribe()
+    store_uplinks(app.config['DATABASE_PATH'], [(1000.0, {"payload_fields": {"temp_c": 5}})])     # older timestamp
+    broadcaster.poll()
+    assert subscriber.get(timeout=1)[1]['table'][2] == '5.0 °C'
+    broadcaster.max_subscribers = 1
+    try:
+        assert client.get('/api/stream').status_code == 503
+    finally:
+        broadcaster.max_subscribers = app.config['STREAM_MAX_CLIENTS']
+        broadcaster.unsubscribe(subscriber)
+
+    response = client.get('/api/stream', headers={'Last-Event-ID': '0'})
+    chunks = response.response
+    assert next(chunks).startswith(b'retry')
+    event = next(chunks).decode().split('data: ')[1]
+    assert json.loads(event)['table'][2] == '20.0 °C'
+    response.close()
+
+
+def test_marker_clusters(client, db, app):
+    '''Markers are clustered by geohash for zoom level, only markers within bounding box are returned'''
+    import json
+    for lat, lon in [(49.2001, 16.6001), (49.2002, 16.6002), (49.2, 16.3), (10.0, 10.0)]:
+        client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+            "payload_fields": {"temp_c": 20, "lat": lat, "lon": lon}})
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={"payload_fields": {"temp_c": 5}})
+    world = json.loads(client.get('/api/markers?zoom=0').data)
+    assert [cluster['count'] for cluster in world] == [1, 3]
+    clusters = json.loads(client.get('/api/markers?bbox=16,49,17,50&zoom=15').data)
+    assert sorted(cluster['count'] for cluster in clusters) == [1, 2]
+    assert json.loads(client.get('/api/markers?bbox=16,49,17,50&zoom=4').data)[0]['count'] == 3
+    card = json.loads(client.get(f'/api/markers/{clusters[0]["id"]}').data)
+    assert 'temperature: 20.0 °C' in card['card']
+    assert client.get('/api/markers/5').status_code == 404      # row without position
+    assert client.get('/api/markers?bbox=16,49').status_code == 400
+
+
+def test_flights(client, db, app):
+    '''Rows are partitioned by device and flight (new flight when counter is reset), finished flights can be archived'''
+    import json
+    from app import archive_flights
+    for dev_id, counter, lat in [('probe-a', 1, 49.1), ('probe-a', 2, 49.2), ('probe-b', 7, 50.0), ('probe-a', 1, 51.0)]:
+        client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={
+            "dev_id": dev_id, "hardware_serial": dev_id.upper(), "counter": counter,
+            "payload_fields": {"temp_c": 20, "lat": lat, "lon": 16.5}})
+    flights = json.loads(client.get('/api/flights').data)
+    assert [(flight['dev_id'], flight['rows']) for flight in flights] == [('probe-a', 1), ('probe-b', 1), ('probe-a', 2)]
+    first = flights[-1]['id']
+    rows = json.loads(client.get(f'/api/telemetry?flight={first}').data)['data']
+    assert [row['lat'] for row in rows] == [49.1, 49.2]
+    assert json.loads(client.get(f'/api/flights/{first}/route').data) == [[16.5, 49.1], [16.5, 49.2]]
+    plan = db._Database__cursor.execute('EXPLAIN QUERY PLAN SELECT timestamp FROM telemetry_derived WHERE timestamp > 0 AND flight_id = 1').fetchall()
+    assert 'telemetry_derived_flight' in str(plan)
+    assert archive_flights() == [first]
+    assert [row[5] for row in db.fetch_all_data()] == [50.0, 51.0]
+    assert client.get(f'/export/csv?flight={first}&fields=lat').data.decode().splitlines()[1].endswith(',49.1')
+    assert json.loads(client.get('/api/flights').data)[-1]['archived'] is True
+    assert client.get('/api/flights/999/route').status_code == 404
+
+
+def test_identity_sanitized(client, db, app):
+    '''Frame counter and ids of the probe are sanitized, a string counter does not break storing of its batch'''
+    from app import store_uplinks
+    from db import parse_identity, uplink_key
+    assert parse_identity({'dev_id': 7, 'hardware_serial': ['A'], 'counter': '6'}) == {
+        'dev_id': '7', 'hardware_serial': None, 'app_id': None, 'counter': 6}
+    assert parse_identity({'counter': 'six'})['counter'] is None
+    assert parse_identity({'counter': True})['counter'] is None
+    assert uplink_key({'counter': [1]}) is None
+    store_uplinks(app.config['DATABASE_PATH'], [
+        (1000 + i, {"dev_id": "probe", "counter": counter, "payload_fields": {"temp_c": 20 + i}})
+        for i, counter in enumerate([40, "41", 42])])
+    assert [row[2] for row in db.fetch_all_data()] == [20, 21, 22]
+    assert [line[0] for line in db._Database__cursor.execute('SELECT counter FROM data ORDER BY rowid')] == [40, 41, 42]
+
+
+def test_flights_out_of_order(client, db, app):
+    '''Frame delivered late stays in its flight, only a counter reset far back to a small value starts a new flight'''
+    import json
+    from app import store_uplinks
+    for timestamp, counter in [(1000, 40), (1060, 42), (1090, 41), (1120, 43), (1180, 2), (1240, 3)]:
+        store_uplinks(app.config['DATABASE_PATH'], [(timestamp, {"dev_id": "probe", "counter": counter,
+                                                                 "payload_fields": {"temp_c": counter}})])
+    flights = json.loads(client.get('/api/flights').data)
+    assert [flight['rows'] for flight in flights] == [2, 4]
+
+
+def test_synthetic_flight(client, db, app):
+    '''Synthetic flight is stored like real uplinks, share of missing GPS and invalid temperature is respected'''
+    from synthetic import generate_flight
+    uplinks = generate_flight(100, gateways=2, missing_gps=0.3, invalid_temp=0.1)
+    assert generate_flight(100, gateways=2, missing_gps=0.3, invalid_temp=0.1) == uplinks
+    assert all(len(raw_data['metadata']['gateways']) == 2 for _, raw_data in uplinks)
+    for _, raw_data in uplinks:
+        client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json=raw_data)
+    rows = db.fetch_all_data()
+    assert len(rows) == 100
+    assert 15 < sum(row[5] is None for row in rows) < 45       # lat from GPS
+    assert all(row[9] is not None for row in rows)               # lat from gateway
+    assert 0 < sum(row[2] > 50 for row in rows) < 25             # invalid temperature
+
+
+def test_metrics(client, db, app):
+    '''Stages and requests are measured and exposed in Prometheus text format, requests can be profiled (streams excepted), metrics need credentials'''
+    import os
+    import shutil
+    from metrics import registry
+    registry.clear()
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={"payload_fields": {"temp_c": 20}})
+    client.post('/endpoint', json={})
+    client.get('/')
+    assert client.get('/metrics').status_code == 401
+    text = client.get('/metrics', headers={'Authorization': 'Basic Zm9vOmJhcg=='}).data.decode()
+    for name in ['auth', 'archive_write', 'prepare_data', 'store_data', 'fetch_derived_data', 'render_template']:
+        assert f'stage="{name}"' in text
+    assert f'uplinks_rejected_total{{worker="{os.getpid()}",reason="unauthorized"}} 1' in text
+    assert f'request_seconds_count{{worker="{os.getpid()}",endpoint="endpoint",status="200"}} 1' in text
+    assert 'le="+Inf"' in text
+    app.config['PROFILE_REQUESTS'] = True
+    try:
+        client.get('/metrics', headers={'Authorization': 'Basic Zm9vOmJhcg=='})
+        client.get('/api/stream').close()
+    finally:
+        app.config['PROFILE_REQUESTS'] = False
+    directory = f'''{app.config['DATABASE_PATH']}/profiles'''
+    assert [name.startswith('metrics-') for name in os.listdir(directory)] == [True]
+    shutil.rmtree(directory)
+
+
+def test_gateway_coverage(client, db, app):
+    '''Every reception is stored, aggregates of gateways are updated at insert'''
+    import json
+
+    def uplink(lat, gateways):
+        return {"payload_fields": {"temp_c": 20, "lat": lat, "lon": 16.0}, "metadata": {"gateways": [
+            {"gtw_id": gtw_id, "rssi": rssi, "snr": snr, "channel": 1, "latitude": 49.0, "longitude": 16.0}
+            for gtw_id, rssi, snr in gateways]}}
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='},
+                json=uplink(50.0, [('gw-a', -100, 5.0), ('gw-b', -120, -3.0)]))
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='},
+                json=uplink(49.5, [('gw-a', -110, None)]))
+    assert db.fetch_all_data()[0][13] == -100       # strongest gateway is still stored with the row
+    gateways = json.loads(client.get('/api/gateways').data)
+    assert [gateway['gtw_id'] for gateway in gateways] == ['gw-a', 'gw-b']
+    assert gateways[0]['receptions'] == 2
+    assert (gateways[0]['best_rssi'], gateways[0]['mean_rssi']) == (-100, -105)
+    assert (gateways[0]['best_snr'], gateways[0]['mean_snr']) == (5.0, 5.0)
+    assert round(gateways[0]['max_distance_m'] / 1000) == 111
+    assert gateways[0]['first_seen'] < gateways[0]['last_seen']
+    db.rebuild_gateways()
+    assert json.loads(client.get('/api/gateways').data) == gateways
+
+
+def test_endpoint_deduplication(client, db, app):
+    '''Repeated deliveries are not stored again, gateways of duplicates are merged into the stored uplink'''
+    import json
+    import time
+    from app import provide_archive, store_uplinks
+    from db import uplink_key
+
+    def uplink(*gateways):
+        return {"dev_id": "probe", "counter": 42, "payload_fields": {"temp_c": 20},
+                "metadata": {"gateways": [{"gtw_id": gtw_id, "rssi": -100} for gtw_id in gateways]}}
+    for gateways in [('gw-a',), ('gw-a',), ('gw-b', 'gw-a')]:
+        response = client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json=uplink(*gateways))
+        assert response.status_code == 200
+    assert len(db.fetch_all_data()) == 1
+    archived = [raw_data for _, raw_data in provide_archive().read()
+                if type(raw_data) == dict and uplink_key(raw_data) == uplink_key(uplink('gw-a'))]
+    assert len(archived) == 2       # the second delivery was not even archived
+    assert [gateway['receptions'] for gateway in json.loads(client.get('/api/gateways').data)] == [1, 1]
+    # deliveries missed by LRU (other worker, restart) are caught by database, also within one batch
+    now = time.time()
+    store_uplinks(app.config['DATABASE_PATH'], [(now, uplink('gw-c')), (now + 1, uplink('gw-c', 'gw-d'))])
+    assert len(db.fetch_all_data()) == 1
+    assert len(json.loads(client.get('/api/gateways').data)) == 4
+
+
+def test_recent_uplinks(client, db, app, monkeypatch):
+    '''Recent uplinks expire after DUPLICATE_WINDOW, uplinks of a failed batch are not remembered'''
+    import sqlite3
+    from app import provide_ingest_queue
+    from db import Database, DUPLICATE_WINDOW
+    from ingest import RecentUplinks
+    recent = RecentUplinks(window=DUPLICATE_WINDOW)
+    recent.add('key', {'gw-a'}, 1000)
+    assert recent.seen('key', {'gw-a'}, 1000 + DUPLICATE_WINDOW)
+    assert not recent.seen('key', {'gw-a', 'gw-b'}, 1000)
+    assert not recent.seen('key', {'gw-a'}, 1001 + DUPLICATE_WINDOW)
+
+    def store_many(self, rows):
+        raise sqlite3.OperationalError('database is locked')
+    uplink = {"dev_id": "probe", "counter": 7, "payload_fields": {"temp_c": 20}}
+    monkeypatch.setitem(app.config, 'INGEST_RETRY_DELAY', 0)
+    app.config['INGEST_ASYNC'] = True
+    try:
+        with monkeypatch.context() as patch:
+            patch.setattr(Database, 'store_many', store_many)
+            assert client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json=uplink).status_code == 200
+            provide_ingest_queue().flush()
+        assert client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json=uplink).status_code == 200
+        provide_ingest_queue().flush()
+    finally:
+        app.config['INGEST_ASYNC'] = False
+    assert len(db.fetch_all_data()) == 1
+
+
+def test_store_uplinks_isolated(client, db, app, monkeypatch):
+    '''Malformed uplink is skipped without its batch, batch which meets a locked database is stored again'''
+    import os
+    import sqlite3
+    from app import store_uplinks
+    from db import Database
+    from metrics import registry
+    registry.clear()
+    uplinks = [(1000 + i, {"dev_id": "probe", "counter": i, "payload_fields": payload})
+               for i, payload in enumerate([{"temp_c": 20}, [1], {"temp_c": 21}, {"temp_c": 22, "lat": [49]}])]
+    store_uplinks(app.config['DATABASE_PATH'], uplinks)
+    assert [row[2] for row in db.fetch_all_data()] == [20, 21]
+    assert f'uplinks_rejected_total{{worker="{os.getpid()}",reason="malformed"}} 2' in registry.render((('worker', os.getpid()),))
+
+    store_many = Database.store_many
+    calls = []
+
+    def store_locked_once(self, rows):
+        calls.append(len(rows))
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        return store_many(self, rows)
+    monkeypatch.setattr(Database, 'store_many', store_locked_once)
+    monkeypatch.setitem(app.config, 'INGEST_RETRY_DELAY', 0)
+    store_uplinks(app.config['DATABASE_PATH'], [(2000, {"dev_id": "probe", "counter": 9, "payload_fields": {"temp_c": 23}})],
+                  retries=1)
+    assert calls == [1, 1]
+    assert [row[2] for row in db.fetch_all_data()] == [20, 21, 23]
+
+
+def test_rollups(client, db, app):
+    '''Hourly and daily aggregates are updated at insert, equal to rebuilt ones, resolution follows time span'''
+    import json
+    from app import store_uplinks
+    day = 1624838400        # midnight UTC
+    uplinks = [(day + hour * 3600 + 60, {"dev_id": "probe", "counter": hour, "payload_fields": {
+        "temp_c": 10 + hour, "alt_m": 1000 * hour, "bat_mv": 3000}}) for hour in range(1, 49)]
+    store_uplinks(app.config['DATABASE_PATH'], uplinks[:10])
+    store_uplinks(app.config['DATABASE_PATH'], uplinks[10:])
+    rollup = json.loads(client.get(f'/api/rollup?start={day}&end={day + 86400}').data)
+    assert rollup['resolution'] == 3600
+    assert rollup['buckets'][0]['time'] == day + 3600
+    assert rollup['buckets'][0]['temp_c'] == {'min': 11.0, 'max': 11.0, 'mean': 11.0}
+    app.config['ROLLUP_MAX_BUCKETS'] = 10
+    try:
+        daily = json.loads(client.get('/api/rollup').data)
+    finally:
+        app.config['ROLLUP_MAX_BUCKETS'] = 500
+    assert daily['resolution'] == 86400
+    assert [bucket['rows'] for bucket in daily['buckets']] == [23, 24, 1]
+    incremental = db._Database__cursor.execute('SELECT * FROM rollups ORDER BY 1, 2, 3').fetchall()
+    db.rebuild_rollups()
+    assert db._Database__cursor.execute('SELECT * FROM rollups ORDER BY 1, 2, 3').fetchall() == incremental
+    days = db.fetch_rollups(86400, day, day + 2 * 86400)
+    assert [line[1] for line in days] == [23, 24, 1]
+    assert days[0][2:5] == [11.0, 33.0, 22.0]
+
+
+def test_rollups_cached(client, db, app, monkeypatch):
+    '''Rollups are cached by data revision without building derived data of the index page'''
+    import app as application
+    from app import store_uplinks
+    store_uplinks(app.config['DATABASE_PATH'], [(1624838460, {"dev_id": "probe", "counter": 1, "payload_fields": {
+        "temp_c": 10}})])
+
+    def provide_derived_data():
+        raise AssertionError('derived data built for rollups')
+    monkeypatch.setattr(application, 'provide_derived_data', provide_derived_data)
+    response = client.get('/api/rollup')
+    assert response.status_code == 200
+    assert client.get('/api/rollup', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get('/api/rollup').data == response.data
+
+
+def test_track_estimate(client, db, app):
+    '''
+    Estimated track fills gaps of GPS (also on the route of the map), its error grows without a fix,
+    incremental estimate equals rebuilt one
+    '''
+    import json
+    from app import store_uplinks, provide_data_route, provide_live_events
+    from synthetic import generate_flight
+    uplinks = generate_flight(60, missing_gps=0.3)
+    store_uplinks(app.config['DATABASE_PATH'], uplinks[:25])
+    store_uplinks(app.config['DATABASE_PATH'], uplinks[25:])
+    columns = ['data_id', 'lat', 'lon', 'est_lat', 'est_lon', 'est_error_m']
+    rows = list(db.iter_derived(columns))
+    assert all(row[3] is not None for row in rows)
+    fixes = [i for i, row in enumerate(rows) if row[1] is not None]
+    for i, row in enumerate(rows[fixes[0]:fixes[-1]], fixes[0]):
+        if row[1] is None:
+            before = max(j for j in fixes if j < i)
+            after = min(j for j in fixes if j > i)
+            share = (i - before) / (after - before)
+            assert abs(row[3] - (rows[before][1] + share * (rows[after][1] - rows[before][1]))) < 0.1
+            assert abs(row[4] - (rows[before][2] + share * (rows[after][2] - rows[before][2]))) < 0.1
+            assert row[5] > rows[before][5]
+        else:
+            assert abs(row[3] - row[1]) < 0.001 and row[5] <= 30
+    flight = json.loads(client.get('/api/flights').data)[0]['id']
+    route = json.loads(client.get(f'/api/flights/{flight}/route?estimated=1').data)
+    assert [point[:2] for point in route] == [[row[4], row[3]] for row in rows]
+    # route of the map follows GPS, estimated track fills rows without fix (not positions of gateways)
+    route = json.loads(client.get(f'/api/flights/{flight}/route').data)
+    assert route == [[row[2], row[1]] if row[1] is not None else [row[4], row[3]] for row in rows]
+    assert provide_data_route() == route
+    assert provide_live_events(app.config['DATABASE_PATH'], 0)[-1][1]['route'] == route[-1]
+    assert 'est_lat' in client.get('/export/csv?fields=est_lat,est_error_m').data.decode().splitlines()[0]
+    db.rebuild_track()
+    rebuilt = list(db.iter_derived(columns))
+    assert [row[:3] for row in rebuilt] == [row[:3] for row in rows]
+    assert [row[3:] for row in rebuilt] == [pytest.approx(row[3:]) for row in rows]
+
+
+def test_track_out_of_order(db, app):
+    '''Rows older than the track state rebuild the track of their flight, estimate does not depend on order of insert'''
+    from app import store_uplinks
+    from synthetic import generate_flight
+    uplinks = generate_flight(60, missing_gps=0.3)
+    store_uplinks(app.config['DATABASE_PATH'], uplinks[:20])
+    store_uplinks(app.config['DATABASE_PATH'], uplinks[40:])
+    store_uplinks(app.config['DATABASE_PATH'], uplinks[20:40])
+    columns = ['timestamp', 'est_lat', 'est_lon', 'est_error_m']
+    rows = sorted(db.iter_derived(columns))
+    assert len(rows) == 60 and len({row[0] for row in rows}) == 60
+    db.rebuild_track()
+    assert sorted(db.iter_derived(columns)) == [pytest.approx(row) for row in rows]
+
+
+def test_binary_columns(client, db, app):
+    '''Typed columns are decoded to stored values, downsampled by points and compressed for clients accepting gzip'''
+    import gzip
+    import json
+    import struct
+    import numpy as np
+    from app import store_uplinks
+    from synthetic import generate_flight
+    store_uplinks(app.config['DATABASE_PATH'], generate_flight(200))
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={"payload_fields": {"bat_mv": 3000}})
+
+    def decode(body):
+        length = struct.unpack('<I', body[:4])[0]
+        assert (4 + length) % 4 == 0
+        header = json.loads(body[4:4 + length])
+        columns, offset = {}, 4 + length
+        for field, dtype in header['columns']:
+            columns[field] = np.frombuffer(body, '<i4' if dtype == 'int32' else '<f4', header['rows'], offset)
+            offset += 4 * header['rows']
+        assert offset == len(body)
+        return columns
+    response = client.get('/api/columns?fields=temp_c,alt_m,lat')
+    assert response.mimetype == 'application/octet-stream'
+    columns = decode(response.data)
+    rows = list(db.iter_derived(['timestamp', 'temp_c', 'alt_m', 'pos_lat']))
+    assert list(columns) == ['timestamp', 'temp_c', 'alt_m', 'lat']
+    assert columns['timestamp'].tolist() == [int(row[0]) for row in rows]
+    assert np.isnan(columns['temp_c']).tolist() == [row[1] is None for row in rows] == [False] * 200 + [True]
+    assert np.allclose(columns['alt_m'], np.array([row[2] for row in rows], dtype=float), equal_nan=True)
+    assert len(response.data) < len(json.dumps(rows)) / 2
+    downsampled = decode(client.get('/api/columns?fields=timestamp,temp_c&points=50').data)
+    assert len(downsampled['timestamp']) == 50 and not np.isnan(downsampled['temp_c']).any()
+    ranged = decode(client.get(f'/api/columns?fields=alt_m&start={rows[10][0]}&end={rows[19][0]}').data)
+    assert len(ranged['alt_m']) == 10
+    compressed = client.get('/api/columns?fields=temp_c,alt_m,lat', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == response.data
+    assert client.get('/api/columns?fields=json').status_code == 400
+    assert client.get('/api/columns?flight=999').status_code == 404
+    assert b'points=500' in client.get('/').data
+
+
+def test_raw_uplinks(client, db, app):
+    '''Raw uplinks are stored compressed apart from table data, decoded only on request, older text is moved'''
+    import sqlite3
+    from db import Database, close_connections
+    uplink = {"dev_id": "probe", "counter": 3, "payload_fields": {"temp_c": 20},
+              "metadata": {"gateways": [{"gtw_id": "eui-1", "rssi": -100}]}}
+    client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json=uplink)
+    assert len(db.fetch_all_data()[0]) == 14
+    data_id, blob = db._Database__cursor.execute('SELECT data_id, uplink FROM raw_uplinks').fetchone()
+    assert len(blob) < len(str(uplink))
+    assert db.fetch_raw_uplink(data_id) == uplink
+    assert list(db.fetch_raw_data()) == [(data_id, uplink)]
+    assert db.fetch_raw_uplink(data_id + 1) is None
+    close_connections()
+    connection = sqlite3.connect(f"""{app.config['DATABASE_PATH']}/database.sqlite""")
+    connection.execute('ALTER TABLE data ADD COLUMN json TEXT')
+    connection.execute('DELETE FROM raw_uplinks')
+    connection.execute('UPDATE data SET json = ?', ("defaultdict(<function endpoint.<locals>.<lambda> at 0x7f1ffe639800>, " + str(uplink) + ")",))
+    connection.execute('INSERT INTO data (timestamp, json) VALUES (1, ?)', ('nonsense',))
+    connection.execute('PRAGMA user_version = 8')
+    connection.commit()
+    connection.close()
+    database = Database(app.config['DATABASE_PATH'])
+    assert database.fetch_raw_uplink(data_id) == uplink
+    assert database.fetch_raw_uplink(data_id + 1) == 'nonsense'
+    assert database._Database__cursor.execute('SELECT COUNT(*) FROM data WHERE json IS NOT NULL').fetchone()[0] == 0
+
+
+def test_load_test(client, db, app, monkeypatch, tmp_path):
+    '''Load test replays uplinks of several probes with retries, reports latency percentiles and SQLite lock errors'''
+    from app import load_credentials
+    from loadtest import LocalTarget, load_uplinks, percentiles, run
+    uplinks = load_uplinks(synthetic=60, probes=3, retries=0.5, seed=1)
+    assert 60 < len(uplinks) < 120
+    assert {raw_data['dev_id'] for raw_data in uplinks} == {'probe-0', 'probe-1', 'probe-2'}
+    report = run(LocalTarget(load_credentials()), uplinks, concurrency=4, readers=1)
+    assert report['uplinks'] == len(uplinks) and report['throughput'] > 0
+    assert report['endpoint']['status'] == {'200': len(uplinks)}
+    assert report['endpoint']['p50'] <= report['endpoint']['p95'] <= report['endpoint']['p99'] <= report['endpoint']['max']
+    assert report['index']['status'] == {'200': report['index']['count']}
+    assert report['sqlite_locked'] == 0 and report['unavailable'] == 0
+    assert len(db.fetch_all_data()) == 60
+    assert percentiles([i / 100 for i in range(1, 101)])['p95'] == 0.95
+    # archive of both formats (text files of older versions and segments) is replayed in order of time
+    from archive import RawArchive
+    from loadtest import print_report
+    (tmp_path / 'a.txt').write_text(str({'payload_fields': {'temp_c': 20}, 'metadata': {'time': '2021-06-17T19:20:32Z'}}))
+    archive = RawArchive(str(tmp_path))
+    archive.append(1623957000, {'payload_fields': {'temp_c': 5}})
+    archive.append(1623957100, {'payload_fields': [1]})     # malformed uplink
+    archive.close()
+    assert [raw_data['payload_fields'] for raw_data in load_uplinks(str(tmp_path))] == [{'temp_c': 5}, {'temp_c': 20}]
+    print_report({**report, 'throughput': None})
+    import sqlite3
+    from db import Database
+    from loadtest import locked_count
+
+    def store_locked(self, rows):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(Database, 'store_many', store_locked)
+    before = locked_count(LocalTarget(load_credentials()))
+    response = client.post('/endpoint', headers={'Authorization': 'Basic Zm9vOmJhcg=='}, json={"payload_fields": {"temp_c": 20}})
+    assert response.status_code == 503 and response.headers['Retry-After'] == '10'
+    assert locked_count(LocalTarget(load_credentials())) == before + 1
+    fresh = [{"dev_id": "probe-9", "counter": i, "payload_fields": {"temp_c": i}} for i in range(5)]
+    report = run(LocalTarget(load_credentials()), fresh, concurrency=2, readers=0)
+    assert report['endpoint']['status'] == {'503': 5} and report['unavailable'] == 5
+    assert locked_count(LocalTarget(load_credentials())) == before + 6
+
+    def fetch_locked(self, *args):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(Database, 'fetch_flights', fetch_locked)
+    assert client.get('/api/flights').status_code == 503
+    assert locked_count(LocalTarget(load_credentials())) == before + 7
+
+
+def test_store_many_rowids(db, app):
+    '''Derived values, raw uplinks and receptions are linked to their rows also when rowids of a batch have gaps'''
+    from backfill import prepare_uplink
+    uplinks = [(1624000000 + i, {"dev_id": "probe", "counter": i, "payload_fields": {"temp_c": 10 + i},
+                                 "metadata": {"gateways": [{"gtw_id": f"eui-{i}", "rssi": -100}]}}) for i in range(3)]
+    # a row inserted by another writer in the middle of the batch
+    db._Database__cursor.execute('''
+        CREATE TEMP TRIGGER gap AFTER INSERT ON data WHEN new.counter = 0
+        BEGIN INSERT INTO data (timestamp) VALUES (0); END''')
+    assert db.store_many([prepare_uplink(timestamp, raw_data) for timestamp, raw_data in uplinks]) == 3
+    db.commit()
+    linked = db._Database__cursor.execute('''
+        SELECT data.counter, derived.temp_c, gtw_id FROM data
+        JOIN telemetry_derived AS derived ON derived.data_id = data.rowid
+        JOIN gateway_reception ON gateway_reception.data_id = data.rowid ORDER BY data.counter''').fetchall()
+    assert linked == [(0, 10.0, 'eui-0'), (1, 11.0, 'eui-1'), (2, 12.0, 'eui-2')]
+    rowids = db._Database__cursor.execute('SELECT rowid FROM data WHERE counter IS NOT NULL ORDER BY counter').fetchall()
+    assert [db.fetch_raw_uplink(rowid)['counter'] for rowid, in rowids] == [0, 1, 2]
@@ -0,0 +1,75 @@
+import math
+
+# metres per degree of latitude
+M_PER_DEG = 111320.0
+# standard deviation of position measured by GPS and estimated from gateways (m)
+GPS_ERROR_M = 30.0
+GATEWAY_ERROR_M = 150000.0
+# standard deviation of acceleration of the balloon (m/s2), changes of wind
+ACCELERATION = 0.02
+# standard deviation of initial velocity (m/s), winds of the upper troposphere
+INITIAL_SPEED = 30.0
+
+
+def gateway_position(gateways):
+    '''
+    Position measured by gateways, average of their positions weighted by received power (RSSI in dBm converted to mW)
+    gateways are receptions of Database.parse_gateways(), None if no gateway knows its position
+    '''
+    weights = [(10 ** (rssi / 10) if rssi is not None else 1e-15, lat, lon)
+               for _, rssi, _, _, lat, lon, _, _ in gateways if lat is not None and lon is not None]
+    total = sum(weight for weight, _, _ in weights)
+    if not weights or total <= 0:
+        return None
+    return (sum(weight * lat for weight, lat, _ in weights) / total,
+            sum(weight * lon for weight, _, lon in weights) / total)
+
+
+def step(state, timestamp, gps, gateways):
+    '''
+    Advance the track estimate of a flight by one uplink, O(1):
+        - state = [timestamp, lat, lon, velocity north, velocity east (m/s), covariance of position, of position and
+          velocity, of velocity], the same for both axes (measurements are isotropic), None before the first measurement
+        - gps = (lat, lon) from GPS or None, gateways = receptions of the uplink (see gateway_position())
+    A constant velocity Kalman filter, GPS fix is a precise measurement, position of gateways a very rough one
+    Return new state and the estimate (lat, lon, standard deviation in m), estimate is None while nothing is known;
+    uplinks older than state do not change it, they get the measurement itself (or prediction) as estimate
+    '''
+    if gps is not None:
+        measurement, error = gps, GPS_ERROR_M
+    else:
+        measurement, error = gateway_position(gateways), GATEWAY_ERROR_M
+    if state is None:
+        if measurement is None:
+            return None, None
+        state = [timestamp, measurement[0], measurement[1], 0.0, 0.0, error ** 2, 0.0, INITIAL_SPEED ** 2]
+        return state, (measurement[0], measurement[1], error)
+    if timestamp < state[0]:
+        if measurement is not None:
+            return state, (measurement[0], measurement[1], error)
+        return state, (state[1], state[2], math.sqrt(state[5]))
+    # predict
+    last, lat, lon, vel_n, vel_e, p_pos, p_cross, p_vel = state
+    dt = timestamp - last
+    m_per_deg_lon = M_PER_DEG * max(math.cos(math.radians(lat)), 0.01)
+    lat += vel_n * dt / M_PER_DEG
+    lon += vel_e * dt / m_per_deg_lon
+    q = ACCELERATION ** 2
+    p_pos, p_cross, p_vel = (p_pos + 2 * dt * p_cross + dt * dt * p_vel + q * dt ** 3 / 3,
+                             p_cross + dt * p_vel + q * dt ** 2 / 2,
+                             p_vel + q * dt)
+    # update, innovation in metres
+    if measurement is not None:
+        gain_pos = p_pos / (p_pos + error ** 2)
+        gain_vel = p_cross / (p_pos + error ** 2)
+        north = (measurement[0] - lat) * M_PER_DEG
+        east = (measurement[1] - lon) * m_per_deg_lon
+        lat += gain_pos * north / M_PER_DEG
+        lon += gain_pos * east / m_per_deg_lon
+        vel_n += gain_vel * north
+        vel_e += gain_vel * east
+        p_pos, p_cross, p_vel = (1 - gain_pos) * p_pos, (1 - gain_pos) * p_cross, p_vel - gain_vel * p_cross
+    lat = max(min(lat, 90.0), -90.0)
+    lon = (lon + 180) % 360 - 180
+    state = [timestamp, lat, lon, vel_n, vel_e, p_pos, p_cross, p_vel]
+    return state, (lat, lon, math.sqrt(p_pos))